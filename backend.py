@@ -1,12 +1,42 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import collections
+import itertools
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from image_generation.generate_replicate import ImageGenerator
-from program_creation.program_creation import ProgramGenerator
-from model.request_schema import ImageGenerationRequest, ImageGenerationResponse, ProgramRequest, SimulateLifeRequest
-from simulate_life.simulate_life import LifeSimulator
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from model.request_schema import BatchSimulateLifeRequest, BranchJobRequest, EnsembleSimulateLifeRequest, ExtendJobRequest, FastSimulationRequest, FutureRequest, ImageGenerationRequest, ImageGenerationResponse, ProgramRequest, SessionRequest, SimulateLifeRequest, TextToSpeechRequest
+from server.clients import ClientRegistry, ClientUnavailableError
+from server.executors import ExecutorSaturatedError
+from server.media import parse_media_id
+from server.pipeline import build_future_pipeline
+from llm import metrics
+from llm.resilience import CircuitOpenError
+from llm.routing import latency_budget
+from simulate_life.ensemble import EnsembleSimulator
+from simulate_life.fast_simulation import FastSimulator, TransitionModel, UnknownActionError
 import uvicorn
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the clients once per worker, then warm them up in the background
+    # so that /ready only reports ready once the providers have been reached.
+    clients = ClientRegistry()
+    await asyncio.to_thread(clients.start)
+    app.state.clients = clients
+    clients.start_jobs()
+    clients.start_sessions()
+    warm_up = asyncio.create_task(asyncio.to_thread(clients.warm_up))
+    yield
+    warm_up.cancel()
+    clients.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -15,53 +45,485 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Token-Usage", "ETag", "Content-Range", "Accept-Ranges"],
 )
 
+# Per-request breakdown headers for every response, otherwise only when asked with X-Request-Timing: 1
+TIMING_HEADERS = os.getenv("TIMING_HEADERS", "0") == "1"
+
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    with metrics.request_timings() as timings:
+        response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.HTTP_SECONDS.observe(
+        time.perf_counter() - start,
+        method=request.method,
+        path=route.path if route is not None else "unmatched",
+        status=response.status_code,
+    )
+    if TIMING_HEADERS or request.headers.get("X-Request-Timing") == "1":
+        # Streaming responses only include what happened before their first byte
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+        response.headers["X-Token-Usage"] = json.dumps(timings["tokens"])
+    return response
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse holding an admission slot of executor until it is sent.
+
+    The slot is taken on creation, before the response starts, so saturation is
+    still a 503. It is released once the response is sent or abandoned, including
+    when the client goes away before the body was ever iterated, in which case
+    the generator's own finally never runs.
+    """
+
+    def __init__(self, content, executor, **kwargs):
+        self.executor = executor
+        # Nothing to release if acquire raises
+        self.released = True
+        executor.acquire()
+        self.released = False
+        try:
+            super().__init__(content, **kwargs)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.executor.release()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+    def __del__(self):
+        # Last resort for a response dropped before it was ever called
+        self.release()
+
+
+def get_clients(request: Request) -> ClientRegistry:
+    return request.app.state.clients
+
+
+@app.exception_handler(ClientUnavailableError)
+async def client_unavailable_handler(request: Request, exc: ClientUnavailableError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
+@app.exception_handler(ExecutorSaturatedError)
+async def executor_saturated_handler(request: Request, exc: ExecutorSaturatedError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(exc.retry_after))},
+    )
+
+
+@app.get("/ready")
+async def ready(clients: ClientRegistry = Depends(get_clients)):
+    status = clients.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
+@app.get("/cache/stats")
+async def cache_stats(clients: ClientRegistry = Depends(get_clients)):
+    stats = {"responses": clients.cache.get_stats()}
+    if clients.prefix_cache is not None:
+        stats["prompt_prefixes"] = clients.prefix_cache.get_stats()
+    if clients.text_to_speech is not None and clients.text_to_speech.cache is not None:
+        stats["audio"] = clients.text_to_speech.cache.get_stats()
+    if clients.sessions is not None:
+        stats["sessions"] = clients.sessions.get_stats()
+    if clients.media_store is not None:
+        stats["media"] = clients.media_store.get_stats()
+    return stats
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/routing/report")
+async def routing_report(clients: ClientRegistry = Depends(get_clients)):
+    """Calls, failure rate and latency per (stage, model), to choose MODEL_ROUTES from data."""
+    return clients.router.report()
+
+
 @app.post("/generate-image", response_model=ImageGenerationResponse)
-async def generate_image(request: ImageGenerationRequest):
-    # Initialize the ImageGenerator
-    generator = ImageGenerator()
+async def generate_image(request: ImageGenerationRequest, clients: ClientRegistry = Depends(get_clients)):
+    generator = clients.get("image_generator")
+    # Without a media store (MEDIA_STORE=none) the images are inlined, as they used to be
+    by_reference = request.response_format == "reference" and clients.media_store is not None
     try:
-        saved_images = generator.generate_image(
+        images = await clients.executor("replicate").run(
+            generator.generate_image_media if by_reference else generator.generate_image,
             prompt=request.prompt,
             input_images_path=request.input_images_path,
             num_steps=request.num_steps,
             negative_prompt=request.negative_prompt,
-            output_directory=request.output_directory
         )
-        return ImageGenerationResponse(saved_images=saved_images)
+        if by_reference:
+            return ImageGenerationResponse(saved_images=[image["url"] for image in images], media=images)
+        return ImageGenerationResponse(saved_images=images)
+    except (ExecutorSaturatedError, CircuitOpenError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/generate-program")
-async def generate_program(request: ProgramRequest):
+async def generate_program(request: ProgramRequest, clients: ClientRegistry = Depends(get_clients)):
+    program_generator = clients.get("program_generator")
     try:
-        program_generator = ProgramGenerator()
-        program = program_generator.generate_program(request.user_query)
+        with latency_budget(request.latency_budget_seconds):
+            program = await clients.executor("gemini").run(
+                program_generator.generate_program, request.user_query
+            )
         return {"program": program}
+    except (ExecutorSaturatedError, CircuitOpenError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate-program/stream")
+async def generate_program_stream(request: ProgramRequest, clients: ClientRegistry = Depends(get_clients)):
+    """
+    Stream the program as NDJSON, one {domain, actions} line per domain as soon
+    as the model has written it, then a final {program} line.
+    """
+    program_generator = clients.get("program_generator")
+
+    async def domains():
+        try:
+            with latency_budget(request.latency_budget_seconds):
+                async for event in program_generator.stream_program_async(request.user_query):
+                    yield json.dumps(event) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return AdmittedStreamingResponse(domains(), clients.executor("gemini"), media_type="application/x-ndjson")
+
 @app.post("/generate-habits-category")
-async def generate_habits_category(request: ProgramRequest):
+async def generate_habits_category(request: ProgramRequest, clients: ClientRegistry = Depends(get_clients)):
+    program_generator = clients.get("program_generator")
     try:
-        program_generator = ProgramGenerator()
-        habits = program_generator.generate_habits_category(request.user_query)
+        habits = None
+        if request.session_id is not None and clients.sessions is not None:
+            habits = await clients.sessions.result(request.session_id, "habits_category", request.user_query)
+        if habits is None:
+            with latency_budget(request.latency_budget_seconds):
+                habits = await clients.executor("gemini").run(
+                    program_generator.generate_habits_category, request.user_query
+                )
         return {"habits": habits}
+    except (ExecutorSaturatedError, CircuitOpenError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Chunks synthesized ahead of the one being sent, at least the next one or the stream would stop after the first
+TTS_PREFETCH = max(1, int(os.getenv("TTS_PREFETCH", 2)))
+
+@app.post("/text-to-speech")
+async def text_to_speech(request: TextToSpeechRequest, clients: ClientRegistry = Depends(get_clients)):
+    """
+    Stream compressed speech for the text, sentence chunk by sentence chunk.
+
+    The first chunk is synthesized before the response starts, so saturation is
+    still a 503; the next ones render while the previous ones are being sent.
+    Only MP3 is chunked, Ogg and WAV are sent as a single clip.
+    """
+    tts = clients.get("text_to_speech")
+    executor = clients.executor("tts")
+    voice_name = tts.voice_for(request.user_id)
+    chunks = tts.chunks(request.text, request.audio_encoding)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Nothing to synthesize")
+
+    # Without a media store (MEDIA_STORE=none) the audio is streamed
+    if request.response_format == "reference" and clients.media_store is not None:
+        try:
+            return await executor.run(tts.speech_media, request.text, request.user_id, request.audio_encoding)
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    # A cancelled chunk that is already rendering keeps its slot until it is done
+    def synthesize(chunk):
+        return executor.submit(tts.synthesize, chunk, voice_name, request.audio_encoding)
+
+    try:
+        first = await synthesize(chunks[0])
+    except ExecutorSaturatedError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def audio():
+        remaining = iter(chunks[1:])
+        pending = collections.deque()
+
+        def prefetch():
+            for chunk in itertools.islice(remaining, TTS_PREFETCH - len(pending)):
+                pending.append(synthesize(chunk))
+
+        try:
+            prefetch()
+            yield first
+            while pending:
+                chunk_audio = await pending.popleft()
+                prefetch()
+                yield chunk_audio
+        finally:
+            for future in pending:
+                future.cancel()
+
+    return StreamingResponse(
+        audio(), media_type=tts.media_type(request.audio_encoding), headers={"X-Voice": voice_name}
+    )
+
+# Media ids are content hashes, what they designate never changes
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@app.get("/media/{media_id}")
+async def get_media(media_id: str, request: Request, clients: ClientRegistry = Depends(get_clients)):
+    """
+    Serve a stored image or audio clip.
+
+    The ETag is the content hash, so a client revalidating gets a 304 without
+    the file being opened. Local files are sent by FileResponse, which answers
+    Range requests and lets the server send the file without copying it.
+    """
+    store = clients.get("media_store")
+    parsed = parse_media_id(media_id)
+    if parsed is None or not store.exists(media_id):
+        raise HTTPException(status_code=404, detail="Media not found")
+    digest, media_type = parsed
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL}
+    if_none_match = request.headers.get("If-None-Match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    path = store.path(media_id)
+    if path is not None:
+        return FileResponse(path, media_type=media_type, headers=headers)
+    return StreamingResponse(store.iter_bytes(media_id), media_type=media_type, headers=headers)
+
 @app.post("/simulate-life")
-async def simulate_life(request: SimulateLifeRequest):
+async def simulate_life(request: SimulateLifeRequest, clients: ClientRegistry = Depends(get_clients)):
+    life_simulator = clients.get("life_simulator")
     try:
-        life_simulator = LifeSimulator()
-        life_simulation = life_simulator.get_evolution_given_program(
-                request.initial_state, request.program, request.time_horizon
-        )
+        # The async engine never blocks the loop, it only needs an admission slot.
+        async with clients.executor("gemini").slot():
+            with latency_budget(request.latency_budget_seconds):
+                life_simulation = await life_simulator.get_evolution_given_program_async(
+                    request.initial_state, request.program, request.time_horizon
+                )
         return {"life_simulation": life_simulation}
+    except (ExecutorSaturatedError, CircuitOpenError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/simulate-life/stream")
+async def simulate_life_stream(request: SimulateLifeRequest, clients: ClientRegistry = Depends(get_clients)):
+    """
+    Stream the simulation as NDJSON, one {week, actions, state} line per simulated week.
+
+    With summary_tone set, a final {summary} line follows the last week.
+    """
+    life_simulator = clients.get("life_simulator")
+    # Every client is resolved before the slot is taken, an unavailable one must not leak it
+    running_summary = None
+    if request.summary_tone is not None:
+        running_summary = clients.get("state_summarizer").running_summary(request.summary_tone)
+
+    async def weeks():
+        updates = []
+        try:
+            with latency_budget(request.latency_budget_seconds):
+                async for week in life_simulator.iter_evolution_given_program_async(
+                    request.initial_state, request.program, request.time_horizon
+                ):
+                    yield json.dumps(week) + "\n"
+                    if running_summary is not None:
+                        # Fold the week into the summary while the next week is simulated.
+                        updates.append(asyncio.create_task(
+                            running_summary.update_async(week["actions"], week["state"])
+                        ))
+            if updates:
+                summary = (await asyncio.gather(*updates))[-1]
+                yield json.dumps({"summary": summary}) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            for update in updates:
+                update.cancel()
+
+    return AdmittedStreamingResponse(weeks(), clients.executor("gemini"), media_type="application/x-ndjson")
+
+@app.post("/sessions/{session_id}")
+async def start_session(session_id: str, request: SessionRequest, clients: ClientRegistry = Depends(get_clients)):
+    """
+    Start the work that does not need the program as soon as the user's description is known.
+
+    Later /generate-habits-category and /what-will-i-become requests with this
+    session_id and the same user_query reuse it.
+    """
+    started = clients.get("sessions").start(session_id, request.user_query, request.time_horizon)
+    return {"session_id": session_id, "started": started}
+
+@app.delete("/sessions/{session_id}")
+async def end_session(session_id: str, clients: ClientRegistry = Depends(get_clients)):
+    """Cancel the session's speculative work, e.g. when the user leaves."""
+    return {"session_id": session_id, "cancelled": clients.get("sessions").cancel(session_id)}
+
+@app.post("/what-will-i-become")
+async def what_will_i_become(request: FutureRequest, clients: ClientRegistry = Depends(get_clients)):
+    """
+    Run the whole pipeline for one user and stream each stage's result as NDJSON.
+
+    Lines are {stage, result, seconds} or {stage, error, skipped} in completion
+    order: program, habits/program simulations, summaries, images and audio.
+    Images and audio are media references, served by /media, unless MEDIA_STORE=none.
+    """
+    graph = build_future_pipeline(clients, request)
+
+    async def events():
+        with latency_budget(request.latency_budget_seconds):
+            async for event in graph.run():
+                yield json.dumps(event) + "\n"
+
+    return AdmittedStreamingResponse(events(), clients.executor("gemini"), media_type="application/x-ndjson")
+
+@app.post("/simulate-life/batch")
+async def simulate_life_batch(request: BatchSimulateLifeRequest, clients: ClientRegistry = Depends(get_clients)):
+    batch_simulator = clients.get("batch_simulator")
+    # The whole cohort takes one admission slot, the batch simulator's semaphore bounds its Gemini calls.
+    async with clients.executor("gemini").slot():
+        results = await batch_simulator.simulate(
+            [persona.model_dump() for persona in request.personas],
+            pack_size=request.pack_size,
+            max_concurrency=request.max_concurrency,
+        )
+    return {"results": results}
+
+@app.post("/simulate-life/ensemble")
+async def simulate_life_ensemble(request: EnsembleSimulateLifeRequest, clients: ClientRegistry = Depends(get_clients)):
+    ensemble = EnsembleSimulator(clients.get("life_simulator"))
+    try:
+        async with clients.executor("gemini").slot():
+            result = await ensemble.run(
+                request.initial_state,
+                request.program,
+                request.time_horizon,
+                max_rollouts=request.max_rollouts,
+                min_rollouts=request.min_rollouts,
+                tolerance=request.tolerance,
+            )
+        return {"ensemble": result}
+    except (ExecutorSaturatedError, CircuitOpenError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/simulate-life/preview")
+async def simulate_life_preview(request: FastSimulationRequest, clients: ClientRegistry = Depends(get_clients)):
+    """Instant, LLM-free preview of the habits and program trajectories over the discrete action space."""
+
+    def preview():
+        simulator = FastSimulator(seed=request.seed)
+        program_model = TransitionModel.towards(request.targets, adherence=request.adherence)
+        return {
+            "habits": simulator.preview(
+                request.initial_actions, request.time_horizon, TransitionModel.sticky(), request.n_personas
+            ),
+            "program": simulator.preview(
+                request.initial_actions, request.time_horizon, program_model, request.n_personas
+            ),
+        }
+
+    try:
+        # Large populations take a while in NumPy, which must not block the event loop
+        return await clients.executor("cpu").run(preview)
+    except UnknownActionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/jobs/simulate-life")
+async def submit_simulation_job(request: SimulateLifeRequest, clients: ClientRegistry = Depends(get_clients)):
+    job_id = await clients.get("jobs").submit(request.model_dump())
+    return {"job_id": job_id}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, clients: ClientRegistry = Depends(get_clients)):
+    job = await clients.get("jobs").get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, clients: ClientRegistry = Depends(get_clients)):
+    """Stream the job's weeks as NDJSON, starting with the ones already checkpointed."""
+    jobs = clients.get("jobs")
+    if not await jobs.exists(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def weeks():
+        async for event in jobs.follow(job_id):
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(weeks(), media_type="application/x-ndjson")
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str, clients: ClientRegistry = Depends(get_clients)):
+    jobs = clients.get("jobs")
+    if not await jobs.exists(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    await jobs.resume(job_id)
+    return {"job_id": job_id}
+
+@app.post("/jobs/{job_id}/extend")
+async def extend_job(job_id: str, request: ExtendJobRequest, clients: ClientRegistry = Depends(get_clients)):
+    """Raise the job's horizon, the weeks already computed are kept and only the new ones are simulated."""
+    jobs = clients.get("jobs")
+    if not await jobs.exists(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        await jobs.extend(job_id, request.time_horizon)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": job_id}
+
+@app.post("/jobs/{job_id}/branch")
+async def branch_job(job_id: str, request: BranchJobRequest, clients: ClientRegistry = Depends(get_clients)):
+    """Start a new job from the state of this one at the end of request.week, e.g. with another program."""
+    jobs = clients.get("jobs")
+    if not await jobs.exists(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        branch_id = await jobs.branch(job_id, request.week, request.program, request.time_horizon)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": branch_id, "parent_id": job_id}
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,245 @@
+"""Local stand-ins for Gemini, Replicate and Google TTS that replay recorded responses"""
+
+import asyncio
+import contextlib
+import json
+import os
+import random
+import time
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+from google.api_core import exceptions as api_exceptions
+from PIL import Image
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(__file__), "recordings", "default.json")
+FAKE_IMAGE_HOST = "https://replicate.fake/"
+
+
+class LatencyProfile:
+    """Log-normal latency around median seconds, and a share of calls failing with error."""
+
+    def __init__(self, median=1.0, sigma=0.4, error_rate=0.0, error=api_exceptions.ServiceUnavailable):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error = error
+
+    def scaled(self, time_scale):
+        return LatencyProfile(self.median * time_scale, self.sigma, self.error_rate, self.error)
+
+    def sample(self, rng=random) -> float:
+        if self.median <= 0:
+            return 0.0
+        return rng.lognormvariate(0, self.sigma) * self.median
+
+    def outcome(self, rng=random):
+        """(latency, error or None) for one call."""
+        error = None
+        if rng.random() < self.error_rate:
+            error = self.error("Injected by the fake provider")
+        return self.sample(rng), error
+
+
+PROFILES = {
+    "instant": {
+        "gemini": LatencyProfile(0),
+        "replicate": LatencyProfile(0),
+        "download": LatencyProfile(0),
+        "tts": LatencyProfile(0),
+    },
+    "realistic": {
+        "gemini": LatencyProfile(2.5, 0.4),
+        "replicate": LatencyProfile(20, 0.3),
+        "download": LatencyProfile(0.3, 0.5),
+        "tts": LatencyProfile(0.8, 0.3),
+    },
+    "degraded": {
+        "gemini": LatencyProfile(4, 0.8, error_rate=0.1),
+        "replicate": LatencyProfile(35, 0.5, error_rate=0.05),
+        "download": LatencyProfile(1, 0.8, error_rate=0.02),
+        "tts": LatencyProfile(1.5, 0.6, error_rate=0.05),
+    },
+}
+
+
+def build_profiles(name="realistic", time_scale=1.0) -> dict:
+    return {provider: profile.scaled(time_scale) for provider, profile in PROFILES[name].items()}
+
+
+def load_recordings(path=None) -> dict:
+    """{kind: [response text, ...]} with kind in actions, fused, state, summary, program, habits."""
+    with open(path or RECORDINGS_PATH) as file:
+        return json.load(file)
+
+
+def response_kind(prompt: str, system_instruction: str, generation_config: dict) -> str:
+    """Which recorded answer a prompt expects, from what the prompts of this repo ask for."""
+    system_instruction = system_instruction or ""
+    if "next_state" in json.dumps((generation_config or {}).get("response_schema", {})):
+        return "fused"
+    if "personalized program" in system_instruction:
+        return "program"
+    if "predefined categories" in system_instruction:
+        return "habits"
+    if "choose 1 and only 1 action" in prompt:
+        return "actions"
+    if "state at the end of the week" in prompt:
+        return "state"
+    return "summary"
+
+
+def fake_response(text: str, prompt: str):
+    """Object with the attributes of a Vertex GenerationResponse that the clients read."""
+    return SimpleNamespace(
+        text=text,
+        candidates=[SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))],
+        usage_metadata=SimpleNamespace(
+            prompt_token_count=len(prompt) // 4,
+            candidates_token_count=len(text) // 4,
+            cached_content_token_count=0,
+            total_token_count=(len(prompt) + len(text)) // 4,
+        ),
+    )
+
+
+class FakeGenerativeModel:
+    """GenerativeModel replaying recorded responses with the latency of a profile."""
+
+    def __init__(self, model_name, system_instruction=None, profile: LatencyProfile = None, recordings: dict = None, rng=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.profile = profile or LatencyProfile(0)
+        self.recordings = recordings or load_recordings()
+        self.rng = rng or random.Random()
+
+    def _answer(self, contents, generation_config):
+        prompt = "".join(str(part) for part in contents)
+        kind = response_kind(prompt, self.system_instruction, generation_config)
+        return prompt, self.rng.choice(self.recordings[kind])
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        latency, error = self.profile.outcome(self.rng)
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        prompt, text = self._answer(contents, generation_config)
+        return fake_response(text, prompt)
+
+    async def generate_content_async(self, contents, generation_config=None, **kwargs):
+        latency, error = self.profile.outcome(self.rng)
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        prompt, text = self._answer(contents, generation_config)
+        return fake_response(text, prompt)
+
+    def count_tokens(self, contents):
+        return SimpleNamespace(total_tokens=len(str(contents)) // 4)
+
+
+class FakeReplicateClient:
+    """replicate.Client answering every prediction with num_outputs image URLs on FAKE_IMAGE_HOST."""
+
+    def __init__(self, profile: LatencyProfile = None, num_outputs=4, **kwargs):
+        self.profile = profile or LatencyProfile(0)
+        self.num_outputs = num_outputs
+        self.models = SimpleNamespace(get=lambda name: SimpleNamespace(name=name))
+        self.files = SimpleNamespace(create=self._create_file)
+
+    def _create_file(self, file, filename=None, content_type=None):
+        return SimpleNamespace(urls={"get": FAKE_IMAGE_HOST + "files/" + (filename or "upload")})
+
+    def run(self, model, input=None):
+        latency, error = self.profile.outcome()
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return [FAKE_IMAGE_HOST + f"outputs/{i}.png" for i in range(self.num_outputs)]
+
+
+def fake_png(size=256) -> bytes:
+    buffered = BytesIO()
+    Image.new("RGB", (size, size), (120, 160, 200)).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+class FakeImageAdapter(requests.adapters.BaseAdapter):
+    """Transport adapter serving a generated PNG for every URL it is mounted on."""
+
+    def __init__(self, profile: LatencyProfile = None, size=256):
+        super().__init__()
+        self.profile = profile or LatencyProfile(0)
+        self.body = fake_png(size)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        latency, error = self.profile.outcome()
+        time.sleep(latency)
+        if error is not None:
+            raise requests.ConnectionError(str(error))
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "image/png"
+        response.raw = BytesIO(self.body)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeTextToSpeechClient:
+    """texttospeech.TextToSpeechClient returning silent audio of a plausible size."""
+
+    def __init__(self, profile: LatencyProfile = None, **kwargs):
+        self.profile = profile or LatencyProfile(0)
+
+    def synthesize_speech(self, request=None, **kwargs):
+        latency, error = self.profile.outcome()
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        text = request["input"].text if request is not None else ""
+        # About 2kB of compressed audio per second of speech, 15 characters per second
+        return SimpleNamespace(audio_content=bytes(max(len(text), 1) * 140))
+
+
+@contextlib.contextmanager
+def patch_providers(profiles: dict, recordings: dict = None):
+    """
+    Swap the provider SDKs for the fakes in every module that builds a client.
+
+    Clients must be created inside the block, e.g. by the backend's lifespan.
+    """
+    recordings = recordings or load_recordings()
+
+    def generative_model(model_name, system_instruction=None):
+        return FakeGenerativeModel(model_name, system_instruction, profiles["gemini"], recordings)
+
+    def replicate_client(*args, **kwargs):
+        return FakeReplicateClient(profiles["replicate"])
+
+    def tts_client(*args, **kwargs):
+        return FakeTextToSpeechClient(profiles["tts"])
+
+    patches = [
+        mock.patch("vertexai.init", lambda **kwargs: None),
+        mock.patch("llm.routing.GenerativeModel", generative_model),
+        mock.patch("simulate_life.simulate_life.GenerativeModel", generative_model),
+        mock.patch("summarize_states.summarize_states.GenerativeModel", generative_model),
+        mock.patch("program_creation.program_creation.GenerativeModel", generative_model),
+        mock.patch("image_generation.generate_replicate.replicate.Client", replicate_client),
+        mock.patch("google.cloud.texttospeech.TextToSpeechClient", tts_client),
+    ]
+    with contextlib.ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patch)
+        yield
+
+
+def mount_fake_downloads(image_generator, profile: LatencyProfile):
+    """Serve the fake Replicate outputs from memory instead of the network."""
+    image_generator.session.mount(FAKE_IMAGE_HOST, FakeImageAdapter(profile))
@@ -0,0 +1,220 @@
+"""
+Load test of backend.py against the fake providers.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run_load --profile realistic --time-scale 0.1 --concurrency 1 8 32 --label main
+    python -m benchmarks.run_load --label my-branch --baseline benchmarks/results/main.json
+
+The app runs in-process behind an ASGI transport, so the event-loop lag measured
+here is the lag of the server's loop. Every request is made unique so that the
+response cache does not turn the benchmark into a cache benchmark.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from benchmarks.fake_providers import build_profiles, fake_png, load_recordings, mount_fake_downloads, patch_providers
+from simulate_life.explo.input_examples import EXAMPLE_INITIAL_STATE, EXAMPLE_PROGRAM
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), "results")
+USER_QUERY = "I do not have a good hygiene of life. I do not sleep much, and because of my work I cannot sleep more than 6 hours a night. I smoke a lot of cigarettes (I cannot stop smoking). I eat a lot of processed food but I want to start eating healthy."
+
+
+def endpoints(time_horizon: int, input_images_path: str) -> dict:
+    """{name: (path, payload(i))} for the benchmarked endpoints."""
+    return {
+        "simulate-life": ("/simulate-life", lambda i: {
+            "initial_state": f"{EXAMPLE_INITIAL_STATE} (benchmark request {i})",
+            "program": EXAMPLE_PROGRAM,
+            "time_horizon": time_horizon,
+        }),
+        "generate-program": ("/generate-program", lambda i: {
+            "user_query": f"{USER_QUERY} (benchmark request {i})",
+        }),
+        "generate-habits-category": ("/generate-habits-category", lambda i: {
+            "user_query": f"{USER_QUERY} (benchmark request {i})",
+        }),
+        "generate-image": ("/generate-image", lambda i: {
+            "prompt": f"A photo of a happy and fit man img (benchmark request {i})",
+            "input_images_path": input_images_path,
+        }),
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def monitor_loop_lag(lags: list, interval=0.05):
+    """Record how late the loop wakes up a task that sleeps interval seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+async def run_level(client, path, payload, concurrency: int, total: int, first_index: int) -> dict:
+    latencies = []
+    statuses = {}
+    next_index = iter(range(first_index, first_index + total))
+    lags = []
+    monitor = asyncio.create_task(monitor_loop_lag(lags))
+
+    async def worker():
+        for i in next_index:
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, json=payload(i))
+                status = str(response.status_code)
+            except Exception as e:
+                status = type(e).__name__
+            latency = time.perf_counter() - start
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == "200":
+                latencies.append(latency)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "error_rate": round(1 - len(latencies) / total, 4),
+        "statuses": statuses,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "loop_lag_p50": percentile(lags, 50),
+        "loop_lag_p99": percentile(lags, 99),
+        "loop_lag_max": max(lags) if lags else None,
+    }
+
+
+async def run_benchmark(args) -> dict:
+    # Before the app is imported: no provider-side caching, no disk state shared with real runs
+    state_directory = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ.setdefault("REPLICATE_API_TOKEN", "fake")
+    os.environ["PROMPT_PREFIX_CACHE"] = "none"
+    os.environ["LLM_CACHE_PATH"] = ""
+    os.environ["JOBS_DB_PATH"] = os.path.join(state_directory, "jobs.sqlite3")
+    os.environ["MEDIA_ROOT"] = os.path.join(state_directory, "media")
+
+    import httpx
+    from backend import app
+
+    input_images_path = os.path.join(state_directory, "input_images")
+    os.makedirs(input_images_path)
+    with open(os.path.join(input_images_path, "reference.png"), "wb") as file:
+        file.write(fake_png(512))
+
+    profiles = build_profiles(args.profile, args.time_scale)
+    selected = endpoints(args.time_horizon, input_images_path)
+    results = []
+    with patch_providers(profiles, load_recordings(args.recordings)):
+        async with app.router.lifespan_context(app):
+            image_generator = app.state.clients.image_generator
+            if image_generator is not None:
+                mount_fake_downloads(image_generator, profiles["download"])
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+                first_index = 0
+                for name in args.endpoints:
+                    path, payload = selected[name]
+                    for concurrency in args.concurrency:
+                        level = await run_level(client, path, payload, concurrency, args.requests, first_index)
+                        first_index += args.requests
+                        results.append(dict(endpoint=name, **level))
+                        print(format_level(results[-1]))
+
+    return {
+        "label": args.label,
+        "commit": git_commit(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "profile": args.profile,
+        "time_scale": args.time_scale,
+        "time_horizon": args.time_horizon,
+        "results": results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def milliseconds(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def format_level(level: dict) -> str:
+    return (
+        f"{level['endpoint']:<26} c={level['concurrency']:<4} rps={level['rps']:<8} "
+        f"p50={milliseconds(level['latency_p50'])} p95={milliseconds(level['latency_p95'])} "
+        f"p99={milliseconds(level['latency_p99'])} errors={level['error_rate']:.1%} "
+        f"loop lag p99={milliseconds(level['loop_lag_p99'])} max={milliseconds(level['loop_lag_max'])}"
+    )
+
+
+def compare(baseline: dict, current: dict) -> list:
+    """Relative change of rps and p95 for every (endpoint, concurrency) found in both runs."""
+    previous = {(r["endpoint"], r["concurrency"]): r for r in baseline["results"]}
+    changes = []
+    for result in current["results"]:
+        before = previous.get((result["endpoint"], result["concurrency"]))
+        if before is None:
+            continue
+        change = {"endpoint": result["endpoint"], "concurrency": result["concurrency"]}
+        for metric in ("rps", "latency_p95", "loop_lag_p99"):
+            if before[metric] and result[metric] is not None:
+                change[metric] = round(result[metric] / before[metric] - 1, 4)
+        changes.append(change)
+    return changes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", nargs="+", default=["simulate-life", "generate-program", "generate-habits-category", "generate-image"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64, help="Requests per endpoint and concurrency level")
+    parser.add_argument("--profile", default="realistic", choices=["instant", "realistic", "degraded"])
+    parser.add_argument("--time-scale", type=float, default=0.1, help="Multiplier applied to every fake latency")
+    parser.add_argument("--time-horizon", type=int, default=4)
+    parser.add_argument("--recordings", default=None, help="JSON file of recorded responses per kind")
+    parser.add_argument("--label", default=None, help="Name of the results file, defaults to the commit")
+    parser.add_argument("--baseline", default=None, help="Results file to compare with")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+
+    os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+    path = os.path.join(RESULTS_DIRECTORY, f"{args.label or report['commit'] or 'results'}.json")
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {path}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            changes = compare(json.load(file), report)
+        print(json.dumps(changes, indent=2))
@@ -1,14 +1,66 @@
 import replicate
 import base64
 from dotenv import load_dotenv
+import contextvars
+import logging
 import os
 import requests
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from PIL import Image, UnidentifiedImageError
 from io import BytesIO
 from typing import List, Optional
 
+from image_generation.input_cache import ReferenceImageCache
+from llm.metrics import span, timed
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Multiple of 3 so that every chunk base64-encodes without padding.
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+DOWNLOAD_TIMEOUT = (5, 60)  # (connect, read) in seconds
+
+logger = logging.getLogger(__name__)
+
+
+def iter_png(response: requests.Response):
+    """
+    Yield a downloaded image as PNG, chunk by chunk.
+
+    PNG bodies are passed on straight from the socket, without being decoded.
+    Other formats are decoded with PIL and re-encoded to PNG.
+    """
+    chunks = response.iter_content(chunk_size=BASE64_CHUNK_SIZE)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(PNG_SIGNATURE):
+            break
+
+    if not head.startswith(PNG_SIGNATURE):
+        img = Image.open(BytesIO(head + b"".join(chunks)))
+        buffered = BytesIO()
+        img.save(buffered, format="PNG")
+        yield buffered.getvalue()
+        return
+
+    yield head
+    yield from chunks
+
+
+def encode_png_base64(response: requests.Response) -> str:
+    """Base64-encode a downloaded image as PNG, chunk by chunk."""
+    encoded = []
+    pending = b""
+    for chunk in iter_png(response):
+        pending += chunk
+        cut = len(pending) - len(pending) % 3
+        encoded.append(base64.b64encode(pending[:cut]))
+        pending = pending[cut:]
+    encoded.append(base64.b64encode(pending))
+    return b"".join(encoded).decode()
+
 class ImageGenerator:
-    def __init__(self, env_file: str = 'conf.env'):
+    def __init__(self, env_file: str = 'conf.env', media_store=None):
         # Load the environment variables
         load_dotenv(env_file)
         
@@ -18,11 +70,22 @@ class ImageGenerator:
         # Initialize the Replicate client with a longer timeout
         self.client = replicate.Client(api_token=os.environ["REPLICATE_API_TOKEN"], timeout=300)  # 5 minutes timeout
 
-    def generate_image(self, 
-                       prompt: str, 
-                       input_images_path: str,
-                       num_steps: int = 50, 
-                       negative_prompt: Optional[str] = None) -> List[str]:
+        # Keep-alive session reused for every output download
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+        # Preprocessed (and when possible uploaded) reference photos
+        self.reference_images = ReferenceImageCache(self.client)
+
+        # Optional MediaStore, generate_image_media writes the outputs there instead of returning them
+        self.media_store = media_store
+
+    def run_model(self,
+                  prompt: str,
+                  input_images_path: str,
+                  num_steps: int = 50,
+                  negative_prompt: Optional[str] = None) -> list:
+        """URLs of the images generated by PhotoMaker."""
         # Prepare input dictionary
         input_data = {
             "prompt": prompt,
@@ -34,40 +97,76 @@ class ImageGenerator:
         else:
             input_data["negative_prompt"] = "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
 
-        # Get the first 4 images from the input directory
-        input_images = [os.path.join(input_images_path, f) for f in os.listdir(input_images_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))][:4]
+        # Get the first 4 images from the input directory, ready to send
+        with span("image.inputs"):
+            input_images = self.reference_images.get_inputs(input_images_path)
 
         # Add images to input dictionary (up to 4)
-        for i, image_path in enumerate(input_images, start=1):
-            with open(image_path, 'rb') as file:
-                data = base64.b64encode(file.read()).decode('utf-8')
-                image = f"data:application/octet-stream;base64,{data}"
-                input_data[f"input_image{'' if i == 1 else i}"] = image
+        for i, image in enumerate(input_images, start=1):
+            input_data[f"input_image{'' if i == 1 else i}"] = image
 
         # Run the model
-        output = self.client.run(
-            "tencentarc/photomaker:ddfc2b08d209f9fa8c1eca692712918bd449f695dabb4a958da31802a9570fe4",
-            input=input_data
-        )
+        with span("image.generate"):
+            return self.client.run(
+                "tencentarc/photomaker:ddfc2b08d209f9fa8c1eca692712918bd449f695dabb4a958da31802a9570fe4",
+                input=input_data
+            )
+
+    def download_all(self, output, handle) -> list:
+        """Download every output image at once, handle(response) turns each one into a result."""
+        # Each download runs in a copy of the caller's context, so its span counts for this request
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, self.download_image, image_url, handle)
+                for image_url in output
+            ]
+            results = [future.result() for future in futures]
+        return [result for result in results if result is not None]
 
-        base64_images = []
-
-        # Download and convert each output image to base64
-        for image_url in output:
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                img = Image.open(BytesIO(response.content))
-                buffered = BytesIO()
-                img.save(buffered, format="PNG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
-                base64_images.append(img_str)
-                print(f"Processed image to base64")
-            else:
-                print(f"Failed to download image")
-
-        print("All images have been processed to base64.")
+    def generate_image(self, 
+                       prompt: str, 
+                       input_images_path: str,
+                       num_steps: int = 50, 
+                       negative_prompt: Optional[str] = None) -> List[str]:
+        output = self.run_model(prompt, input_images_path, num_steps, negative_prompt)
+        base64_images = self.download_all(output, encode_png_base64)
+        logger.info("Encoded %d images to base64", len(base64_images))
         return base64_images
 
+    def generate_image_media(self,
+                             prompt: str,
+                             input_images_path: str,
+                             num_steps: int = 50,
+                             negative_prompt: Optional[str] = None) -> List[dict]:
+        """
+        Same as generate_image, but each image is streamed from Replicate into the
+        media store and only its reference is returned.
+        """
+        if self.media_store is None:
+            raise RuntimeError("generate_image_media needs a media_store")
+        output = self.run_model(prompt, input_images_path, num_steps, negative_prompt)
+        return self.download_all(
+            output, lambda response: self.media_store.put_stream(iter_png(response), "image/png")
+        )
+
+    @timed("image.download")
+    def download_image(self, image_url, handle):
+        try:
+            with self.session.get(str(image_url), stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 200:
+                    logger.warning("Failed to download image %s: HTTP %d", image_url, response.status_code)
+                    return None
+                result = handle(response)
+        except requests.RequestException as e:
+            logger.warning("Failed to download image %s: %s", image_url, e)
+            return None
+        # A truncated or undecodable image is skipped, the other outputs of the run are still returned
+        except (UnidentifiedImageError, OSError) as e:
+            logger.warning("Failed to decode image %s: %s", image_url, e)
+            return None
+        logger.debug("Processed image %s", image_url)
+        return result
+
 # Example usage:
 if __name__ == "__main__":
   generator = ImageGenerator("../conf.env")
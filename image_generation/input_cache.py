@@ -0,0 +1,120 @@
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import List
+
+from PIL import Image, ImageOps
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MAX_INPUT_IMAGES = 4
+# PhotoMaker works at 1024x1024, anything bigger is only upload time
+TARGET_SIZE = 1024
+JPEG_QUALITY = 90
+# Replicate deletes uploaded files after a day, re-upload a bit before that
+UPLOAD_TTL_SECONDS = 23 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+def preprocess_image(data: bytes) -> bytes:
+    """Center-crop to a square, downscale to TARGET_SIZE and compress to JPEG."""
+    img = ImageOps.exif_transpose(Image.open(BytesIO(data))).convert("RGB")
+    side = min(img.size)
+    img = ImageOps.fit(img, (side, side), method=Image.LANCZOS)
+    if side > TARGET_SIZE:
+        img = img.resize((TARGET_SIZE, TARGET_SIZE), Image.LANCZOS)
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buffered.getvalue()
+
+
+class ReferenceImageCache:
+    """
+    Ready-to-send reference photos for PhotoMaker.
+
+    Files are identified by path, mtime and size; when those change the content is
+    hashed again, and the preprocessed image is cached per content hash, so a photo
+    that did not change is never read, resized or encoded twice. When the client
+    supports file uploads each image is uploaded once and referenced by URL.
+    """
+
+    def __init__(self, client=None, max_entries=256):
+        self.client = client
+        self.max_entries = max_entries
+        # Every edit of a file adds a key, so both maps are LRU-bounded by max_entries
+        self.hashes = OrderedDict()
+        self.prepared = OrderedDict()
+        self.lock = threading.Lock()
+
+    def list_images(self, input_images_path: str) -> List[str]:
+        # Sorted so that the same directory always gives the same inputs in the same order
+        names = sorted(f for f in os.listdir(input_images_path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        return [os.path.join(input_images_path, name) for name in names[:MAX_INPUT_IMAGES]]
+
+    def get_inputs(self, input_images_path: str) -> List[str]:
+        return [self.get_input(path) for path in self.list_images(input_images_path)]
+
+    def get_input(self, image_path: str) -> str:
+        content_hash = self._content_hash(image_path)
+        with self.lock:
+            entry = self.prepared.get(content_hash)
+            if entry is not None:
+                self.prepared.move_to_end(content_hash)
+        if entry is None or self._expired(entry):
+            entry = self._prepare(image_path, content_hash, entry)
+        return entry["url"] or entry["data_uri"]
+
+    def _content_hash(self, image_path: str) -> str:
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            content_hash = self.hashes.get(key)
+            if content_hash is not None:
+                self.hashes.move_to_end(key)
+        if content_hash is None:
+            with open(image_path, 'rb') as file:
+                content_hash = hashlib.sha256(file.read()).hexdigest()
+            with self.lock:
+                self.hashes[key] = content_hash
+                while len(self.hashes) > self.max_entries:
+                    self.hashes.popitem(last=False)
+        return content_hash
+
+    @staticmethod
+    def _expired(entry) -> bool:
+        return entry["url"] is not None and time.time() - entry["uploaded_at"] > UPLOAD_TTL_SECONDS
+
+    def _prepare(self, image_path: str, content_hash: str, entry=None) -> dict:
+        if entry is None:
+            with open(image_path, 'rb') as file:
+                data = preprocess_image(file.read())
+            entry = {
+                "data": data,
+                "data_uri": f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}",
+                "url": None,
+                "uploaded_at": None,
+            }
+        entry["url"] = self._upload(entry["data"], content_hash)
+        entry["uploaded_at"] = time.time()
+        with self.lock:
+            self.prepared[content_hash] = entry
+            while len(self.prepared) > self.max_entries:
+                self.prepared.popitem(last=False)
+        return entry
+
+    def _upload(self, data: bytes, content_hash: str):
+        files = getattr(self.client, "files", None)
+        if files is None:
+            return None
+        try:
+            uploaded = files.create(BytesIO(data), filename=f"{content_hash}.jpg", content_type="image/jpeg")
+            return uploaded.urls["get"]
+        except Exception as e:
+            # Inline data URIs still work, they are only bigger
+            logger.warning("Failed to upload reference image %s: %s", content_hash, e)
+            return None
@@ -0,0 +1,254 @@
+"""Content-addressed cache for LLM responses"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Result of an in-flight computation whose caller was cancelled, waiters compute it again
+_LEADER_CANCELLED = object()
+
+
+class ResponseCache:
+    """
+    Two-tier cache of generated texts keyed on everything that determines the output.
+
+    The first tier is a bounded in-memory LRU, the second an optional SQLite file
+    shared by every worker on the machine. Entries older than ttl_seconds are
+    ignored in both tiers. Identical calls that are in flight at the same time
+    are coalesced so the model is only called once.
+
+    Expired rows are deleted from the file when it is opened and every
+    purge_every writes, which also trim it to its max_disk_entries newest rows.
+    """
+
+    def __init__(
+        self, max_entries=1024, path=None, ttl_seconds=7 * 24 * 3600, max_disk_entries=100_000, purge_every=1000
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.purge_every = purge_every
+        self.writes = 0
+        self.memory = OrderedDict()
+        # Memory tier and stats, never held during a SQLite call so the event loop never waits on disk
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.in_flight = {}
+        self.in_flight_async = {}
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "purged": 0}
+
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created_at REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            self.db.commit()
+            self.purge()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024)),
+            path=os.getenv("LLM_CACHE_PATH", "cache/llm_responses.sqlite3") or None,
+            ttl_seconds=int(os.getenv("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+            max_disk_entries=int(os.getenv("LLM_CACHE_MAX_DISK_ENTRIES", 100_000)),
+        )
+
+    @staticmethod
+    def make_key(model_name, system_instruction, prompt, generation_config) -> str:
+        payload = json.dumps(
+            [model_name, system_instruction, prompt, generation_config], sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_memory(self, key):
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                value, created_at = self.memory[key]
+                if now - created_at < self.ttl_seconds:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self.memory[key]
+        return None
+
+    def get_disk(self, key):
+        if self.db is None:
+            return None
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] >= self.ttl_seconds:
+            return None
+        with self.lock:
+            self._remember(key, row[0], row[1])
+            self.stats["disk_hits"] += 1
+        return row[0]
+
+    def get(self, key):
+        value = self.get_memory(key)
+        if value is None:
+            value = self.get_disk(key)
+        return value
+
+    async def get_async(self, key):
+        """Same as get, the SQLite read runs off the event loop."""
+        value = self.get_memory(key)
+        if value is None and self.db is not None:
+            value = await asyncio.to_thread(self.get_disk, key)
+        return value
+
+    def set_memory(self, key, value, created_at):
+        with self.lock:
+            self._remember(key, value, created_at)
+
+    def set_disk(self, key, value, created_at):
+        if self.db is None:
+            return
+        with self.db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, created_at),
+            )
+            self.db.commit()
+            self.writes += 1
+            purge = self.writes % self.purge_every == 0
+        if purge:
+            self.purge()
+
+    def purge(self):
+        """Delete the expired rows, then the oldest ones beyond max_disk_entries. Blocking, keep it off the event loop."""
+        with self.db_lock:
+            expired = self.db.execute(
+                "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            ).rowcount
+            trimmed = self.db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            ).rowcount
+            self.db.commit()
+        with self.lock:
+            self.stats["purged"] += expired + trimmed
+
+    def set(self, key, value):
+        created_at = time.time()
+        self.set_memory(key, value, created_at)
+        self.set_disk(key, value, created_at)
+
+    async def set_async(self, key, value):
+        """Same as set, the SQLite write and commit run off the event loop."""
+        created_at = time.time()
+        self.set_memory(key, value, created_at)
+        if self.db is not None:
+            await asyncio.to_thread(self.set_disk, key, value, created_at)
+
+    def _remember(self, key, value, created_at):
+        self.memory[key] = (value, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for key, or call compute() once and cache its result.
+
+        Threads asking for a key that is already being computed wait for that
+        computation instead of starting their own.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            waiter = self.in_flight.get(key)
+            if waiter is None:
+                waiter = {"event": threading.Event(), "value": None, "error": None}
+                self.in_flight[key] = waiter
+                leader = True
+            else:
+                self.stats["coalesced"] += 1
+                leader = False
+
+        if not leader:
+            waiter["event"].wait()
+            if waiter["error"] is not None:
+                raise waiter["error"]
+            return waiter["value"]
+
+        try:
+            with self.lock:
+                self.stats["misses"] += 1
+            waiter["value"] = compute()
+            self.set(key, waiter["value"])
+            return waiter["value"]
+        except Exception as e:
+            waiter["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            waiter["event"].set()
+
+    async def get_or_compute_async(self, key, compute):
+        """
+        Async version of get_or_compute, compute is a coroutine function.
+
+        When the caller computing the value is cancelled, the callers waiting for
+        it are not: they start over, and one of them computes the value.
+        """
+        value = await self.get_async(key)
+        if value is not None:
+            return value
+
+        future = self.in_flight_async.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            value = await asyncio.shield(future)
+            if value is _LEADER_CANCELLED:
+                return await self.get_or_compute_async(key, compute)
+            return value
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight_async[key] = future
+        try:
+            with self.lock:
+                self.stats["misses"] += 1
+            value = await compute()
+            future.set_result(value)
+            await self.set_async(key, value)
+            return value
+        except asyncio.CancelledError:
+            if not future.done():
+                future.set_result(_LEADER_CANCELLED)
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+                # Mark the exception as retrieved when nobody else was waiting on it.
+                future.exception()
+            raise
+        finally:
+            if self.in_flight_async.get(key) is future:
+                del self.in_flight_async[key]
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        )
+        return stats
@@ -0,0 +1,200 @@
+"""Timing spans, token accounting and Prometheus text exposition"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import threading
+import time
+
+# Seconds, from a parse of a few hundred microseconds to a slow image generation
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Breakdown of the current request, set by request_timings()
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def format_labels(labelnames, values, extra=()) -> str:
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = format_labels(self.labelnames, key, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = format_labels(self.labelnames, key, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "stage_duration_seconds", "Time spent in each instrumented stage.", ["stage"]
+))
+LLM_CALLS = REGISTRY.register(Counter(
+    "llm_calls_total", "Model calls that returned a response.", ["model", "stage"]
+))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "llm_tokens_total", "Tokens reported by the usage metadata of the responses.", ["model", "stage", "kind"]
+))
+HTTP_SECONDS = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Time to produce the response of an HTTP request.", ["method", "path", "status"]
+))
+
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = None
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Time the block into the stage histogram and the current request's breakdown."""
+    timing = Span(stage)
+    start = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.seconds = time.perf_counter() - start
+        record_span(stage, timing.seconds)
+
+
+def record_span(stage, seconds):
+    """Record a duration measured without span, e.g. summed over the chunks of a stream."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        with timings["lock"]:
+            stage_timing = timings["stages"].setdefault(stage, {"seconds": 0.0, "count": 0})
+            stage_timing["seconds"] += seconds
+            stage_timing["count"] += 1
+
+
+def timed(stage):
+    """Decorator version of span, for sync and async functions."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_usage(model_name, stage, response):
+    """Count a model response and its tokens from usage_metadata, when the response has one."""
+    LLM_CALLS.inc(model=model_name, stage=stage)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    tokens = {
+        "prompt": getattr(usage, "prompt_token_count", 0) or 0,
+        "output": getattr(usage, "candidates_token_count", 0) or 0,
+        "cached": getattr(usage, "cached_content_token_count", 0) or 0,
+    }
+    for kind, count in tokens.items():
+        if count:
+            LLM_TOKENS.inc(count, model=model_name, stage=stage, kind=kind)
+    timings = _request_timings.get()
+    if timings is not None:
+        with timings["lock"]:
+            for kind, count in tokens.items():
+                timings["tokens"][kind] = timings["tokens"].get(kind, 0) + count
+
+
+@contextlib.contextmanager
+def request_timings():
+    """Collect the spans and tokens of everything run inside the block, including tasks and threads it starts."""
+    timings = {"stages": {}, "tokens": {}, "lock": threading.Lock()}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing_header(timings) -> str:
+    """Server-Timing header value, one metric per stage with its total duration in milliseconds."""
+    with timings["lock"]:
+        stages = sorted(timings["stages"].items())
+    return ", ".join(
+        f'{stage.replace(".", "_")};dur={value["seconds"] * 1000:.1f};desc="{value["count"]} calls"'
+        for stage, value in stages
+    )
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,180 @@
+"""Parsing, local repair and validation of JSON produced by the models"""
+
+import ast
+import json
+import re
+
+from llm.metrics import timed
+
+NO_INFORMATION = "I do not have any information on that category"
+
+
+class OutputParsingError(ValueError):
+    """Raised when a model output cannot be turned into the expected JSON, even after repair."""
+
+
+def extract_braces(text: str) -> str:
+    start_index = text.find("{")
+    end_index = text.rfind("}")
+    if start_index == -1:
+        # The actions prompt historically asked for "category": 'action' pairs without braces
+        return "{" + text.strip().strip(",") + "}"
+    if end_index < start_index:
+        # Truncated output, close the object
+        body = text[start_index:].rstrip().rstrip(",")
+        if body.count('"') % 2:
+            body += '"'
+        return body + "}"
+    return text[start_index : end_index + 1]
+
+
+def candidates(text: str):
+    """Successively more aggressive repairs of a near-JSON object."""
+    text = re.sub(r"^```(?:json)?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+    extracted = extract_braces(text)
+    yield extracted
+    # Trailing commas before a closing brace or bracket
+    without_trailing_commas = re.sub(r",\s*([}\]])", r"\1", extracted)
+    yield without_trailing_commas
+    # Escaped JSON, e.g. the repr of a response part
+    if '\\"' in extracted:
+        yield extract_braces(unescape(extracted))
+
+
+def unescape(text: str) -> str:
+    unescaped = text.encode("utf-8").decode("unicode_escape")
+    try:
+        # Octal-escaped UTF-8 bytes come out as latin-1 characters, put them back together
+        return unescaped.encode("latin-1").decode("utf-8")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return unescaped
+
+
+@timed("parse.json")
+def parse_json_object(text: str) -> dict:
+    """
+    Parse the JSON object contained in a model output, repairing it locally if needed.
+
+    Handles surrounding prose, code fences, trailing commas, single-quoted
+    (Python literal) objects, escaped JSON and missing closing braces.
+    """
+    for candidate in candidates(text):
+        try:
+            value = json.loads(candidate)
+        except json.JSONDecodeError:
+            try:
+                value = ast.literal_eval(candidate)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                continue
+        if isinstance(value, dict):
+            return value
+    raise OutputParsingError(f"No valid JSON object in model output: {text[:200]!r}")
+
+
+class IncrementalObjectParser:
+    """
+    Parse a JSON object while its text is streamed in.
+
+    feed() returns the (key, value) members of the top-level object whose value
+    was completed by the new text: a nested object or array as soon as it is
+    closed, a scalar at the next comma or closing brace. Text before the opening
+    brace, such as a code fence, is skipped. A member that is not valid JSON is
+    not returned, the caller still parses the whole text with parse_json_object.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.member_start = None
+        self.done = False
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        members = []
+        for i in range(self.position, len(self.text)):
+            if self.done:
+                break
+            char = self.text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                # Quotes in the prose before the object do not open strings
+                self.in_string = self.depth > 0
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.member_start = i + 1
+            elif char in "}]" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 1:
+                    members += self._member(i + 1)
+                elif self.depth == 0:
+                    members += self._member(i)
+                    self.done = True
+            elif char == "," and self.depth == 1:
+                members += self._member(i)
+                self.member_start = i + 1
+        self.position = len(self.text)
+        return members
+
+    def _member(self, end) -> list:
+        if self.member_start is None:
+            return []
+        member = self.text[self.member_start:end].strip()
+        self.member_start = None
+        if not member:
+            return []
+        try:
+            return list(json.loads("{" + member + "}").items())
+        except json.JSONDecodeError:
+            return []
+
+
+def validate_actions(actions: dict, categories: list) -> dict:
+    """
+    Check an actions dict against the known categories.
+
+    Keys are matched case-insensitively, unknown keys are dropped, values are
+    turned into strings and missing categories get the "no information" answer
+    the prompts already ask for. An object with none of the categories is rejected.
+    """
+    by_name = {category.lower(): category for category in categories}
+    validated = {}
+    for key, value in actions.items():
+        category = by_name.get(str(key).strip().lower())
+        if category is not None:
+            validated[category] = value if isinstance(value, str) else json.dumps(value)
+    if not validated:
+        raise OutputParsingError(f"None of the categories {categories} in {list(actions)}")
+    return {category: validated.get(category, NO_INFORMATION) for category in categories}
+
+
+def validate_fused_step(step: dict, categories: list) -> tuple:
+    if not isinstance(step.get("actions"), dict) or not isinstance(step.get("next_state"), str):
+        raise OutputParsingError(f"Expected actions and next_state, got {list(step)}")
+    return validate_actions(step["actions"], categories), step["next_state"]
+
+
+def validate_program(program: dict) -> dict:
+    """A program maps each domain to a {action: description} dict."""
+    if not program or not all(
+        isinstance(actions, dict) and all(isinstance(d, str) for d in actions.values())
+        for actions in program.values()
+    ):
+        raise OutputParsingError("Expected {domain: {action: description}}")
+    return program
+
+
+def validate_habits(habits: dict) -> dict:
+    """Habits map each category to the extracted text."""
+    if not habits or not all(isinstance(text, str) for text in habits.values()):
+        raise OutputParsingError("Expected {category: text}")
+    return habits
@@ -0,0 +1,173 @@
+"""Register static prompt prefixes once and send only the per-call delta"""
+
+import abc
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from vertexai.preview import caching
+from vertexai.preview.generative_models import GenerativeModel
+
+# Vertex only caches contents of at least this many tokens
+VERTEX_MIN_TOKENS = 32768
+# Rough token estimate, good enough to skip registrations Vertex would reject
+CHARS_PER_TOKEN = 4
+
+logger = logging.getLogger(__name__)
+
+
+def prefix_key(model_name, system_instruction, prefix) -> str:
+    payload = "\x00".join([model_name, system_instruction or "", prefix or ""])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PromptPrefixCache(abc.ABC):
+    """
+    Base class for prefix caches, subclasses implement register.
+
+    model_for returns a model that already holds the system instruction and the
+    prefix, so callers only send what changes from one call to the next, or None
+    when the prefix could not be registered and the full prompt must be sent.
+
+    Prefixes embed the program, so entries are kept in an LRU of max_entries.
+    Registration is a network call: it runs outside the cache lock, and only
+    once per prefix however many callers ask for it at the same time.
+    """
+
+    def __init__(self, ttl_seconds=3600, max_entries=256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.registering = {}
+        self.lock = threading.Lock()
+        self.stats = {"registrations": 0, "hits": 0, "skipped": 0, "evictions": 0, "failures": 0}
+
+    def _lookup(self, key):
+        """Must be called with the lock held, returns the fresh entry of key or None."""
+        entry = self.entries.get(key)
+        # Renew a bit before the provider expires the cached content
+        if entry is None or time.time() - entry["created_at"] >= self.ttl_seconds * 0.9:
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits" if entry["model"] is not None else "skipped"] += 1
+        return entry
+
+    def cached(self, model_name, system_instruction, prefix=None):
+        """(found, model) without registering, cheap enough to be called from the event loop."""
+        with self.lock:
+            entry = self._lookup(prefix_key(model_name, system_instruction, prefix))
+        return (False, None) if entry is None else (True, entry["model"])
+
+    def model_for(self, model_name, system_instruction, prefix=None):
+        key = prefix_key(model_name, system_instruction, prefix)
+        with self.lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry["model"]
+            registering = self.registering.setdefault(key, threading.Lock())
+
+        with registering:
+            with self.lock:
+                # Registered by another caller while this one waited
+                entry = self._lookup(key)
+            if entry is not None:
+                return entry["model"]
+            try:
+                model = self.register(model_name, system_instruction, prefix)
+            except BaseException:
+                with self.lock:
+                    self.registering.pop(key, None)
+                raise
+            with self.lock:
+                self.entries[key] = {"model": model, "created_at": time.time()}
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+                self.stats["registrations" if model is not None else "skipped"] += 1
+                self.registering.pop(key, None)
+            return model
+
+    @abc.abstractmethod
+    def register(self, model_name, system_instruction, prefix):
+        """Model holding the system instruction and the prefix, or None to send full prompts."""
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries))
+
+
+class VertexPromptPrefixCache(PromptPrefixCache):
+    """Prefixes stored as Vertex AI cached contents."""
+
+    def __init__(self, ttl_seconds=3600, min_tokens=VERTEX_MIN_TOKENS, max_entries=256):
+        super().__init__(ttl_seconds, max_entries)
+        self.min_tokens = min_tokens
+
+    def register(self, model_name, system_instruction, prefix):
+        size = len(system_instruction or "") + len(prefix or "")
+        if size / CHARS_PER_TOKEN < self.min_tokens:
+            return None
+        try:
+            cached_content = caching.CachedContent.create(
+                model_name=model_name,
+                system_instruction=system_instruction,
+                contents=[prefix] if prefix else None,
+                ttl=datetime.timedelta(seconds=self.ttl_seconds),
+            )
+            return GenerativeModel.from_cached_content(cached_content=cached_content)
+        except Exception:
+            logger.exception("Failed to cache the prompt prefix for %s", model_name)
+            with self.lock:
+                self.stats["failures"] += 1
+            return None
+
+
+class PrefixedModel:
+    """Model stand-in that prepends a prefix locally, with the GenerativeModel call signatures."""
+
+    def __init__(self, model, prefix):
+        self.model = model
+        self.prefix = prefix or ""
+
+    def generate_content(self, contents, **kwargs):
+        return self.model.generate_content([self.prefix + contents[0]] + contents[1:], **kwargs)
+
+    async def generate_content_async(self, contents, **kwargs):
+        return await self.model.generate_content_async(
+            [self.prefix + contents[0]] + contents[1:], **kwargs
+        )
+
+
+class LocalPromptPrefixCache(PromptPrefixCache):
+    """
+    Provider-free prefix cache for tests and local runs.
+
+    It does not save any token, but goes through the same registration and
+    delta-only calls as the Vertex cache.
+    """
+
+    def __init__(self, ttl_seconds=3600, model_factory=GenerativeModel, max_entries=256):
+        super().__init__(ttl_seconds, max_entries)
+        self.model_factory = model_factory
+
+    def register(self, model_name, system_instruction, prefix):
+        return PrefixedModel(
+            self.model_factory(model_name, system_instruction=system_instruction), prefix
+        )
+
+
+def build_prefix_cache(kind=None):
+    # Off by default: no current prompt reaches VERTEX_MIN_TOKENS, the cache would only add a thread hop per call
+    kind = kind or os.getenv("PROMPT_PREFIX_CACHE", "none")
+    ttl_seconds = int(os.getenv("PROMPT_PREFIX_CACHE_TTL_SECONDS", 3600))
+    max_entries = int(os.getenv("PROMPT_PREFIX_CACHE_MAX_ENTRIES", 256))
+    if kind == "vertex":
+        return VertexPromptPrefixCache(ttl_seconds, max_entries=max_entries)
+    if kind == "local":
+        return LocalPromptPrefixCache(ttl_seconds, max_entries=max_entries)
+    return None
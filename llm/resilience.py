@@ -0,0 +1,449 @@
+"""Deadlines, retries, hedging and circuit breaking around model calls"""
+
+import asyncio
+import concurrent.futures
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from google.api_core import exceptions as api_exceptions
+
+# Provider errors worth another attempt, anything else (bad request, parsing) fails at once
+RETRYABLE_ERRORS = (
+    TimeoutError,
+    ConnectionError,
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+)
+# Per-attempt timeouts of the stages that generate much more than a week of simulation
+STAGE_TIMEOUTS = {
+    "program": 120.0,
+    "habits": 60.0,
+}
+DEFAULT_STAGE = "default"
+
+
+def parse_timeouts(text) -> dict:
+    """'program=120,habits=60' -> {"program": 120.0, "habits": 60.0}"""
+    timeouts = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            stage, seconds = item.split("=", 1)
+            timeouts[stage.strip()] = float(seconds)
+    return timeouts
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the provider while the circuit breaker is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is failing, calls are suspended for {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a share of the calls.
+
+    Each first attempt deposits ratio tokens and each retry withdraws one, so
+    during an outage retries add at most ratio extra load instead of
+    multiplying it by the number of attempts.
+    """
+
+    def __init__(self, ratio=0.2, min_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max(min_tokens, 1)
+        self.tokens = float(self.max_tokens)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LatencyTracker:
+    """Sliding window of successful call latencies."""
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q, min_samples=20):
+        """q-th percentile in seconds, None until enough calls have been seen."""
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class CircuitBreaker:
+    """
+    Closed until failure_threshold consecutive failures, then open for reset_timeout.
+
+    Once the timeout is over a single trial call is let through (half-open):
+    it closes the circuit if it succeeds and reopens it otherwise. A trial that
+    ends any other way, e.g. cancelled, leaves the next call free to be the trial.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return "open"
+            return "half_open"
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpenError while open, returns True when this call is the half-open trial."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self.trial_in_flight:
+                raise CircuitOpenError(self.name, max(remaining, 1))
+            self.trial_in_flight = True
+            return True
+
+    def end_trial(self):
+        with self.lock:
+            self.trial_in_flight = False
+
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+
+class ResilientCaller:
+    """
+    Wraps one provider's calls with a deadline, retries, hedging and a circuit breaker.
+
+    - Every attempt gets timeout seconds, the whole call deadline seconds. Stages
+      listed in stage_timeouts get their own timeout, and a deadline scaled by the
+      same factor.
+    - Retryable errors are retried with full-jitter exponential backoff, as long as
+      the shared RetryBudget allows it.
+    - Once hedge_percentile of the recent latencies of the stage is known, an
+      attempt still running after that long gets a duplicate and the first answer wins.
+    - Consecutive failures open the circuit breaker, calls then fail fast with
+      CircuitOpenError until the provider recovers.
+
+    A single instance is meant to be shared by every client of the same provider,
+    so that budget, latencies and breaker reflect the provider as a whole.
+    """
+
+    def __init__(
+        self,
+        name="gemini",
+        timeout=30.0,
+        deadline=90.0,
+        max_attempts=3,
+        base_delay=0.5,
+        max_delay=8.0,
+        hedge_percentile=95,
+        max_hedges=1,
+        retry_budget: RetryBudget = None,
+        breaker: CircuitBreaker = None,
+        retryable=RETRYABLE_ERRORS,
+        stage_timeouts=None,
+        max_workers=16,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # None disables hedging
+        self.hedge_percentile = hedge_percentile
+        self.max_hedges = max_hedges
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker(name)
+        self.retryable = retryable
+        self.stage_timeouts = dict(STAGE_TIMEOUTS, **(stage_timeouts or {}))
+        # Stages generate very different lengths, each one hedges on its own latencies
+        self.latencies = {}
+        self.latencies_lock = threading.Lock()
+        # Threads for the sync path: one attempt and its hedges for each thread of the
+        # executor calling us, so no attempt waits for a thread while its timeout runs.
+        # A timed-out attempt keeps its thread until it returns.
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers * (1 + max_hedges), thread_name_prefix=f"{name}-call"
+        )
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "timeouts": 0, "rejected": 0}
+        self.stats_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name="gemini"):
+        prefix = name.upper()
+        hedge_percentile = os.getenv(f"{prefix}_HEDGE_PERCENTILE", "95")
+        return cls(
+            name,
+            timeout=float(os.getenv(f"{prefix}_TIMEOUT_SECONDS", 30)),
+            deadline=float(os.getenv(f"{prefix}_DEADLINE_SECONDS", 90)),
+            max_attempts=int(os.getenv(f"{prefix}_MAX_ATTEMPTS", 3)),
+            hedge_percentile=float(hedge_percentile) if hedge_percentile else None,
+            retry_budget=RetryBudget(float(os.getenv(f"{prefix}_RETRY_BUDGET_RATIO", 0.2))),
+            breaker=CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv(f"{prefix}_BREAKER_FAILURES", 5)),
+                reset_timeout=float(os.getenv(f"{prefix}_BREAKER_RESET_SECONDS", 30)),
+            ),
+            stage_timeouts=parse_timeouts(os.getenv(f"{prefix}_STAGE_TIMEOUTS")),
+            # Same variable as the size of the executor the calls come from
+            max_workers=int(os.getenv(f"{prefix}_MAX_WORKERS", 16)),
+        )
+
+    def count(self, stat, n=1):
+        with self.stats_lock:
+            self.stats[stat] += n
+
+    def latency_tracker(self, stage) -> LatencyTracker:
+        with self.latencies_lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = LatencyTracker()
+            return self.latencies[stage]
+
+    def timeout_for(self, stage) -> float:
+        return self.stage_timeouts.get(stage, self.timeout)
+
+    def deadline_for(self, stage) -> float:
+        return self.deadline * self.timeout_for(stage) / self.timeout
+
+    def hedge_delay(self, stage):
+        if self.hedge_percentile is None or self.max_hedges < 1:
+            return None
+        return self.latency_tracker(stage).percentile(self.hedge_percentile)
+
+    def backoff(self, attempt, remaining):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, max(remaining, 0))
+
+    def should_retry(self, error, attempt, remaining) -> bool:
+        if not isinstance(error, self.retryable) or attempt + 1 >= self.max_attempts:
+            return False
+        if remaining <= 0:
+            return False
+        if not self.retry_budget.withdraw():
+            self.count("rejected")
+            return False
+        self.count("retries")
+        return True
+
+    def on_error(self, error):
+        if isinstance(error, self.retryable):
+            self.breaker.on_failure()
+        else:
+            # The provider answered, a rejected request says nothing against its health
+            self.breaker.on_success()
+
+    def call(self, fn, *args, stage=DEFAULT_STAGE, **kwargs):
+        """Run the blocking fn(*args, **kwargs) with the resilience policies of stage."""
+        trial = self.breaker.before_call()
+        try:
+            self.count("calls")
+            self.retry_budget.deposit()
+            timeout, deadline = self.timeout_for(stage), self.deadline_for(stage)
+            start = time.monotonic()
+            attempt = 0
+            while True:
+                remaining = deadline - (time.monotonic() - start)
+                try:
+                    result = self._attempt(fn, args, kwargs, min(timeout, remaining), stage)
+                except Exception as e:
+                    remaining = deadline - (time.monotonic() - start)
+                    if not self.should_retry(e, attempt, remaining):
+                        self.on_error(e)
+                        raise
+                    time.sleep(self.backoff(attempt, remaining))
+                    attempt += 1
+                    continue
+                self.breaker.on_success()
+                return result
+        finally:
+            if trial:
+                self.breaker.end_trial()
+
+    def _attempt(self, fn, args, kwargs, timeout, stage):
+        started = time.monotonic()
+        first = self.pool.submit(fn, *args, **kwargs)
+        futures = {first}
+        hedges = 0
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= timeout:
+                self.count("timeouts")
+                raise TimeoutError(f"{self.name} call took more than {timeout:.1f}s")
+            wait = timeout - elapsed
+            hedge_delay = self.hedge_delay(stage)
+            can_hedge = hedge_delay is not None and hedges < self.max_hedges
+            if can_hedge:
+                wait = min(wait, max(hedge_delay - elapsed, 0))
+            done, _ = concurrent.futures.wait(futures, wait, concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                futures.discard(future)
+                if future.exception() is None or not futures:
+                    for other in futures:
+                        other.cancel()
+                    if future.exception() is not None:
+                        raise future.exception()
+                    self.latency_tracker(stage).record(time.monotonic() - started)
+                    if future is not first:
+                        self.count("hedge_wins")
+                    return future.result()
+            if not done and can_hedge and time.monotonic() - started >= hedge_delay:
+                hedges += 1
+                self.count("hedges")
+                futures.add(self.pool.submit(fn, *args, **kwargs))
+
+    async def call_async(self, coro_fn, *args, stage=DEFAULT_STAGE, **kwargs):
+        """Await coro_fn(*args, **kwargs) with the resilience policies of stage."""
+        trial = self.breaker.before_call()
+        try:
+            self.count("calls")
+            self.retry_budget.deposit()
+            timeout, deadline = self.timeout_for(stage), self.deadline_for(stage)
+            start = time.monotonic()
+            attempt = 0
+            while True:
+                remaining = deadline - (time.monotonic() - start)
+                try:
+                    result = await self._attempt_async(coro_fn, args, kwargs, min(timeout, remaining), stage)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    remaining = deadline - (time.monotonic() - start)
+                    if not self.should_retry(e, attempt, remaining):
+                        self.on_error(e)
+                        raise
+                    await asyncio.sleep(self.backoff(attempt, remaining))
+                    attempt += 1
+                    continue
+                self.breaker.on_success()
+                return result
+        finally:
+            if trial:
+                self.breaker.end_trial()
+
+    async def stream_async(self, coro_fn, *args, stage=DEFAULT_STAGE, **kwargs):
+        """
+        Yield the responses of the stream opened by awaiting coro_fn(*args, **kwargs).
+
+        Opening the stream is a call of stage + ".stream", with all the policies
+        above. Reading it gets timeout_for(stage) seconds of generation in total,
+        the time the consumer takes between two responses does not count. A
+        failure or stall while reading counts against the breaker like a failed
+        call, but is not retried: responses were already handed out.
+        """
+        responses = await self.call_async(coro_fn, *args, stage=f"{stage}.stream", **kwargs)
+        iterator = responses.__aiter__()
+        timeout = self.timeout_for(stage)
+        generating = 0.0
+        while True:
+            started = time.monotonic()
+            try:
+                async with asyncio.timeout(timeout - generating):
+                    response = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                raise
+            except TimeoutError:
+                self.count("timeouts")
+                self.breaker.on_failure()
+                raise TimeoutError(f"{self.name} stream took more than {timeout:.1f}s")
+            except Exception as e:
+                self.on_error(e)
+                raise
+            finally:
+                generating += time.monotonic() - started
+            yield response
+
+    async def _attempt_async(self, coro_fn, args, kwargs, timeout, stage):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = asyncio.ensure_future(coro_fn(*args, **kwargs))
+        tasks = {first}
+        hedges = 0
+        try:
+            while True:
+                elapsed = loop.time() - started
+                if elapsed >= timeout:
+                    self.count("timeouts")
+                    raise TimeoutError(f"{self.name} call took more than {timeout:.1f}s")
+                wait = timeout - elapsed
+                hedge_delay = self.hedge_delay(stage)
+                can_hedge = hedge_delay is not None and hedges < self.max_hedges
+                if can_hedge:
+                    wait = min(wait, max(hedge_delay - elapsed, 0))
+                done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None or not tasks:
+                        if task.exception() is not None:
+                            raise task.exception()
+                        self.latency_tracker(stage).record(loop.time() - started)
+                        if task is not first:
+                            self.count("hedge_wins")
+                        return task.result()
+                if not done and can_hedge and loop.time() - started >= hedge_delay:
+                    hedges += 1
+                    self.count("hedges")
+                    tasks.add(asyncio.ensure_future(coro_fn(*args, **kwargs)))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        with self.latencies_lock:
+            trackers = dict(self.latencies)
+        return dict(
+            stats,
+            breaker=self.breaker.state,
+            retry_tokens=round(self.retry_budget.tokens, 2),
+            latencies={
+                stage: {"p50": tracker.percentile(50), "p95": tracker.percentile(95)}
+                for stage, tracker in trackers.items()
+            },
+        )
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,174 @@
+"""Per-stage model routing with request latency budgets"""
+
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+from vertexai.preview.generative_models import GenerativeModel
+
+from llm.resilience import LatencyTracker
+
+TIERS = {
+    "pro": "gemini-1.5-pro-002",
+    "flash": "gemini-1.5-flash-002",
+}
+# Every stage keeps the model it always had unless the config says otherwise
+DEFAULT_TIER = "pro"
+STAGES = ("actions", "transition", "step", "repair", "summary", "program", "habits")
+# Tier to fall back to when the latency budget runs low
+DOWNGRADES = {"pro": "flash"}
+
+_deadline = contextvars.ContextVar("latency_deadline", default=None)
+# {stage: model_name} of the last routing decisions in the current context
+_routed = contextvars.ContextVar("routed_models", default={})
+
+
+@contextlib.contextmanager
+def latency_budget(seconds):
+    """
+    Give the calls made inside the block seconds to complete, None for no budget.
+
+    The deadline lives in a context variable, so it follows the request through
+    awaits, asyncio tasks and to_thread without being passed around.
+    """
+    if seconds is None:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_budget():
+    """Seconds left in the current latency budget, None when there is none."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def parse_mapping(text) -> dict:
+    """'a=b,c=d' -> {"a": "b", "c": "d"}"""
+    mapping = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            mapping[key.strip()] = value.strip()
+    return mapping
+
+
+class RouteStats:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.downgraded = 0
+        self.latencies = LatencyTracker()
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "downgraded": self.downgraded,
+            "failures": self.failures,
+            "failure_rate": self.failures / self.calls if self.calls else None,
+            "latency_p50": self.latencies.percentile(50, min_samples=1),
+            "latency_p95": self.latencies.percentile(95, min_samples=1),
+        }
+
+
+class ModelRouter:
+    """
+    Maps each pipeline stage to a model tier.
+
+    A stage is downgraded to a faster tier when the current latency budget has
+    less time left than the route usually takes (its p95, or min_remaining_seconds
+    before enough calls have been seen). Latency and output failures (answers
+    that could not be parsed) are recorded per (stage, model) for report().
+
+    Each decision is remembered in the caller's context, so a failure noticed
+    after the call is charged to the model that actually answered.
+    """
+
+    def __init__(self, routes: dict = None, tiers: dict = None, downgrades: dict = None, min_remaining_seconds=10.0):
+        self.tiers = dict(TIERS, **(tiers or {}))
+        self.routes = {stage: DEFAULT_TIER for stage in STAGES}
+        self.routes.update(routes or {})
+        for stage, tier in self.routes.items():
+            if tier not in self.tiers:
+                raise ValueError(f"Unknown tier {tier!r} for stage {stage!r}, expected one of {list(self.tiers)}")
+        self.downgrades = DOWNGRADES if downgrades is None else downgrades
+        self.min_remaining_seconds = min_remaining_seconds
+        self.models = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """MODEL_ROUTES="actions=flash,step=flash", MODEL_TIERS="flash=gemini-1.5-flash-002"."""
+        return cls(
+            routes=parse_mapping(os.getenv("MODEL_ROUTES")),
+            tiers=parse_mapping(os.getenv("MODEL_TIERS")),
+            min_remaining_seconds=float(os.getenv("ROUTING_MIN_REMAINING_SECONDS", 10)),
+        )
+
+    def route_stats(self, stage, model_name) -> RouteStats:
+        with self.lock:
+            return self.stats.setdefault((stage, model_name), RouteStats())
+
+    def _route(self, stage) -> str:
+        tier = self.routes.get(stage, DEFAULT_TIER)
+        model_name = self.tiers[tier]
+        remaining = remaining_budget()
+        if remaining is None or tier not in self.downgrades:
+            return model_name
+        expected = self.route_stats(stage, model_name).latencies.percentile(95)
+        if remaining < max(expected or 0, self.min_remaining_seconds):
+            model_name = self.tiers[self.downgrades[tier]]
+            self.route_stats(stage, model_name).downgraded += 1
+        return model_name
+
+    def model_name(self, stage) -> str:
+        model_name = self._route(stage)
+        _routed.set({**_routed.get(), stage: model_name})
+        return model_name
+
+    def routed_model_name(self, stage) -> str:
+        """Model of the last call of stage in this context, without making a new routing decision."""
+        return _routed.get().get(stage) or self.tiers[self.routes.get(stage, DEFAULT_TIER)]
+
+    def model(self, model_name, system_instruction) -> GenerativeModel:
+        key = (model_name, system_instruction)
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = GenerativeModel(model_name, system_instruction=system_instruction)
+            return self.models[key]
+
+    def warm_up(self, system_instructions):
+        """Build the model of every tier for each system instruction and open its connection."""
+        for model_name in dict.fromkeys(self.tiers.values()):
+            for system_instruction in system_instructions:
+                # count_tokens goes through the same channel and auth as generate_content
+                self.model(model_name, system_instruction).count_tokens("ping")
+
+    def record(self, stage, model_name, seconds):
+        stats = self.route_stats(stage, model_name)
+        with self.lock:
+            stats.calls += 1
+        stats.latencies.record(seconds)
+
+    def record_failure(self, stage, model_name=None):
+        stats = self.route_stats(stage, model_name or self.routed_model_name(stage))
+        with self.lock:
+            stats.failures += 1
+
+    def report(self) -> dict:
+        """{stage: {"route": tier, "models": {model_name: stats}}} to choose the mapping from data."""
+        with self.lock:
+            items = list(self.stats.items())
+        report = {stage: {"route": tier, "models": {}} for stage, tier in self.routes.items()}
+        for (stage, model_name), stats in items:
+            report.setdefault(stage, {"route": None, "models": {}})["models"][model_name] = stats.to_dict()
+        return report
@@ -1,23 +1,45 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import Dict, List, Literal, Optional
+
+# Weeks, two years at most: every week costs model calls, or memory in the fast simulation
+MAX_TIME_HORIZON = 104
 
 class ImageGenerationRequest(BaseModel):
     prompt: str
     input_images_path: str
     num_steps: int = 50
     negative_prompt: Optional[str] = None
-    output_directory: str = "output_images"
+    # "base64": the images are inlined in the response, "reference": they are stored
+    # and served by /media, falling back to base64 when no media store is configured
+    response_format: Literal["base64", "reference"] = "base64"
+
+class MediaReference(BaseModel):
+    # sha256 of the content and extension, also its ETag
+    id: str
+    url: str
+    media_type: str
+    size: int
 
 class ImageGenerationResponse(BaseModel):
+    # Base64 PNGs, or media URLs with response_format="reference"
     saved_images: List[str]
+    media: List[MediaReference] = []
 
 class ProgramRequest(BaseModel):
     user_query: str
+    # Session whose speculative results may be reused, see /sessions/{session_id}
+    session_id: Optional[str] = None
+    # Seconds the caller is willing to wait, stages fall back to faster models when it runs low.
+    latency_budget_seconds: Optional[float] = Field(None, gt=0)
 
 class SimulateLifeRequest(BaseModel):
     initial_state: str
     program: str
-    time_horizon: int
+    time_horizon: int = Field(..., ge=1, le=MAX_TIME_HORIZON)
+    # "program" or "habits": also keep a running summary in that tone (streaming endpoint only).
+    summary_tone: Optional[Literal["program", "habits"]] = None
+    # Seconds the caller is willing to wait, stages fall back to faster models when it runs low.
+    latency_budget_seconds: Optional[float] = Field(None, gt=0)
 
     class Config:
         json_schema_extra = {
@@ -38,4 +60,75 @@ class SimulateLifeRequest(BaseModel):
     Regular physical activity: Incorporate regular physical activity into your routine, even if it's just a short walk or some stretching. Exercise can improve sleep quality and reduce stress.""",
                 "time_horizon": 15
             }
-        }
\ No newline at end of file
+        }
+
+class TextToSpeechRequest(BaseModel):
+    text: str = Field(..., min_length=1)
+    # The voice is derived from it, so the same user always gets the same voice
+    user_id: Optional[str] = None
+    # Only MP3 is streamed sentence by sentence, the other encodings start once the whole clip is synthesized
+    audio_encoding: Literal["ogg_opus", "mp3", "linear16"] = "mp3"
+    # "stream": the audio is the response body, "reference": it is stored and a MediaReference is returned,
+    # falling back to "stream" when no media store is configured
+    response_format: Literal["stream", "reference"] = "stream"
+
+class FutureRequest(BaseModel):
+    # The user's description of their habits, both the program and the initial state come from it
+    user_query: str
+    time_horizon: int = Field(15, ge=1, le=MAX_TIME_HORIZON)
+    # Directory of reference photos, the two images are skipped without it
+    input_images_path: Optional[str] = None
+    include_audio: bool = True
+    user_id: Optional[str] = None
+    audio_encoding: Literal["ogg_opus", "mp3", "linear16"] = "ogg_opus"
+    latency_budget_seconds: Optional[float] = Field(None, gt=0)
+    # Session whose speculative results may be reused, see /sessions/{session_id}
+    session_id: Optional[str] = None
+
+class SessionRequest(BaseModel):
+    # The user's description, as it will be sent to the later requests of the session
+    user_query: str
+    # Bounded like the requests that reuse its work, anyone can start a session
+    time_horizon: int = Field(15, ge=1, le=MAX_TIME_HORIZON)
+
+class ExtendJobRequest(BaseModel):
+    # New horizon of the job, only the weeks after its last checkpoint are simulated
+    time_horizon: int = Field(..., ge=1, le=MAX_TIME_HORIZON)
+
+class BranchJobRequest(BaseModel):
+    # Weeks up to this one are taken from the parent job, 0 starts over from its initial state
+    week: int = Field(..., ge=0)
+    # Program followed from week + 1, defaults to the parent's
+    program: Optional[str] = None
+    # Defaults to the parent's horizon
+    time_horizon: Optional[int] = Field(None, ge=1, le=MAX_TIME_HORIZON)
+
+class BatchSimulateLifeRequest(BaseModel):
+    personas: List[SimulateLifeRequest] = Field(..., min_length=1, max_length=64)
+    # Number of personas sharing one prompt per step, 1 simulates each persona on its own.
+    pack_size: int = Field(1, ge=1, le=8)
+    # Lower than the worker's BATCH_MAX_CONCURRENCY to leave room to other batches
+    max_concurrency: Optional[int] = Field(None, ge=1, le=16)
+
+class FastSimulationRequest(BaseModel):
+    # {category: action} over simulate_life.action_space.DICT_ACTIONS, every category is required
+    initial_actions: Dict[str, str]
+    # The trajectory holds n_personas * time_horizon weeks
+    time_horizon: int = Field(..., ge=1, le=MAX_TIME_HORIZON)
+    # Actions the program aims for, categories without a target keep their habits
+    targets: Dict[str, str] = {}
+    adherence: float = Field(0.3, ge=0, le=1)
+    n_personas: int = Field(1000, ge=1, le=100000)
+    seed: Optional[int] = None
+
+class EnsembleSimulateLifeRequest(SimulateLifeRequest):
+    max_rollouts: int = Field(8, ge=1, le=32)
+    min_rollouts: int = Field(3, ge=1)
+    # Stop once a new batch of rollouts moves no weekly action distribution by more than this
+    tolerance: float = Field(0.1, gt=0, le=1)
+
+    @model_validator(mode="after")
+    def check_rollouts(self):
+        if self.min_rollouts > self.max_rollouts:
+            raise ValueError(f"min_rollouts ({self.min_rollouts}) must not exceed max_rollouts ({self.max_rollouts})")
+        return self
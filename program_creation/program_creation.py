@@ -1,11 +1,59 @@
+import asyncio
 import vertexai
-from vertexai.preview.generative_models import GenerativeModel
-import json
 from dotenv import load_dotenv
 import os
+import time
+
+from llm.metrics import record_span, record_usage, span
+from llm.resilience import ResilientCaller
+from llm.routing import ModelRouter
+from llm.parsing import IncrementalObjectParser, OutputParsingError, parse_json_object, validate_habits, validate_program
+
+MODEL_NAME = "gemini-1.5-pro-002"
+GENERATION_CONFIG = {
+    "max_output_tokens": 5000,
+    "temperature": 0.3,
+    "top_p": 0.95,
+    "response_mime_type": "application/json"
+}
+HABITS_CATEGORIES = [
+    "Sleep",
+    "Nutrition",
+    "Exercise",
+    "Smoking",
+    "Alcohol",
+    "Social relationships",
+    "Mental health",
+    "Motivation",
+    "Hydration",
+    "Stress management",
+    "Screen time",
+]
+# Tighter configs for re-issuing a call whose answer could not be parsed
+REPAIR_PROGRAM_CONFIG = dict(GENERATION_CONFIG, temperature=0)
+REPAIR_HABITS_CONFIG = dict(
+    GENERATION_CONFIG,
+    temperature=0,
+    response_schema={
+        "type": "OBJECT",
+        "properties": {category: {"type": "STRING"} for category in HABITS_CATEGORIES},
+        "required": HABITS_CATEGORIES,
+    },
+)
+
+def chunk_text(response) -> str:
+    """Text of one streamed response, the last ones may only carry usage metadata."""
+    try:
+        return response.text
+    except (ValueError, IndexError, AttributeError):
+        return ""
+
+REPAIR_PROGRAM_INSTRUCTION = """
+
+Answer only with a valid json object whose keys are the domains of the program and whose values are json objects mapping each action to its description, both as strings."""
 
 class ProgramGenerator:
-    def __init__(self, env_file="../conf.env"):
+    def __init__(self, env_file="../conf.env", cache=None, prefix_cache=None, resilience=None, router=None):
         load_dotenv(env_file)
         PROJECT_ID = os.getenv('PROJECT_ID')
         REGION = os.getenv('LOCATION')
@@ -14,39 +62,146 @@ class ProgramGenerator:
         self.system_instruction_program = open("program_creation/system_instruction_program.txt", "r").read()
         self.system_instruction_category_completion = open("program_creation/system_instruction_category_completion.txt", "r").read()
 
-        self.model_program = GenerativeModel("gemini-1.5-pro-002", system_instruction=self.system_instruction_program)
-        self.model_category_completion = GenerativeModel("gemini-1.5-pro-002", system_instruction=self.system_instruction_category_completion)
+        # Optional llm.cache.ResponseCache shared with the other generators.
+        self.cache = cache
+        # Optional llm.prompt_cache.PromptPrefixCache holding the large system instructions
+        self.prefix_cache = prefix_cache
+        # Optional llm.resilience.ResilientCaller shared with the other Gemini clients.
+        self.resilience = resilience or ResilientCaller()
+        # Optional llm.routing.ModelRouter choosing the model of the "program" and "habits" stages.
+        self.router = router or ModelRouter()
+
+    def generate_content(self, stage, system_instruction, user_query, generation_config=GENERATION_CONFIG):
+        model_name = self.router.model_name(stage)
+
+        def generate():
+            cached_model = None
+            if self.prefix_cache is not None:
+                cached_model = self.prefix_cache.model_for(model_name, system_instruction)
+            model = cached_model or self.router.model(model_name, system_instruction)
+            with span(f"generate.{stage}") as timing:
+                response = self.resilience.call(model.generate_content, [user_query],
+                generation_config=generation_config,
+                stage=stage,
+                )
+            self.router.record(stage, model_name, timing.seconds)
+            record_usage(model_name, stage, response)
+            return response.candidates[0].content.parts[0].text
 
-    def extract_dict(self, input_string):
-        start_index = input_string.find('{')
-        end_index = input_string.rfind('}')
-        
-        if start_index != -1 and end_index != -1 and start_index < end_index:
-            return input_string[start_index:end_index + 1]
-        else:
-            return ""
+        if self.cache is None:
+            return generate()
+        key = self.cache.make_key(model_name, system_instruction, user_query, generation_config)
+        return self.cache.get_or_compute(key, generate)
 
     def generate_program(self, user_query):
-        response = self.model_program.generate_content([user_query],
-        generation_config= {
-          "max_output_tokens": 5000,
-          "temperature": 0.3,
-            "top_p": 0.95,
-            "response_mime_type": "application/json"
-        },
-        )
-        return json.loads(self.extract_dict(str(response.candidates[0].content.parts[0])).replace('\\', ''))
+        response = self.generate_content("program", self.system_instruction_program, user_query)
+        try:
+            return validate_program(parse_json_object(response))
+        except OutputParsingError:
+            self.router.record_failure("program")
+            # Re-issue the call once with a stricter prompt instead of failing the request
+            response = self.generate_content(
+                "program", self.system_instruction_program,
+                user_query + REPAIR_PROGRAM_INSTRUCTION, REPAIR_PROGRAM_CONFIG,
+            )
+            return validate_program(parse_json_object(response))
+
+    async def generate_content_stream_async(
+        self, stage, system_instruction, user_query, generation_config=GENERATION_CONFIG, model_name=None
+    ):
+        """Yield the text of the model's answer as it is generated, model_name defaults to the stage's route."""
+        model_name = model_name or self.router.model_name(stage)
+        cached_model = None
+        if self.prefix_cache is not None:
+            found, cached_model = self.prefix_cache.cached(model_name, system_instruction)
+            if not found:
+                # Registration is a blocking call, but only happens once per instruction
+                cached_model = await asyncio.to_thread(self.prefix_cache.model_for, model_name, system_instruction)
+        model = cached_model or self.router.model(model_name, system_instruction)
+        last = None
+        # Only the time spent waiting for the model is timed, not the consumer's
+        generating = 0.0
+        started = time.perf_counter()
+        async for response in self.resilience.stream_async(
+            model.generate_content_async, [user_query],
+            generation_config=generation_config,
+            stream=True,
+            stage=stage,
+        ):
+            generating += time.perf_counter() - started
+            last = response
+            text = chunk_text(response)
+            if text:
+                yield text
+            started = time.perf_counter()
+        generating += time.perf_counter() - started
+        record_span(f"generate.{stage}", generating)
+        self.router.record(stage, model_name, generating)
+        if last is not None:
+            # Usage metadata comes with the last response of the stream
+            record_usage(model_name, stage, last)
+
+    async def stream_program_async(self, user_query):
+        """
+        Yield each domain of the program as soon as the model has written it.
+
+        Events are {"domain", "actions"} in the order of the answer, then a last
+        {"program"} with the whole validated program, which is the one to keep.
+        When the whole answer does not parse, the repair call of generate_program
+        is made and the domains that were not streamed yet come from it.
+        """
+        model_name = self.router.model_name("program")
+        key = None
+        text = None
+        if self.cache is not None:
+            key = self.cache.make_key(model_name, self.system_instruction_program, user_query, GENERATION_CONFIG)
+            text = await self.cache.get_async(key)
+
+        streamed = set()
+        if text is None:
+            parser = IncrementalObjectParser()
+            chunks = []
+            async for chunk in self.generate_content_stream_async(
+                "program", self.system_instruction_program, user_query, model_name=model_name
+            ):
+                chunks.append(chunk)
+                for domain, actions in parser.feed(chunk):
+                    try:
+                        validate_program({domain: actions})
+                    except OutputParsingError:
+                        continue
+                    streamed.add(domain)
+                    yield {"domain": domain, "actions": actions}
+            text = "".join(chunks)
+
+        try:
+            program = validate_program(parse_json_object(text))
+            if key is not None:
+                await self.cache.set_async(key, text)
+        except OutputParsingError:
+            self.router.record_failure("program", model_name)
+            response = await asyncio.to_thread(
+                self.generate_content, "program", self.system_instruction_program,
+                user_query + REPAIR_PROGRAM_INSTRUCTION, REPAIR_PROGRAM_CONFIG,
+            )
+            program = validate_program(parse_json_object(response))
+
+        for domain, actions in program.items():
+            if domain not in streamed:
+                yield {"domain": domain, "actions": actions}
+        yield {"program": program}
 
     def generate_habits_category(self, user_query):
-        response = self.model_category_completion.generate_content([user_query],
-        generation_config= {
-          "max_output_tokens": 5000,
-          "temperature": 0.3,
-            "top_p": 0.95,
-            "response_mime_type": "application/json"
-        },
-        )
-        return json.loads(self.extract_dict(str(response.candidates[0].content.parts[0])).replace('\\', ''))
+        response = self.generate_content("habits", self.system_instruction_category_completion, user_query)
+        try:
+            return validate_habits(parse_json_object(response))
+        except OutputParsingError:
+            self.router.record_failure("habits")
+            response = self.generate_content(
+                "habits", self.system_instruction_category_completion,
+                user_query, REPAIR_HABITS_CONFIG,
+            )
+            return validate_habits(parse_json_object(response))
 
     def display_program(self, program):
         for domain, actions in program.items():
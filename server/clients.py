@@ -0,0 +1,178 @@
+"""Clients shared by every request of a worker"""
+
+import os
+
+from dotenv import load_dotenv
+
+from image_generation.generate_replicate import ImageGenerator
+from llm.cache import ResponseCache
+from llm.prompt_cache import build_prefix_cache
+from llm.resilience import ResilientCaller
+from llm.routing import ModelRouter
+from program_creation.program_creation import ProgramGenerator
+from server.executors import build_executors
+from server.jobs import JobManager
+from server.media import build_media_store
+from server.speculation import SpeculativeSessions
+from simulate_life.batch import BatchSimulator
+from simulate_life.simulate_life import SYSTEM_INSTRUCTION as SIMULATION_INSTRUCTION, LifeSimulator
+from summarize_states.summarize_states import SYSTEM_INSTRUCTION as SUMMARY_INSTRUCTION, StateSummarizer
+from text_to_speech import AudioCache, TextToSpeech
+
+PHOTOMAKER_MODEL = "tencentarc/photomaker"
+
+
+class ClientUnavailableError(Exception):
+    """Raised when a handler needs a client that could not be created."""
+
+
+class ClientRegistry:
+    """
+    Builds the model clients once per worker and keeps them warm.
+
+    Building a client reloads conf.env, calls vertexai.init and, for the
+    ProgramGenerator, reads the system instructions from disk, so handlers
+    must take their clients from here instead of constructing new ones.
+    """
+
+    def __init__(self, env_file="conf.env"):
+        self.env_file = env_file
+        self.life_simulator = None
+        self.program_generator = None
+        self.image_generator = None
+        self.state_summarizer = None
+        self.text_to_speech = None
+        self.executors = {}
+        self.cache = None
+        self.prefix_cache = None
+        self.resilience = None
+        self.router = None
+        self.media_store = None
+        self.jobs = None
+        self.sessions = None
+        self.batch_simulator = None
+        self.errors = {}
+        self.ready = False
+
+    def start(self):
+        load_dotenv(self.env_file)
+        self.executors = build_executors()
+        self.cache = ResponseCache.from_env()
+        self.prefix_cache = build_prefix_cache()
+        # One set of latencies, retry budget and circuit breaker for all the Gemini clients
+        self.resilience = ResilientCaller.from_env("gemini")
+        self.router = ModelRouter.from_env()
+        # Generated images and audio are written there and returned by reference
+        self.media_store = build_media_store()
+        builders = {
+            "life_simulator": lambda: LifeSimulator(
+                env_file=self.env_file,
+                cache=self.cache,
+                step_mode=os.getenv("SIMULATION_STEP_MODE", "two_call"),
+                prefix_cache=self.prefix_cache,
+                resilience=self.resilience,
+                router=self.router,
+            ),
+            "program_generator": lambda: ProgramGenerator(
+                env_file=self.env_file,
+                cache=self.cache,
+                prefix_cache=self.prefix_cache,
+                resilience=self.resilience,
+                router=self.router,
+            ),
+            "image_generator": lambda: ImageGenerator(env_file=self.env_file, media_store=self.media_store),
+            "state_summarizer": lambda: StateSummarizer(
+                env_file=self.env_file,
+                cache=self.cache,
+                resilience=self.resilience,
+                router=self.router,
+            ),
+            "text_to_speech": lambda: TextToSpeech(
+                audio_encoding=os.getenv("TTS_AUDIO_ENCODING", "ogg_opus"),
+                cache=AudioCache(int(os.getenv("TTS_CACHE_MAX_BYTES", 64 * 1024 * 1024))),
+                media_store=self.media_store,
+            ),
+        }
+        for name, build in builders.items():
+            try:
+                setattr(self, name, build())
+            except Exception as e:
+                self.errors[name] = str(e)
+        if self.life_simulator is not None:
+            # Shared by every batch request, so concurrent batches cannot multiply the Gemini calls
+            self.batch_simulator = BatchSimulator(
+                self.life_simulator, max_concurrency=int(os.getenv("BATCH_MAX_CONCURRENCY", 8))
+            )
+
+    def start_jobs(self):
+        """Must be called from the event loop, the job manager schedules asyncio tasks."""
+        if self.life_simulator is not None:
+            self.jobs = JobManager.from_env(self.life_simulator)
+            self.jobs.start()
+
+    def start_sessions(self):
+        """Must be called from the event loop, speculative work runs as asyncio tasks."""
+        if self.life_simulator is not None:
+            self.sessions = SpeculativeSessions.from_env(
+                self.life_simulator,
+                self.program_generator,
+                self.executors["speculation"],
+                foreground=self.executors["gemini"],
+            )
+            self.sessions.start_reaper()
+
+    def warm_up(self):
+        """
+        Open the connections to the providers with calls that do not generate anything.
+
+        The Gemini clients are warmed through the router, whose models serve the
+        requests, for every tier a stage may be routed or downgraded to, so the
+        first real request does not pay for the handshake.
+        """
+        warm_ups = {
+            "life_simulator": lambda c: c.router.warm_up([SIMULATION_INSTRUCTION]),
+            "program_generator": lambda c: c.router.warm_up(
+                [c.system_instruction_program, c.system_instruction_category_completion]
+            ),
+            "image_generator": lambda c: c.client.models.get(PHOTOMAKER_MODEL),
+            "state_summarizer": lambda c: c.router.warm_up([SUMMARY_INSTRUCTION]),
+            "text_to_speech": lambda c: c.client.list_voices(language_code="en-GB"),
+        }
+        for name, warm_up in warm_ups.items():
+            client = getattr(self, name)
+            if client is None:
+                continue
+            try:
+                warm_up(client)
+            except Exception as e:
+                self.errors[name] = str(e)
+        self.ready = not self.errors
+
+    def get(self, name):
+        client = getattr(self, name)
+        if client is None and name in ("jobs", "sessions", "batch_simulator"):
+            name = "life_simulator"
+        if client is None:
+            raise ClientUnavailableError(
+                f"{name} is not available: {self.errors.get(name, 'starting up')}"
+            )
+        return client
+
+    def executor(self, backend):
+        return self.executors[backend]
+
+    def close(self):
+        if self.jobs is not None:
+            self.jobs.stop()
+        if self.sessions is not None:
+            self.sessions.stop()
+        for executor in self.executors.values():
+            executor.shutdown()
+        if self.resilience is not None:
+            self.resilience.close()
+
+    def status(self) -> dict:
+        status = {"ready": self.ready, "errors": self.errors}
+        if self.resilience is not None:
+            status["gemini"] = self.resilience.get_stats()
+        return status
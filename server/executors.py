@@ -0,0 +1,135 @@
+"""Bounded executors that keep blocking provider calls off the event loop"""
+
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+
+class ExecutorSaturatedError(Exception):
+    """Raised when a backend already has as much work as it accepts."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is saturated, retry in {retry_after}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a hard limit on queued work.
+
+    At most max_workers calls run at once and at most max_queue more wait for a
+    thread. Anything beyond that is rejected immediately with
+    ExecutorSaturatedError, so callers get a fast 503 instead of an unbounded wait.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, retry_after: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.capacity = max_workers + max_queue
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def acquire(self):
+        # Only called from the event loop thread, so no lock is needed.
+        if self.in_flight >= self.capacity:
+            raise ExecutorSaturatedError(self.name, self.retry_after)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.submit(fn, *args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs) -> asyncio.Future:
+        """
+        Start fn(*args, **kwargs) in a thread and return its future.
+
+        Cancelling the future only stops fn if it has not started yet, a thread
+        cannot be interrupted, so the slot is held until fn actually returns.
+        """
+        loop = asyncio.get_running_loop()
+        self.acquire()
+        try:
+            # Carry the request's context variables (e.g. its latency budget) into the thread
+            context = contextvars.copy_context()
+            future = self.executor.submit(context.run, fn, *args, **kwargs)
+        except BaseException:
+            self.release()
+            raise
+        future.add_done_callback(lambda _: self._release_threadsafe(loop))
+        return asyncio.wrap_future(future, loop=loop)
+
+    def _release_threadsafe(self, loop):
+        # acquire and release only run on the event loop thread
+        try:
+            loop.call_soon_threadsafe(self.release)
+        except RuntimeError:
+            # The loop is closed, nothing can be admitted anymore
+            pass
+
+    async def run_admitted(self, fn, *args, **kwargs):
+        """run for a caller that already holds a slot of this executor."""
+        loop = asyncio.get_running_loop()
+        # Carry the request's context variables (e.g. its latency budget) into the thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(context.run, fn, *args, **kwargs)
+        )
+
+    @asynccontextmanager
+    async def slot(self):
+        """Admission control for work that is already async but counts against this backend."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def build_executors() -> dict:
+    def limit(name, default):
+        return int(os.getenv(name, default))
+
+    return {
+        "gemini": BoundedExecutor(
+            "gemini",
+            max_workers=limit("GEMINI_MAX_WORKERS", 16),
+            max_queue=limit("GEMINI_MAX_QUEUE", 32),
+            retry_after=2,
+        ),
+        "replicate": BoundedExecutor(
+            "replicate",
+            max_workers=limit("REPLICATE_MAX_WORKERS", 4),
+            max_queue=limit("REPLICATE_MAX_QUEUE", 4),
+            retry_after=30,
+        ),
+        "tts": BoundedExecutor(
+            "tts",
+            max_workers=limit("TTS_MAX_WORKERS", 8),
+            max_queue=limit("TTS_MAX_QUEUE", 16),
+            retry_after=2,
+        ),
+        # Speculative session work, a small budget of its own so it never takes a request's gemini slot
+        "speculation": BoundedExecutor(
+            "speculation",
+            max_workers=limit("SPECULATION_MAX_WORKERS", 2),
+            max_queue=limit("SPECULATION_MAX_QUEUE", 2),
+            retry_after=2,
+        ),
+        # Local number crunching, e.g. the NumPy previews, kept off the event loop
+        "cpu": BoundedExecutor(
+            "cpu",
+            max_workers=limit("CPU_MAX_WORKERS", 2),
+            max_queue=limit("CPU_MAX_QUEUE", 8),
+            retry_after=1,
+        ),
+    }
@@ -0,0 +1,416 @@
+"""Background simulation jobs with per-week checkpoints"""
+
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from server.executors import ExecutorSaturatedError
+
+FINISHED_STATUSES = ("succeeded", "failed")
+
+
+class JobStore:
+    """
+    SQLite persistence for jobs and the weeks they already computed.
+
+    Every finished week is written as soon as it is known, so a job that fails
+    or whose worker dies can restart from its last checkpoint.
+
+    The file is shared by every worker of the machine. A job is run by the worker
+    that owns it, which renews its lease with a heartbeat; another worker only
+    takes an unfinished job over once that lease has expired.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT,
+                request TEXT,
+                error TEXT,
+                created_at REAL,
+                updated_at REAL,
+                owner TEXT,
+                heartbeat_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                job_id TEXT,
+                week INTEGER,
+                actions TEXT,
+                state TEXT,
+                PRIMARY KEY (job_id, week)
+            );
+            """
+        )
+        # Files created before jobs had owners
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("heartbeat_at", "REAL")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self.db.commit()
+
+    def claim(self, job_id, owner, lease_seconds) -> bool:
+        """
+        Make owner the worker running job_id, unless another worker holds a live lease on it.
+
+        Finished jobs and jobs without a recent heartbeat can always be claimed.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET owner = ?, heartbeat_at = ? WHERE id = ? AND ("
+                "owner IS NULL OR owner = ? OR heartbeat_at IS NULL OR heartbeat_at < ? "
+                "OR status NOT IN ('queued', 'running'))",
+                (owner, now, job_id, owner, now - lease_seconds),
+            )
+            self.db.commit()
+        return cursor.rowcount == 1
+
+    def renew(self, job_id, owner) -> bool:
+        """Extend owner's lease on job_id, False if another worker took it over."""
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND owner = ?",
+                (time.time(), job_id, owner),
+            )
+            self.db.commit()
+        return cursor.rowcount == 1
+
+    def release(self, job_id, owner):
+        """Let any worker claim job_id right away, e.g. when owner shuts down."""
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET owner = NULL, heartbeat_at = NULL WHERE id = ? AND owner = ?",
+                (job_id, owner),
+            )
+            self.db.commit()
+
+    def create(self, request: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (id, status, request, error, created_at, updated_at) VALUES (?, ?, ?, NULL, ?, ?)",
+                (job_id, "queued", json.dumps(request), now, now),
+            )
+            self.db.commit()
+        return job_id
+
+    def branch(self, parent_id, week, request: dict) -> str:
+        """New job starting from the first `week` checkpointed weeks of parent_id, which are copied."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (id, status, request, error, created_at, updated_at) VALUES (?, ?, ?, NULL, ?, ?)",
+                (job_id, "queued", json.dumps(request), now, now),
+            )
+            self.db.execute(
+                "INSERT INTO checkpoints (job_id, week, actions, state) "
+                "SELECT ?, week, actions, state FROM checkpoints WHERE job_id = ? AND week <= ?",
+                (job_id, parent_id, week),
+            )
+            self.db.commit()
+        return job_id
+
+    def set_request(self, job_id, request: dict):
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET request = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(request), time.time(), job_id),
+            )
+            self.db.commit()
+
+    def set_status(self, job_id, status, error=None):
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+            self.db.commit()
+
+    def save_week(self, job_id, week: dict):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checkpoints (job_id, week, actions, state) VALUES (?, ?, ?, ?)",
+                (job_id, week["week"], json.dumps(week["actions"]), week["state"]),
+            )
+            self.db.execute(
+                "UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id)
+            )
+            self.db.commit()
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, status, request, error FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "status": row[1],
+            "request": json.loads(row[2]),
+            "error": row[3],
+        }
+
+    def weeks(self, job_id, after_week=0) -> list:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT week, actions, state FROM checkpoints WHERE job_id = ? AND week > ? ORDER BY week",
+                (job_id, after_week),
+            ).fetchall()
+        return [
+            {"week": week, "actions": json.loads(actions), "state": state}
+            for week, actions, state in rows
+        ]
+
+    def unfinished(self) -> list:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+class JobManager:
+    """
+    Runs simulation jobs in the background with at most max_workers at a time.
+
+    A failed week is retried from the last checkpoint up to max_attempts times,
+    with exponential backoff, before the job is marked failed; it can still be
+    resumed later with resume(). The SQLite store is called from threads, except
+    by stop() once the server is shutting down.
+
+    A job is a persisted simulation: extend() raises its horizon and branch()
+    starts a new job from one of its weeks, possibly with another program. Both
+    only compute the weeks that are not checkpointed yet.
+    """
+
+    def __init__(
+        self,
+        life_simulator,
+        store: JobStore,
+        max_workers=4,
+        max_pending=64,
+        max_attempts=3,
+        lease_seconds=120,
+        base_retry_delay=2.0,
+        max_retry_delay=60.0,
+    ):
+        self.life_simulator = life_simulator
+        self.store = store
+        # Unique per process, several workers share the store
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.heartbeat = None
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_retry_delay = base_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.workers = asyncio.Semaphore(max_workers)
+        self.tasks = {}
+        self.updated = asyncio.Condition()
+
+    @classmethod
+    def from_env(cls, life_simulator):
+        store = JobStore(os.getenv("JOBS_DB_PATH", "cache/jobs.sqlite3"))
+        return cls(
+            life_simulator,
+            store,
+            max_workers=int(os.getenv("JOBS_MAX_WORKERS", 4)),
+            max_pending=int(os.getenv("JOBS_MAX_PENDING", 64)),
+            lease_seconds=float(os.getenv("JOBS_LEASE_SECONDS", 120)),
+        )
+
+    def start(self):
+        """Pick up the unfinished jobs whose worker stopped, those of live workers are left to them."""
+        self.heartbeat = asyncio.create_task(self._heartbeat())
+
+    async def _heartbeat(self):
+        for job_id in await asyncio.to_thread(self.store.unfinished):
+            if job_id not in self.tasks and await asyncio.to_thread(
+                self.store.claim, job_id, self.worker_id, self.lease_seconds
+            ):
+                self._schedule_once(job_id)
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            for job_id, task in list(self.tasks.items()):
+                if not await asyncio.to_thread(self.store.renew, job_id, self.worker_id):
+                    # Taken over after our lease expired, the other worker runs it now
+                    task.cancel()
+
+    def retry_delay(self, failures, error) -> float:
+        """Exponential backoff between two rounds of a failing job, at least as long as an open circuit."""
+        delay = min(self.max_retry_delay, self.base_retry_delay * 2 ** (failures - 1))
+        return max(delay, getattr(error, "retry_after", 0))
+
+    async def submit(self, request: dict) -> str:
+        if len(self.tasks) >= self.max_pending:
+            raise ExecutorSaturatedError("jobs", retry_after=10)
+        job_id = await asyncio.to_thread(self.store.create, request)
+        await asyncio.to_thread(self.store.claim, job_id, self.worker_id, self.lease_seconds)
+        self._schedule_once(job_id)
+        return job_id
+
+    async def resume(self, job_id):
+        """Run the job up to its horizon again, unless it is already queued or running."""
+        previous = self.tasks.get(job_id)
+        if previous is not None and (await asyncio.to_thread(self.store.get, job_id))["status"] not in FINISHED_STATUSES:
+            return
+        if len(self.tasks) >= self.max_pending:
+            raise ExecutorSaturatedError("jobs", retry_after=10)
+        if not await asyncio.to_thread(self.store.claim, job_id, self.worker_id, self.lease_seconds):
+            # Running on another live worker, which reads the request at every round
+            return
+        await asyncio.to_thread(self.store.set_status, job_id, "queued")
+        if self.tasks.get(job_id) is not previous:
+            # Resumed concurrently while this call waited for the store
+            return
+        self._schedule(job_id)
+
+    async def extend(self, job_id, time_horizon: int):
+        """
+        Simulate the job up to a longer horizon, from its last checkpointed week.
+
+        A running job picks the new horizon up when it reaches the old one. When
+        the job cannot be resumed, its horizon is left as it was.
+        """
+        request = (await asyncio.to_thread(self.store.get, job_id))["request"]
+        if time_horizon < request["time_horizon"]:
+            raise ValueError(f"time_horizon must be at least {request['time_horizon']}, got {time_horizon}")
+        if job_id not in self.tasks and len(self.tasks) >= self.max_pending:
+            raise ExecutorSaturatedError("jobs", retry_after=10)
+        await asyncio.to_thread(self.store.set_request, job_id, dict(request, time_horizon=time_horizon))
+        try:
+            await self.resume(job_id)
+        except BaseException:
+            await asyncio.to_thread(self.store.set_request, job_id, request)
+            raise
+
+    async def branch(self, job_id, week: int, program=None, time_horizon=None) -> str:
+        """
+        Start a new job from the state of job_id at the end of `week`.
+
+        Weeks up to `week` are copied from the parent, the next ones are simulated
+        with program, or the parent's program if it is None.
+        """
+        parent = await self.get(job_id)
+        request = parent["request"]
+        computed = len(parent["life_simulation"]["states"])
+        if week > computed:
+            raise ValueError(f"week must be at most {computed}, the weeks computed so far, got {week}")
+        time_horizon = time_horizon or request["time_horizon"]
+        if time_horizon < week:
+            raise ValueError(f"time_horizon must be at least week {week}, got {time_horizon}")
+        if len(self.tasks) >= self.max_pending:
+            raise ExecutorSaturatedError("jobs", retry_after=10)
+        branch_request = dict(
+            request,
+            program=program if program is not None else request["program"],
+            time_horizon=time_horizon,
+            parent_id=job_id,
+            branch_week=week,
+        )
+        branch_id = await asyncio.to_thread(self.store.branch, job_id, week, branch_request)
+        await asyncio.to_thread(self.store.claim, branch_id, self.worker_id, self.lease_seconds)
+        self._schedule_once(branch_id)
+        return branch_id
+
+    def _schedule(self, job_id):
+        task = asyncio.create_task(self._run(job_id))
+        self.tasks[job_id] = task
+        # A job resumed while its previous task was finishing must keep its new task
+        task.add_done_callback(lambda done: self.tasks.pop(job_id) if self.tasks.get(job_id) is done else None)
+
+    def _schedule_once(self, job_id):
+        # The startup scan may find a job submitted while it waited for the store
+        task = self.tasks.get(job_id)
+        if task is None or task.done():
+            self._schedule(job_id)
+
+    async def _notify(self):
+        async with self.updated:
+            self.updated.notify_all()
+
+    async def _run(self, job_id):
+        # The store is SQLite, every call runs in a thread so that commits never block the event loop
+        store = self.store
+        async with self.workers:
+            await asyncio.to_thread(store.set_status, job_id, "running")
+            await self._notify()
+            failures = 0
+            while True:
+                # Read at every round, the horizon may have been extended meanwhile
+                request = (await asyncio.to_thread(store.get, job_id))["request"]
+                done = await asyncio.to_thread(store.weeks, job_id)
+                if len(done) >= request["time_horizon"]:
+                    await asyncio.to_thread(store.set_status, job_id, "succeeded")
+                    break
+                state = done[-1]["state"] if done else request["initial_state"]
+                try:
+                    async for week in self.life_simulator.iter_evolution_given_program_async(
+                        state,
+                        request["program"],
+                        request["time_horizon"],
+                        start_week=len(done),
+                    ):
+                        await asyncio.to_thread(store.save_week, job_id, week)
+                        await self._notify()
+                except Exception as e:
+                    failures += 1
+                    if failures == self.max_attempts:
+                        await asyncio.to_thread(store.set_status, job_id, "failed", str(e))
+                        break
+                    # Retrying at once would spend every attempt within the same outage
+                    await asyncio.sleep(self.retry_delay(failures, e))
+            await self._notify()
+
+    async def get(self, job_id):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            return None
+        weeks = await asyncio.to_thread(self.store.weeks, job_id)
+        job["life_simulation"] = {
+            "actions": [week["actions"] for week in weeks],
+            "states": [week["state"] for week in weeks],
+        }
+        return job
+
+    async def exists(self, job_id) -> bool:
+        return await asyncio.to_thread(self.store.get, job_id) is not None
+
+    async def follow(self, job_id):
+        """Yield every checkpointed week of a job, then wait for new ones until it finishes."""
+        last_week = 0
+        while True:
+            for week in await asyncio.to_thread(self.store.weeks, job_id, last_week):
+                last_week = week["week"]
+                yield week
+            job = await asyncio.to_thread(self.store.get, job_id)
+            if job["status"] in FINISHED_STATUSES:
+                yield {"status": job["status"], "error": job["error"]}
+                return
+            async with self.updated:
+                try:
+                    await asyncio.wait_for(self.updated.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+
+    def stop(self):
+        # Cancelled jobs stay "running" in the store and are resumed by the next start(),
+        # of this worker or another one, without waiting for the lease to expire.
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        for job_id, task in list(self.tasks.items()):
+            task.cancel()
+            self.store.release(job_id, self.worker_id)
@@ -0,0 +1,138 @@
+"""Content-addressed storage of generated media, served by reference instead of inline"""
+
+import abc
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".ogg": "audio/ogg",
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+}
+EXTENSIONS = {media_type: extension for extension, media_type in MEDIA_TYPES.items()}
+# sha256 of the content followed by the extension of its media type
+MEDIA_ID = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]+)$")
+READ_CHUNK_SIZE = 256 * 1024
+
+
+def parse_media_id(media_id):
+    """(digest, media type) of a media id, or None if it is not one this store could have written."""
+    match = MEDIA_ID.match(media_id)
+    if match is None or match.group(2) not in MEDIA_TYPES:
+        return None
+    return match.group(1), MEDIA_TYPES[match.group(2)]
+
+
+class MediaStore(abc.ABC):
+    """
+    Base class for media stores.
+
+    Media are written once under the sha256 of their content, so the same image
+    or audio clip is stored once however many times it is generated, and a
+    media id always designates the same bytes, which lets clients and proxies
+    cache it forever. Subclasses implement where the bytes live.
+    """
+
+    def __init__(self, url_prefix="/media"):
+        self.url_prefix = url_prefix.rstrip("/")
+        self.stats = {"writes": 0, "deduplicated": 0, "bytes_written": 0}
+        self.lock = threading.Lock()
+
+    def put(self, data: bytes, media_type) -> dict:
+        return self.put_stream([data], media_type)
+
+    @abc.abstractmethod
+    def put_stream(self, chunks, media_type) -> dict:
+        """Store the concatenated chunks, without holding them all in memory, and return their reference."""
+
+    @abc.abstractmethod
+    def exists(self, media_id) -> bool:
+        """Whether the store holds the media."""
+
+    @abc.abstractmethod
+    def iter_bytes(self, media_id):
+        """Chunks of the media, read lazily."""
+
+    def path(self, media_id):
+        """Local file of the media, to be sent without copying it through Python, or None."""
+        return None
+
+    def reference(self, media_id, size) -> dict:
+        return {
+            "id": media_id,
+            "url": f"{self.url_prefix}/{media_id}",
+            "media_type": parse_media_id(media_id)[1],
+            "size": size,
+        }
+
+    def _count(self, size, deduplicated):
+        with self.lock:
+            self.stats["deduplicated" if deduplicated else "writes"] += 1
+            if not deduplicated:
+                self.stats["bytes_written"] += size
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+
+class LocalMediaStore(MediaStore):
+    """Media as files of a local directory, named by their media id."""
+
+    def __init__(self, root, url_prefix="/media"):
+        super().__init__(url_prefix)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _file(self, media_id):
+        return os.path.join(self.root, media_id)
+
+    def put_stream(self, chunks, media_type) -> dict:
+        if media_type not in EXTENSIONS:
+            raise ValueError(f"media_type must be one of {list(EXTENSIONS)}, got {media_type!r}")
+        digest = hashlib.sha256()
+        size = 0
+        # Written next to its final location, then renamed, so a media id never points to a partial file
+        descriptor, temporary = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    file.write(chunk)
+            media_id = digest.hexdigest() + EXTENSIONS[media_type]
+            deduplicated = os.path.exists(self._file(media_id))
+            if deduplicated:
+                os.remove(temporary)
+            else:
+                # mkstemp creates the file readable by its owner only
+                os.chmod(temporary, 0o644)
+                os.replace(temporary, self._file(media_id))
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self._count(size, deduplicated)
+        return self.reference(media_id, size)
+
+    def exists(self, media_id) -> bool:
+        return parse_media_id(media_id) is not None and os.path.isfile(self._file(media_id))
+
+    def iter_bytes(self, media_id):
+        with open(self._file(media_id), "rb") as file:
+            while chunk := file.read(READ_CHUNK_SIZE):
+                yield chunk
+
+    def path(self, media_id):
+        return self._file(media_id)
+
+
+def build_media_store(kind=None):
+    kind = kind or os.getenv("MEDIA_STORE", "local")
+    if kind == "local":
+        return LocalMediaStore(os.getenv("MEDIA_ROOT", "cache/media"), os.getenv("MEDIA_URL_PREFIX", "/media"))
+    return None
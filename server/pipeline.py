@@ -0,0 +1,129 @@
+"""The whole "what will I become" pipeline as a graph of concurrent stages"""
+
+import asyncio
+
+# PhotoMaker needs the class word followed by the "img" trigger word
+PROGRAM_IMAGE_PROMPT = "A photo of a happy, fit and healthy person img, smiling and full of energy"
+HABITS_IMAGE_PROMPT = "A photo of a tired and unhealthy person img, looking sad and exhausted"
+
+
+class StageSkippedError(Exception):
+    """A stage did not run because one of the stages it depends on failed."""
+
+
+class StageGraph:
+    """
+    Runs async stages as soon as the stages they depend on are done.
+
+    Each stage is a function returning an awaitable, called with the results of
+    its dependencies in the order they were listed. Stages must be added after
+    their dependencies, which also rules out cycles.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, fn, after=()):
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"{name} depends on {dependency}, which must be added first")
+        self.stages[name] = (fn, tuple(after))
+
+    async def _run_stage(self, name, fn, dependencies, events):
+        loop = asyncio.get_running_loop()
+        try:
+            inputs = []
+            for dependency, task in dependencies:
+                try:
+                    inputs.append(await task)
+                except Exception:
+                    raise StageSkippedError(f"{dependency} failed")
+            start = loop.time()
+            result = await fn(*inputs)
+            await events.put({"stage": name, "result": result, "seconds": round(loop.time() - start, 3)})
+            return result
+        except Exception as e:
+            await events.put({"stage": name, "error": str(e), "skipped": isinstance(e, StageSkippedError)})
+            raise
+
+    async def run(self):
+        """Yield one {stage, result} or {stage, error} event per stage, in completion order."""
+        events = asyncio.Queue()
+        tasks = {}
+        for name, (fn, after) in self.stages.items():
+            dependencies = [(dependency, tasks[dependency]) for dependency in after]
+            tasks[name] = asyncio.create_task(self._run_stage(name, fn, dependencies, events))
+        try:
+            for _ in range(len(tasks)):
+                yield await events.get()
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            # Retrieve every outcome, failures were already reported as events
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+def build_future_pipeline(clients, request) -> StageGraph:
+    """
+    Stages of one request, from the user's description to summaries, images and audio.
+
+    The habits trajectory and both images only need the request, so they start
+    right away, alongside the program generation. Each summary starts when its
+    trajectory is done and its audio when the summary is.
+    """
+    life_simulator = clients.get("life_simulator")
+    program_generator = clients.get("program_generator")
+    summarizer = clients.get("state_summarizer")
+    gemini = clients.executor("gemini")
+    # Both trajectories share the simulator's usual concurrency budget
+    semaphore = asyncio.Semaphore(life_simulator.max_concurrency)
+
+    async def habits_simulation():
+        # Started speculatively when the session began, if it did
+        if request.session_id is not None and clients.sessions is not None:
+            baseline = await clients.sessions.result(
+                request.session_id, "baseline", request.user_query, request.time_horizon
+            )
+            if baseline is not None:
+                return baseline
+        return await life_simulator.get_evolution_given_program_async(
+            request.user_query, life_simulator.prompt_no_program, request.time_horizon, semaphore
+        )
+
+    graph = StageGraph()
+    graph.add("program", lambda: gemini.run(program_generator.generate_program, request.user_query))
+    graph.add("habits_simulation", habits_simulation)
+    graph.add("program_simulation", lambda program: life_simulator.get_evolution_given_program_async(
+        request.user_query, program, request.time_horizon, semaphore
+    ), after=["program"])
+    graph.add("habits_summary", lambda simulation: gemini.run(
+        summarizer.summarize_habits_states, simulation["actions"], simulation["states"]
+    ), after=["habits_simulation"])
+    graph.add("program_summary", lambda simulation: gemini.run(
+        summarizer.summarize_program_states, simulation["actions"], simulation["states"]
+    ), after=["program_simulation"])
+
+    # Images and audio are returned as media references when there is a store, inline otherwise
+    by_reference = clients.media_store is not None
+
+    if request.input_images_path is not None:
+        image_generator = clients.get("image_generator")
+        generate_image = image_generator.generate_image_media if by_reference else image_generator.generate_image
+        replicate = clients.executor("replicate")
+        graph.add("program_image", lambda: replicate.run(
+            generate_image, PROGRAM_IMAGE_PROMPT, request.input_images_path
+        ))
+        graph.add("habits_image", lambda: replicate.run(
+            generate_image, HABITS_IMAGE_PROMPT, request.input_images_path
+        ))
+
+    if request.include_audio:
+        text_to_speech = clients.get("text_to_speech")
+        speak = text_to_speech.speech_media if by_reference else text_to_speech.text_to_speech
+        tts = clients.executor("tts")
+        for branch in ("program", "habits"):
+            graph.add(f"{branch}_audio", lambda summary: tts.run(
+                speak, summary, request.user_id, request.audio_encoding
+            ), after=[f"{branch}_summary"])
+
+    return graph
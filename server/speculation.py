@@ -0,0 +1,183 @@
+"""Speculative work started for a session before the client asks for it"""
+
+import asyncio
+import os
+import time
+
+
+def _retrieve(task):
+    # Nobody may ever await a speculative task, read its outcome so asyncio does not warn
+    if not task.cancelled():
+        task.exception()
+
+
+class SpeculativeSessions:
+    """
+    Starts the program-independent stages as soon as a user's description arrives.
+
+    The baseline (habits) trajectory only needs the description and the "no
+    program" prompt, and the habits categories only need the description, so both
+    run while the program is being generated and reviewed. Later requests of the
+    same session pick up the results, or wait for them if they are still running.
+
+    A session that is not used for ttl_seconds is considered abandoned and its
+    work is cancelled. Speculative work has its own, smaller executor, so it
+    never takes an admission slot from a request, and yields to requests: it is
+    not started when its executor is full or when foreground requests already
+    keep every worker of the foreground executor busy, and is started by the
+    next POST of the same session instead.
+    """
+
+    def __init__(
+        self, life_simulator, program_generator, executor, foreground=None, ttl_seconds=600, max_sessions=256
+    ):
+        self.life_simulator = life_simulator
+        self.program_generator = program_generator
+        self.executor = executor
+        self.foreground = foreground
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.reaper = None
+        self.stats = {"started": 0, "used": 0, "cancelled": 0, "skipped": 0}
+
+    @classmethod
+    def from_env(cls, life_simulator, program_generator, executor, foreground=None):
+        return cls(
+            life_simulator,
+            program_generator,
+            executor,
+            foreground,
+            ttl_seconds=int(os.getenv("SESSION_TTL_SECONDS", 600)),
+            max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", 256)),
+        )
+
+    def start(self, session_id, user_query, time_horizon) -> list:
+        """
+        Start the speculative stages of a session, returns the names of the ones started.
+
+        Stages skipped for lack of room are started by a later call for the same session.
+        """
+        entry = self.sessions.get(session_id)
+        if entry is not None and entry["user_query"] == user_query and entry["time_horizon"] >= time_horizon:
+            entry["last_seen"] = time.monotonic()
+            return self._start_missing(entry)
+        self.cancel(session_id)
+        while len(self.sessions) >= self.max_sessions:
+            oldest = min(self.sessions, key=lambda key: self.sessions[key]["last_seen"])
+            self.cancel(oldest)
+
+        entry = {
+            "user_query": user_query,
+            "time_horizon": time_horizon,
+            "tasks": {},
+            "last_seen": time.monotonic(),
+        }
+        self.sessions[session_id] = entry
+        return self._start_missing(entry)
+
+    def _start_missing(self, entry) -> list:
+        stages = {"baseline": lambda: self._baseline(entry["user_query"], entry["time_horizon"])}
+        if self.program_generator is not None:
+            stages["habits_category"] = lambda: self.executor.run_admitted(
+                self.program_generator.generate_habits_category, entry["user_query"]
+            )
+        missing = [name for name in stages if name not in entry["tasks"]]
+        if not missing:
+            return []
+        if not self._has_room(len(missing)):
+            self.stats["skipped"] += 1
+            return []
+        for name in missing:
+            task = self._admitted_task(stages[name]())
+            task.add_done_callback(_retrieve)
+            entry["tasks"][name] = task
+        self.stats["started"] += len(missing)
+        return missing
+
+    def _has_room(self, stages):
+        if self.executor.in_flight + stages > self.executor.capacity:
+            return False
+        # Requests are already waiting for a worker, speculating would only slow them down
+        return self.foreground is None or self.foreground.in_flight < self.foreground.max_workers
+
+    def _admitted_task(self, coroutine):
+        # The slot is taken now rather than when the task first runs, so that the
+        # next start sees it, and released once the task ends, even cancelled before running
+        self.executor.acquire()
+        task = asyncio.create_task(coroutine)
+        task.add_done_callback(lambda _: self.executor.release())
+        return task
+
+    async def _baseline(self, user_query, time_horizon):
+        return await self.life_simulator.get_evolution_given_program_async(
+            user_query,
+            self.life_simulator.prompt_no_program,
+            time_horizon,
+            asyncio.Semaphore(self.life_simulator.max_concurrency),
+        )
+
+    async def result(self, session_id, name, user_query, time_horizon=None):
+        """
+        The speculative result for this session, or None if it has to be computed.
+
+        None is returned when the session is unknown, was started for another
+        description or a shorter horizon, or when its speculative stage failed.
+        """
+        entry = self.sessions.get(session_id)
+        if entry is None or entry["user_query"] != user_query or name not in entry["tasks"]:
+            return None
+        if time_horizon is not None and time_horizon > entry["time_horizon"]:
+            return None
+        entry["last_seen"] = time.monotonic()
+        task = entry["tasks"][name]
+        try:
+            # Shielded, a caller going away must not cancel work the session still owns
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception:
+            return None
+        self.stats["used"] += 1
+        if name == "baseline" and time_horizon is not None:
+            result = {key: values[:time_horizon] for key, values in result.items()}
+        return result
+
+    def cancel(self, session_id):
+        entry = self.sessions.pop(session_id, None)
+        if entry is None:
+            return False
+        for task in entry["tasks"].values():
+            if not task.done():
+                task.cancel()
+                self.stats["cancelled"] += 1
+        return True
+
+    def expire(self):
+        """Cancel the sessions that have not been used for ttl_seconds."""
+        now = time.monotonic()
+        for session_id in [
+            session_id
+            for session_id, entry in self.sessions.items()
+            if now - entry["last_seen"] > self.ttl_seconds
+        ]:
+            self.cancel(session_id)
+
+    async def _reap(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
+
+    def start_reaper(self, interval=30):
+        self.reaper = asyncio.create_task(self._reap(interval))
+
+    def stop(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+        for session_id in list(self.sessions):
+            self.cancel(session_id)
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, sessions=len(self.sessions))
@@ -0,0 +1,77 @@
+"""Discrete action space of the simulation"""
+
+DICT_ACTIONS = {
+    "Sleep": [
+        "More than 8 hours on average",
+        "7 to 8 hours on average",
+        "5 to 7 hours on average",
+        "Less than 5 hours on average",
+    ],
+    "Diet": [
+        "Balanced diet on average",
+        "High-protein diet on average",
+        "High-carb diet on average",
+        "High-fat diet on average",
+        "Vegetarian diet on average",
+        "Vegan diet on average",
+    ],
+    "Number of Workouts": [
+        "More than 3 times a week",
+        "2 to 3 times a week",
+        "1 time a week",
+        "No workout",
+    ],
+    "Duration of Workout": [
+        "More than 2 hours",
+        "1 to 2 hours",
+        "30 to 60 minutes",
+        "Less than 30 minutes",
+        "No workout",
+    ],
+    "Smoking": [
+        "No smoking at all",
+        "1 cigarette a week",
+        "1 cigarette a day",
+        "More than 5 cigarettes a day",
+    ],
+}
+
+# Habit levels of every category of LifeSimulator.categories_actions, the vocabulary
+# of the discrete rollouts of an ensemble. Each category also accepts NO_INFORMATION.
+EFFORT_LEVELS = [
+    "Works on it every day",
+    "Works on it a few times a week",
+    "Works on it once a week or less",
+    "No particular effort",
+]
+ACTION_LABELS = {
+    "Sleep": DICT_ACTIONS["Sleep"],
+    "Diet": DICT_ACTIONS["Diet"] + ["Mostly processed food"],
+    "Exercise": DICT_ACTIONS["Number of Workouts"],
+    "Smoking": DICT_ACTIONS["Smoking"],
+    "Alcohol": [
+        "No alcohol at all",
+        "Less than 7 drinks a week",
+        "7 to 14 drinks a week",
+        "More than 14 drinks a week",
+    ],
+    "Social relationships": EFFORT_LEVELS,
+    "Mental health": EFFORT_LEVELS,
+    "Motivation": [
+        "Highly motivated",
+        "Somewhat motivated",
+        "Not motivated",
+    ],
+    "Hydration": [
+        "More than 2 liters a day",
+        "1 to 2 liters a day",
+        "Less than 1 liter a day",
+    ],
+    "Stress management": EFFORT_LEVELS,
+    "Screen time": [
+        "Less than 2 hours a day",
+        "2 to 4 hours a day",
+        "4 to 6 hours a day",
+        "More than 6 hours a day",
+    ],
+}
@@ -0,0 +1,194 @@
+"""Simulation of many personas at once"""
+
+import asyncio
+import json
+
+from llm.parsing import OutputParsingError, parse_json_object
+from simulate_life.simulate_life import GENERATION_CONFIG, LifeSimulator
+
+# Output limit of the Gemini models, a packed prompt cannot ask for more
+MAX_OUTPUT_TOKENS = 8192
+
+
+class NestedLimit:
+    """Takes the batch's own semaphore, then the one shared by every batch of the worker."""
+
+    def __init__(self, *semaphores):
+        self.semaphores = [semaphore for semaphore in semaphores if semaphore is not None]
+
+    async def __aenter__(self):
+        acquired = []
+        try:
+            for semaphore in self.semaphores:
+                await semaphore.acquire()
+                acquired.append(semaphore)
+        except BaseException:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        for semaphore in reversed(self.semaphores):
+            semaphore.release()
+
+
+class BatchSimulator:
+    """
+    Schedule the simulations of a cohort of personas together.
+
+    In the default mode every persona runs its own trajectory and all of them share
+    one concurrency budget. With pack_size > 1, the personas that are at the same
+    week are grouped and each group gets a single prompt for its actions and a
+    single prompt for its next states, so a cohort of N personas costs about
+    2 * N / pack_size calls per week instead of 2 * N.
+
+    A worker builds one BatchSimulator, whose max_concurrency bounds the Gemini
+    calls of all its batches together, whatever each request asks for.
+    """
+
+    def __init__(self, life_simulator: LifeSimulator, max_concurrency=8):
+        self.life_simulator = life_simulator
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def simulate(self, personas: list, pack_size: int = 1, max_concurrency: int = None) -> list:
+        """
+        Simulate every persona and return the results in the same order.
+
+        Args:
+            personas (list): Dicts with initial_state, program and time_horizon.
+            pack_size (int): Number of personas sharing one prompt per step, 1 disables packing.
+            max_concurrency (int): Cap on concurrent Gemini calls for the whole batch, within the shared one.
+
+        Returns:
+            list: {"life_simulation": {...}} or {"error": str} for each persona.
+        """
+        if not personas:
+            return []
+        semaphore = NestedLimit(
+            asyncio.Semaphore(max_concurrency) if max_concurrency else None, self.semaphore
+        )
+        if pack_size > 1:
+            return await self._simulate_packed(personas, pack_size, semaphore)
+
+        results = await asyncio.gather(
+            *[
+                self.life_simulator.get_evolution_given_program_async(
+                    persona["initial_state"],
+                    persona["program"],
+                    persona["time_horizon"],
+                    semaphore,
+                )
+                for persona in personas
+            ],
+            return_exceptions=True,
+        )
+        return [self._result(result) for result in results]
+
+    @staticmethod
+    def _result(result):
+        if isinstance(result, Exception):
+            return {"error": str(result)}
+        return {"life_simulation": result}
+
+    async def _simulate_packed(self, personas, pack_size, semaphore):
+        trajectories = [{"actions": [], "states": []} for _ in personas]
+        states = [persona["initial_state"] for persona in personas]
+        errors = {}
+
+        for week in range(max(persona["time_horizon"] for persona in personas)):
+            active = [
+                i
+                for i, persona in enumerate(personas)
+                if week < persona["time_horizon"] and i not in errors
+            ]
+            groups = [active[i : i + pack_size] for i in range(0, len(active), pack_size)]
+            steps = await asyncio.gather(
+                *[self._packed_step(group, personas, states, semaphore) for group in groups],
+                return_exceptions=True,
+            )
+            for group, step in zip(groups, steps):
+                for i in group:
+                    outcome = step if isinstance(step, Exception) else step[i]
+                    if isinstance(outcome, Exception):
+                        errors[i] = outcome
+                        continue
+                    actions, next_state = outcome
+                    trajectories[i]["actions"].append(actions)
+                    trajectories[i]["states"].append(next_state)
+                    states[i] = next_state
+
+        return [
+            self._result(errors[i]) if i in errors else self._result(trajectories[i])
+            for i in range(len(personas))
+        ]
+
+    async def _packed_step(self, group, personas, states, semaphore) -> dict:
+        """One week for a group of personas: one packed actions call, one packed transition call."""
+        simulator = self.life_simulator
+        generation_config = dict(
+            GENERATION_CONFIG,
+            max_output_tokens=min(GENERATION_CONFIG["max_output_tokens"] * len(group), MAX_OUTPUT_TOKENS),
+        )
+
+        actions_prompt = self.build_packed_actions_prompt(
+            {f"person_{i}": (states[i], personas[i]["program"]) for i in group}
+        )
+        packed_actions = self._parse_packed(
+            await simulator.generate_content_async(
+                actions_prompt, semaphore, generation_config, stage="actions"
+            )
+        )
+
+        actions = {}
+        for i in group:
+            try:
+                person_actions = simulator.parse_actions(json.dumps(packed_actions[f"person_{i}"]))
+            except (KeyError, OutputParsingError):
+                # The model skipped this persona, fall back to the single-persona prompt.
+                person_actions = await simulator.choose_actions_async(
+                    states[i], personas[i]["program"], semaphore
+                )
+            actions[i] = person_actions
+
+        next_state_prompt = self.build_packed_next_state_prompt(
+            {f"person_{i}": (states[i], actions[i]) for i in group}
+        )
+        packed_states = self._parse_packed(
+            await simulator.generate_content_async(next_state_prompt, semaphore, generation_config)
+        )
+
+        outcomes = {}
+        for i in group:
+            next_state = packed_states.get(f"person_{i}")
+            if not isinstance(next_state, str):
+                next_state = await simulator.determine_next_state_async(
+                    states[i], actions[i], semaphore
+                )
+            outcomes[i] = (actions[i], next_state)
+        return outcomes
+
+    @staticmethod
+    def _parse_packed(text: str) -> dict:
+        try:
+            return parse_json_object(text)
+        except OutputParsingError:
+            return {}
+
+    def build_packed_actions_prompt(self, people: dict) -> str:
+        described = "\n".join(
+            f"- { person_id } : state : { state }. Recommendations from their personal coach : { json.dumps(program) }."
+            for person_id, (state, program) in people.items()
+        )
+        return f"""I present you several people, each with a state that describes their health state and habits and the recommendations they received from their personal coach :
+{ described }
+These are ideal programs, which means that each person might not be able to respect each step of their program (it depends on their motivation, their objectives, etc… and all information that you can find in their state. For each person independently, your goal is to find the realistic actions that they are going to do during the next week, based on their current state and their program. Your goal is not to take the optimal actions but the most realistic ones based on their characteristics. The actions are split into different categories : { self.life_simulator.categories_actions }. For each category, you must choose 1 and only 1 action to take, the one that is the most probable according to you. If you do not have any information on a given category, return 'I do not have any information on that category' and do not invent anything. You may decide not to do anything : if so, you must specify it by returning 'none' for the concerned category. When returning the actions, you must use the first person at the present time. You must output a single json object whose keys are the person identifiers ({ ", ".join(people) }) and whose values are json objects of the form {{"category_1": "action_1", "category_2": "action_2", etc…}}."""
+
+    def build_packed_next_state_prompt(self, people: dict) -> str:
+        described = "\n".join(
+            f"- { person_id } : state at the beginning of the week : { state }. Actions taken during the week : { actions }."
+            for person_id, (state, actions) in people.items()
+        )
+        return f"""I present you several people, each with the state that describes the health state and habits that they had at the beginning of the week and the actions they took during this week regarding different categories :
+{ described }
+These actions are all they did during this week. You must not assume that they did something else during this week. For each person independently, your goal is to determine their state at the end of the week. This new state must take into account their characteristics and the actions that they have taken during the week. Be careful and take into consideration that turning an action into a habit takes times, so their state cannot change drastically in a week. If a category contains 'I do not have any information on that category', do not take it into consideration. You must not invent something for those categories. Each result must be the realistic and probable one, detailed and precise but as concise as possible, and written in the first person at the present time. You must output a single json object whose keys are the person identifiers ({ ", ".join(people) }) and whose values are the new states as strings."""
@@ -0,0 +1,140 @@
+"""Monte Carlo ensembles of life simulations"""
+
+import asyncio
+import re
+from collections import Counter
+
+from simulate_life.simulate_life import LifeSimulator
+
+
+def normalize_action(action) -> str:
+    """Lowercase and strip punctuation so that rewordings of the same action are counted together."""
+    return re.sub(r"[^\w\s]", "", str(action).lower()).strip()
+
+
+def action_frequencies(rollouts: list, time_horizon: int) -> list:
+    """Per week and per category, the share of rollouts that took each action."""
+    weeks = []
+    for week in range(time_horizon):
+        counters = {}
+        for rollout in rollouts:
+            for category, action in rollout["actions"][week].items():
+                counters.setdefault(category, Counter())[normalize_action(action)] += 1
+        weeks.append({
+            category: {action: count / len(rollouts) for action, count in counter.items()}
+            for category, counter in counters.items()
+        })
+    return weeks
+
+
+def max_distance(previous: list, current: list) -> float:
+    """Largest total variation distance between two sets of per-week, per-category distributions."""
+    distance = 0.0
+    for previous_week, current_week in zip(previous, current):
+        for category in set(previous_week) | set(current_week):
+            p = previous_week.get(category, {})
+            q = current_week.get(category, {})
+            tv = 0.5 * sum(abs(p.get(a, 0.0) - q.get(a, 0.0)) for a in set(p) | set(q))
+            distance = max(distance, tv)
+    return distance
+
+
+class EnsembleSimulator:
+    """
+    Runs several rollouts of the same (initial_state, program) until the actions stabilise.
+
+    Sampled free text almost never repeats word for word, so rollouts are discrete:
+    each week the model picks one of the ACTION_LABELS of every category, enforced
+    by the response schema, and the distributions compare like with like. Rollout
+    0 uses the default temperature, so it is shared with any earlier ensemble of
+    the same request through the response cache. The others are sampled with a
+    higher temperature and their own seed, in batches, until adding a batch moves
+    no per-week label distribution by more than tolerance (total variation distance).
+    """
+
+    def __init__(self, life_simulator: LifeSimulator, temperature=0.9, max_concurrency=4):
+        self.life_simulator = life_simulator
+        self.temperature = temperature
+        self.max_concurrency = max_concurrency
+
+    async def rollout(self, initial_state, program, time_horizon, index, semaphore):
+        config_overrides = None
+        if index > 0:
+            config_overrides = {"temperature": self.temperature, "seed": index}
+        weeks = [
+            week
+            async for week in self.life_simulator.iter_evolution_given_program_async(
+                initial_state, program, time_horizon, semaphore, config_overrides=config_overrides, discrete=True
+            )
+        ]
+        return {
+            "actions": [week["actions"] for week in weeks],
+            "states": [week["state"] for week in weeks],
+        }
+
+    async def run(
+        self,
+        initial_state: str,
+        program: str,
+        time_horizon: int,
+        max_rollouts: int = 8,
+        min_rollouts: int = 3,
+        batch_size: int = 2,
+        tolerance: float = 0.1,
+    ) -> dict:
+        """
+        Sample rollouts until the per-week action label distributions stabilise.
+
+        Args:
+            initial_state (str): Initial state at t=0.
+            program (str): Program recommended by the first LLM.
+            time_horizon (int): Number of time steps to consider.
+            max_rollouts (int): Hard cap K on the number of rollouts.
+            min_rollouts (int): Rollouts to run before stopping is considered.
+            batch_size (int): Rollouts added between two stability checks.
+            tolerance (float): Largest change in distribution accepted as stable.
+
+        Returns:
+            dict: Per-week action frequencies, representative states and the number of rollouts used.
+        """
+        if min_rollouts > max_rollouts:
+            raise ValueError(f"min_rollouts ({min_rollouts}) must not exceed max_rollouts ({max_rollouts})")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        rollouts = []
+        frequencies = None
+        converged = False
+
+        while len(rollouts) < max_rollouts:
+            size = min_rollouts if not rollouts else batch_size
+            size = min(size, max_rollouts - len(rollouts))
+            batch = await asyncio.gather(
+                *[
+                    self.rollout(initial_state, program, time_horizon, len(rollouts) + i, semaphore)
+                    for i in range(size)
+                ]
+            )
+            rollouts.extend(batch)
+            previous, frequencies = frequencies, action_frequencies(rollouts, time_horizon)
+            if previous is not None and max_distance(previous, frequencies) <= tolerance:
+                converged = True
+                break
+
+        return {
+            "rollouts": len(rollouts),
+            "converged": converged,
+            "frequencies": frequencies,
+            "representative_states": self.representative_states(rollouts, frequencies, time_horizon),
+        }
+
+    @staticmethod
+    def representative_states(rollouts, frequencies, time_horizon) -> list:
+        """For each week, the state of the rollout whose actions are the most common ones."""
+        states = []
+        for week in range(time_horizon):
+            def typicality(rollout):
+                return sum(
+                    frequencies[week][category][normalize_action(action)]
+                    for category, action in rollout["actions"][week].items()
+                )
+            states.append(max(rollouts, key=typicality)["states"][week])
+        return states
@@ -0,0 +1,75 @@
+"""Compare the two-call and fused step modes of the LifeSimulator"""
+
+import asyncio
+import json
+import time
+
+from simulate_life.explo.input_examples import (
+    EXAMPLE_INITIAL_STATE,
+    EXAMPLE_PROGRAM,
+    EXAMPLE_TIME_HORIZON,
+)
+from simulate_life.simulate_life import SYSTEM_INSTRUCTION, LifeSimulator
+
+
+class CountingModel:
+    """Wraps a GenerativeModel to count the calls and the input/output tokens."""
+
+    def __init__(self, model):
+        self.model = model
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    async def generate_content_async(self, contents, generation_config):
+        self.calls += 1
+        response = await self.model.generate_content_async(
+            contents, generation_config=generation_config
+        )
+        self.prompt_tokens += response.usage_metadata.prompt_token_count
+        self.output_tokens += response.usage_metadata.candidates_token_count
+        return response
+
+
+async def run_mode(step_mode, initial_state, program, time_horizon):
+    simulator = LifeSimulator(step_mode=step_mode)
+    # Every stage is routed to the same model here, count the calls on the router's instance
+    model_name = simulator.router.model_name("actions")
+    model = CountingModel(simulator.router.model(model_name, SYSTEM_INSTRUCTION))
+    simulator.router.models[(model_name, SYSTEM_INSTRUCTION)] = model
+    start = time.perf_counter()
+    weeks = []
+    async for week in simulator.iter_evolution_given_program_async(
+        initial_state, program, time_horizon
+    ):
+        weeks.append(week)
+    elapsed = time.perf_counter() - start
+    return {
+        "step_mode": step_mode,
+        "seconds": round(elapsed, 2),
+        "seconds_per_week": round(elapsed / time_horizon, 2),
+        "calls": model.calls,
+        "prompt_tokens": model.prompt_tokens,
+        "output_tokens": model.output_tokens,
+        "categories_answered": sum(
+            1
+            for week in weeks
+            for action in week["actions"].values()
+            if action != "I do not have any information on that category"
+        ),
+        "final_state": weeks[-1]["state"],
+    }
+
+
+async def compare(initial_state, program, time_horizon):
+    return [
+        await run_mode(step_mode, initial_state, program, time_horizon)
+        for step_mode in ("two_call", "fused")
+    ]
+
+
+if __name__ == "__main__":
+    results = asyncio.run(
+        compare(EXAMPLE_INITIAL_STATE, EXAMPLE_PROGRAM, EXAMPLE_TIME_HORIZON)
+    )
+    print(json.dumps(results, indent=2))
@@ -5,6 +5,8 @@ from typing import Any
 import vertexai
 from vertexai.preview.generative_models import GenerativeModel
 
+from simulate_life.action_space import DICT_ACTIONS
+
 PROJECT_ID = "mistral-alan-hack24par-810"
 REGION = "us-central1"
 vertexai.init(project=PROJECT_ID, location=REGION)
@@ -13,42 +15,6 @@ model = GenerativeModel(
     system_instruction="You are a helpful assistant that can answer questions and help with tasks.",
 )
 
-DICT_ACTIONS = {
-    "Sleep": [
-        "More than 8 hours on average",
-        "7 to 8 hours on average",
-        "5 to 7 hours on average",
-        "Less than 5 hours on average",
-    ],
-    "Diet": [
-        "Balanced diet on average",
-        "High-protein diet on average",
-        "High-carb diet on average",
-        "High-fat diet on average",
-        "Vegetarian diet on average",
-        "Vegan diet on average",
-    ],
-    "Number of Workouts": [
-        "More than 3 times a week",
-        "2 to 3 times a week",
-        "1 time a week",
-        "No workout",
-    ],
-    "Duration of Workout": [
-        "More than 2 hours",
-        "1 to 2 hours",
-        "30 to 60 minutes",
-        "Less than 30 minutes",
-        "No workout",
-    ],
-    "Smoking": [
-        "No smoking at all",
-        "1 cigarette a week",
-        "1 cigarette a day",
-        "More than 5 cigarettes a day",
-    ],
-}
-
 INITIAL_STATE = "I do not have a good hygiene of life. I do not sleep much, and because of my work I cannot sleep more than 6 hours a night. I smoke a lot of cigarettes (I cannot stop smoking). I eat a lot of processed food but I want to start eating healthy. I really want to start exercising."
 
 PROGRAM = """Lifestyle
@@ -0,0 +1,251 @@
+"""LLM-free simulation over the discrete action space"""
+
+import difflib
+import json
+
+import numpy as np
+
+from simulate_life.action_space import DICT_ACTIONS
+
+CATEGORIES = list(DICT_ACTIONS)
+# Categories whose options are not ordered from best to worst, a program jumps straight to the target
+CATEGORICAL = {"Diet"}
+# LifeSimulator categories whose ACTION_LABELS are options of a DICT_ACTIONS category.
+# The simulator has no workout duration, and its other categories are not in this space.
+SIMULATOR_CATEGORIES = {
+    "Sleep": "Sleep",
+    "Diet": "Diet",
+    "Exercise": "Number of Workouts",
+    "Smoking": "Smoking",
+}
+
+
+class UnknownActionError(ValueError):
+    """Raised when an action does not match any option of its category."""
+
+
+def match_action(category: str, action: str):
+    """
+    Map a free-text action to its index in DICT_ACTIONS[category].
+
+    Returns None when nothing in the category is close enough.
+    """
+    options = [option.lower() for option in DICT_ACTIONS[category]]
+    matches = difflib.get_close_matches(action.strip().lower(), options, n=1, cutoff=0.6)
+    return options.index(matches[0]) if matches else None
+
+
+def match_known_action(category: str, action: str) -> int:
+    """Same as match_action, but raises UnknownActionError instead of returning None."""
+    if category not in DICT_ACTIONS:
+        raise UnknownActionError(f"Unknown category {category!r}, expected one of {CATEGORIES}")
+    level = match_action(category, action)
+    if level is None:
+        raise UnknownActionError(
+            f"{category}: {action!r} matches none of {DICT_ACTIONS[category]}"
+        )
+    return level
+
+
+def encode_actions(actions: dict) -> np.ndarray:
+    """
+    Turn a {category: action} dict into a vector of action indices.
+
+    Every category is required. Index 0 is the best habit, so guessing a missing
+    or misspelled action would silently make the preview look better.
+    """
+    unknown = set(actions) - set(CATEGORIES)
+    if unknown:
+        raise UnknownActionError(f"Unknown categories {sorted(unknown)}, expected {CATEGORIES}")
+    missing = [category for category in CATEGORIES if category not in actions]
+    if missing:
+        raise UnknownActionError(f"Missing actions for {missing}")
+    return np.array(
+        [match_known_action(category, actions[category]) for category in CATEGORIES], dtype=np.int64
+    )
+
+
+def from_simulator_actions(actions: dict) -> dict:
+    """Rename the categories of a week of LifeSimulator actions to DICT_ACTIONS, dropping the others."""
+    return {
+        SIMULATOR_CATEGORIES[category]: action
+        for category, action in actions.items()
+        if category in SIMULATOR_CATEGORIES
+    }
+
+
+def decode_actions(levels) -> dict:
+    return {
+        category: DICT_ACTIONS[category][int(level)]
+        for category, level in zip(CATEGORIES, levels)
+    }
+
+
+class TransitionModel:
+    """
+    Markov model of week-to-week actions, one transition matrix per category.
+
+    matrices[category][i, j] is the probability of taking action j next week when
+    action i was taken this week.
+    """
+
+    def __init__(self, matrices: dict):
+        self.matrices = {
+            category: np.asarray(matrices[category], dtype=np.float64) for category in CATEGORIES
+        }
+        for category, matrix in self.matrices.items():
+            size = len(DICT_ACTIONS[category])
+            if matrix.shape != (size, size):
+                raise ValueError(f"{category} needs a {size}x{size} matrix, got {matrix.shape}")
+            self.matrices[category] = matrix / matrix.sum(axis=1, keepdims=True)
+
+    @classmethod
+    def sticky(cls, inertia=0.9):
+        """Keep doing the same thing with probability inertia, otherwise pick any other action."""
+        matrices = {}
+        for category, options in DICT_ACTIONS.items():
+            size = len(options)
+            matrix = np.full((size, size), (1 - inertia) / (size - 1))
+            np.fill_diagonal(matrix, inertia)
+            matrices[category] = matrix
+        return cls(matrices)
+
+    @classmethod
+    def towards(cls, targets: dict, adherence=0.3, inertia=0.9):
+        """
+        Follow a program: each week, move one action closer to the target with probability adherence.
+
+        Categorical categories (CATEGORICAL) have no order between their options,
+        they move straight to the target instead.
+
+        Args:
+            targets (dict): {category: target action text or index}, other categories are sticky.
+                A text that matches no option raises UnknownActionError.
+            adherence (float): Probability of making progress in a given week.
+            inertia (float): Probability of not changing for categories without a target.
+        """
+        model = cls.sticky(inertia)
+        for category, target in targets.items():
+            if isinstance(target, str):
+                target = match_known_action(category, target)
+            size = len(DICT_ACTIONS[category])
+            matrix = np.zeros((size, size))
+            for level in range(size):
+                step = int(np.sign(target - level))
+                matrix[level, level] += 1 - adherence if step else 1
+                if step:
+                    matrix[level, target if category in CATEGORICAL else level + step] += adherence
+            model.matrices[category] = matrix
+        return model
+
+    @classmethod
+    def fit(cls, trajectories: list, smoothing=1.0):
+        """
+        Estimate the matrices from trajectories already in the DICT_ACTIONS categories.
+
+        Args:
+            trajectories (list): Lists of weekly {category: action} dicts. Actions that do
+                not match the action space are skipped. See from_rollouts for simulator output.
+            smoothing (float): Count added to every transition (Laplace smoothing).
+        """
+        counts = {
+            category: np.full((len(options), len(options)), smoothing)
+            for category, options in DICT_ACTIONS.items()
+        }
+        for weeks in trajectories:
+            for previous, current in zip(weeks, weeks[1:]):
+                for category in CATEGORIES:
+                    if category not in previous or category not in current:
+                        continue
+                    i = match_action(category, previous[category])
+                    j = match_action(category, current[category])
+                    if i is not None and j is not None:
+                        counts[category][i, j] += 1
+        return cls(counts)
+
+    @classmethod
+    def from_rollouts(cls, rollouts: list, smoothing=1.0):
+        """
+        Estimate the matrices from discrete LLM rollouts, as kept by EnsembleSimulator.
+
+        Only the categories of SIMULATOR_CATEGORIES are learned from the rollouts,
+        the other rows keep the uniform smoothing prior.
+
+        Args:
+            rollouts (list): {"actions": [weekly {category: action label}]} dicts.
+            smoothing (float): Count added to every transition (Laplace smoothing).
+        """
+        trajectories = [
+            [from_simulator_actions(actions) for actions in rollout["actions"]] for rollout in rollouts
+        ]
+        return cls.fit(trajectories, smoothing)
+
+    def to_dict(self) -> dict:
+        return {category: matrix.tolist() for category, matrix in self.matrices.items()}
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls(json.load(file))
+
+
+class FastSimulator:
+    """Vectorized Monte Carlo simulation of many personas with a TransitionModel."""
+
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def simulate(self, initial_levels, model: TransitionModel, time_horizon: int) -> np.ndarray:
+        """
+        Simulate every persona for time_horizon weeks.
+
+        Args:
+            initial_levels (np.ndarray): (n_personas, n_categories) action indices at t=0.
+            model (TransitionModel): Transition model to sample from.
+            time_horizon (int): Number of weeks.
+
+        Returns:
+            np.ndarray: (n_personas, time_horizon, n_categories) action indices for each week.
+        """
+        current = np.array(initial_levels, dtype=np.int64, copy=True)
+        # Every category has fewer than 128 options, int8 keeps large populations small
+        trajectory = np.empty((current.shape[0], time_horizon, len(CATEGORIES)), dtype=np.int8)
+        cdfs = [np.cumsum(model.matrices[category], axis=1) for category in CATEGORIES]
+        for week in range(time_horizon):
+            draws = self.rng.random(current.shape)
+            for c, cdf in enumerate(cdfs):
+                # Inverse-CDF sampling for all personas at once
+                rows = cdf[current[:, c]]
+                current[:, c] = np.minimum((draws[:, c : c + 1] > rows).sum(axis=1), cdf.shape[0] - 1)
+            trajectory[:, week] = current
+        return trajectory
+
+    def frequencies(self, trajectory: np.ndarray) -> list:
+        """Share of personas taking each action, per week and per category."""
+        weeks = []
+        for week in range(trajectory.shape[1]):
+            weeks.append({
+                category: dict(zip(
+                    DICT_ACTIONS[category],
+                    np.bincount(trajectory[:, week, c], minlength=len(DICT_ACTIONS[category]))
+                    / trajectory.shape[0],
+                ))
+                for c, category in enumerate(CATEGORIES)
+            })
+        return weeks
+
+    def preview(self, initial_actions: dict, time_horizon: int, model: TransitionModel, n_personas=1000) -> dict:
+        """Population preview for one starting point: weekly action frequencies and one sample path."""
+        initial_levels = np.tile(encode_actions(initial_actions), (n_personas, 1))
+        trajectory = self.simulate(initial_levels, model, time_horizon)
+        return {
+            "frequencies": [
+                {category: {action: float(share) for action, share in shares.items()} for category, shares in week.items()}
+                for week in self.frequencies(trajectory)
+            ],
+            "sample": [decode_actions(levels) for levels in trajectory[0]],
+        }
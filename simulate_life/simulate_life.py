@@ -1,10 +1,22 @@
 # %%
+import asyncio
+import contextlib
 import vertexai
-from vertexai.preview.generative_models import GenerativeModel
 import json
 from dotenv import load_dotenv
 import os
 
+from llm.metrics import record_usage, span, timed
+from llm.resilience import ResilientCaller
+from llm.routing import ModelRouter
+from llm.parsing import (
+    NO_INFORMATION,
+    OutputParsingError,
+    parse_json_object,
+    validate_actions,
+    validate_fused_step,
+)
+from simulate_life.action_space import ACTION_LABELS, EFFORT_LEVELS
 from simulate_life.explo.input_examples import (
     EXAMPLE_INITIAL_STATE,
     EXAMPLE_INITIAL_STATE_2,
@@ -13,32 +25,87 @@ from simulate_life.explo.input_examples import (
 )
 
 
-def extract_dict_from_actions(actions: str):
-    start_index = actions.find("{")
-    end_index = actions.rfind("}")
+def format_actions_output(actions: str, categories: list = None) -> dict:
+    dict_actions = parse_json_object(actions)
+    if categories is not None:
+        return validate_actions(dict_actions, categories)
+    return dict_actions
+
+
+MODEL_NAME = "gemini-1.5-pro-002"
+SYSTEM_INSTRUCTION = "You are a helpful assistant that can answer questions and help with tasks."
+GENERATION_CONFIG = {
+    "max_output_tokens": 512,
+    "temperature": 0.3,
+    "top_p": 0.95,
+}
+STEP_MODES = ("two_call", "fused")
+
+
+def actions_schema(categories: list) -> dict:
+    return {
+        "type": "OBJECT",
+        "properties": {category: {"type": "STRING"} for category in categories},
+        "required": list(categories),
+    }
+
 
-    if start_index != -1 and end_index != -1 and start_index < end_index:
-        return actions[start_index : end_index + 1]
-    else:
-        return ""
+def discrete_actions_schema(categories: list) -> dict:
+    """{category: label} with the label taken from ACTION_LABELS, or NO_INFORMATION."""
+    return {
+        "type": "OBJECT",
+        "properties": {
+            category: {"type": "STRING", "enum": ACTION_LABELS.get(category, EFFORT_LEVELS) + [NO_INFORMATION]}
+            for category in categories
+        },
+        "required": list(categories),
+    }
 
 
-def format_actions_output(actions: str) -> dict:
-    dict_actions = extract_dict_from_actions(actions)
-    dict_actions
-    return json.loads(dict_actions)
+def actions_generation_config(categories: list, discrete=False, **overrides) -> dict:
+    """Generation config constraining the output to {category: action}, or {category: label} when discrete."""
+    return dict(
+        GENERATION_CONFIG,
+        response_mime_type="application/json",
+        response_schema=(discrete_actions_schema if discrete else actions_schema)(categories),
+        **overrides,
+    )
+
+
+def fused_generation_config(categories: list) -> dict:
+    """Generation config constraining a fused step to {"actions": {category: str}, "next_state": str}."""
+    return dict(
+        GENERATION_CONFIG,
+        max_output_tokens=1024,
+        response_mime_type="application/json",
+        response_schema={
+            "type": "OBJECT",
+            "properties": {
+                "actions": actions_schema(categories),
+                "next_state": {"type": "STRING"},
+            },
+            "required": ["actions", "next_state"],
+        },
+    )
 
 
 class LifeSimulator:
-    def __init__(self, env_file="conf.env"):
+    def __init__(self, env_file="conf.env", max_concurrency=2, cache=None, step_mode="two_call", prefix_cache=None, resilience=None, router=None):
         load_dotenv(env_file)
         PROJECT_ID = os.getenv("PROJECT_ID")
         REGION = os.getenv("LOCATION")
         vertexai.init(project=PROJECT_ID, location=REGION)
-        self.model = GenerativeModel(
-            "gemini-1.5-pro-002",
-            system_instruction="You are a helpful assistant that can answer questions and help with tasks.",
-        )
+        # Optional llm.cache.ResponseCache shared with the other generators.
+        self.cache = cache
+        # Optional llm.prompt_cache.PromptPrefixCache, the static part of each prompt
+        # (instructions, categories, program) is then registered once per simulation.
+        self.prefix_cache = prefix_cache
+        # llm.resilience.ResilientCaller putting deadlines, retries, hedging and a circuit
+        # breaker around every Gemini call, normally shared by all the Gemini clients.
+        self.resilience = resilience or ResilientCaller()
+        # llm.routing.ModelRouter choosing the model of each stage (actions, transition,
+        # step, repair), by default every stage keeps MODEL_NAME.
+        self.router = router or ModelRouter()
         self.categories_actions = [
             "Sleep",
             "Diet",
@@ -53,17 +120,206 @@ class LifeSimulator:
             "Screen time",
         ]
         self.prompt_no_program = """Keep doing exactly what you are doing."""
+        # Maximum number of Gemini calls in flight for one async pipeline run.
+        # Two is enough for the habits and program branches to never wait on each other.
+        self.max_concurrency = max_concurrency
+        # "two_call" asks for the actions then for the next state, "fused" gets both
+        # from a single schema-constrained call and halves the round trips per week.
+        if step_mode not in STEP_MODES:
+            raise ValueError(f"step_mode must be one of {STEP_MODES}, got {step_mode!r}")
+        self.step_mode = step_mode
+        self.fused_generation_config = fused_generation_config(self.categories_actions)
+        self.actions_generation_config = actions_generation_config(self.categories_actions)
+        # A failed step is repaired deterministically
+        self.repair_generation_config = actions_generation_config(self.categories_actions, temperature=0)
+        # Discrete steps pick one of the ACTION_LABELS of each category instead of writing free text
+        self.discrete_actions_generation_config = actions_generation_config(self.categories_actions, discrete=True)
+        self.discrete_repair_generation_config = actions_generation_config(
+            self.categories_actions, discrete=True, temperature=0
+        )
 
-    def generate_content(self, text):
-        response = self.model.generate_content(
-            [text],
-            generation_config={
-                "max_output_tokens": 512,
-                "temperature": 0.3,
-                "top_p": 0.95,
-            },
+    def cache_key(self, text, generation_config, model_name=MODEL_NAME):
+        return self.cache.make_key(model_name, SYSTEM_INSTRUCTION, text, generation_config)
+
+    def generate_content(self, text, generation_config=GENERATION_CONFIG, prefix=None, stage="transition"):
+        model_name = self.router.model_name(stage)
+
+        def generate():
+            model, contents = self.router.model(model_name, SYSTEM_INSTRUCTION), (prefix or "") + text
+            if prefix and self.prefix_cache is not None:
+                prefixed_model = self.prefix_cache.model_for(model_name, SYSTEM_INSTRUCTION, prefix)
+                if prefixed_model is not None:
+                    model, contents = prefixed_model, text
+            with span(f"generate.{stage}") as timing:
+                response = self.resilience.call(
+                    model.generate_content,
+                    [contents],
+                    generation_config=generation_config,
+                    stage=stage,
+                )
+            self.router.record(stage, model_name, timing.seconds)
+            record_usage(model_name, stage, response)
+            return response.candidates[0].content.parts[0].text
+
+        if self.cache is None:
+            return generate()
+        return self.cache.get_or_compute(
+            self.cache_key((prefix or "") + text, generation_config, model_name), generate
+        )
+
+    async def generate_content_async(
+        self, text, semaphore=None, generation_config=GENERATION_CONFIG, prefix=None, stage="transition"
+    ):
+        model_name = self.router.model_name(stage)
+
+        async def generate():
+            model, contents = self.router.model(model_name, SYSTEM_INSTRUCTION), (prefix or "") + text
+            if prefix and self.prefix_cache is not None:
+                found, prefixed_model = self.prefix_cache.cached(model_name, SYSTEM_INSTRUCTION, prefix)
+                if not found:
+                    # Registration is a blocking call, but only happens once per prefix
+                    prefixed_model = await asyncio.to_thread(
+                        self.prefix_cache.model_for, model_name, SYSTEM_INSTRUCTION, prefix
+                    )
+                if prefixed_model is not None:
+                    model, contents = prefixed_model, text
+            async with semaphore or contextlib.nullcontext():
+                with span(f"generate.{stage}") as timing:
+                    response = await self.resilience.call_async(
+                        model.generate_content_async,
+                        [contents],
+                        generation_config=generation_config,
+                        stage=stage,
+                    )
+            self.router.record(stage, model_name, timing.seconds)
+            record_usage(model_name, stage, response)
+            return response.candidates[0].content.parts[0].text
+
+        if self.cache is None:
+            return await generate()
+        return await self.cache.get_or_compute_async(
+            self.cache_key((prefix or "") + text, generation_config, model_name), generate
+        )
+
+    @timed("simulate.prompt")
+    def actions_prompt_parts(self, state: str, program: str) -> tuple:
+        """Static prefix (instructions, categories, program) and per-week delta (state) of the actions prompt."""
+        prefix = f"""Someone received those recommendations from their personal coach: { json.dumps(program) }. This is an ideal program, which means that they might not be able to respect each step of the program (it depends on their motivation, their objectives, etc… and all information that you can find in their state. Your goal is to find the realistic actions that they are going to do during the next week, based on their current state and the program they are given. Your goal is not to take the optimal actions but the most realistic ones based on their characteristics. The actions are split into different categories : { self.categories_actions }. For each category, you must choose 1 and only 1 action to take, the one that is the most probable according to you. If you do not have any information on a given category, return 'I do not have any information on that category' and do not invent anything. You may decide not to do anything : if so, you must specify it by returning 'none' for the concerned category. When returning the actions, you must use the first person at the present time. You must then output your actions as a string with the following json format (without forgetting the brackets) : "category_1" : 'action_1', "category_2": 'action_2', etc… """
+        delta = f"""Here is their state that describes their health state and habits : { state }"""
+        return prefix, delta
+
+    @timed("simulate.prompt")
+    def next_state_prompt_parts(self, state: str, actions: dict) -> tuple:
+        """Static prefix (instructions) and per-week delta (state and actions) of the transition prompt."""
+        prefix = """I will present you someone's state that describes the health state and habits that they had at the beginning of a week, and the actions they took during this week regarding different categories. These actions are all they did during this week. You must not assume that they did something else during this week. Your goal is to determine their state at the end of the week. This new state must take into account their characteristics and the actions that they have taken during the week. Be careful and take into consideration that turning an action into a habit takes times, so their state cannot change drastically in a week. If a category contains 'I do not have any information on that category', do not take it into consideration. You must not invent something for those categories, so do not write something if you do not have any information on it. Your result must then be the realistic and probable one. You should then output the new state as a string. The format must be detailed and precise but as concise as possible. And finally, you must use the first person at the present time. """
+        delta = f"""State at the beginning of the week : { state }. Actions taken during this week : { actions }."""
+        return prefix, delta
+
+    @timed("simulate.prompt")
+    def fused_prompt_parts(self, state: str, program: str) -> tuple:
+        """Static prefix (instructions, categories, program) and per-week delta (state) of the fused prompt."""
+        prefix = f"""Someone received those recommendations from their personal coach: { json.dumps(program) }. This is an ideal program, which means that they might not be able to respect each step of the program (it depends on their motivation, their objectives, etc… and all information that you can find in their state. You have two goals. First, find the realistic actions that they are going to do during this week, based on their current state and the program they are given. Your goal is not to take the optimal actions but the most realistic ones based on their characteristics. The actions are split into different categories : { self.categories_actions }. For each category, you must choose 1 and only 1 action to take, the one that is the most probable according to you. If you do not have any information on a given category, return 'I do not have any information on that category' and do not invent anything. You may decide not to do anything : if so, you must specify it by returning 'none' for the concerned category. Second, determine their state at the end of the week. These actions are all they did during this week, you must not assume that they did something else. The new state must take into account their characteristics and the actions that they have taken during the week. Be careful and take into consideration that turning an action into a habit takes times, so their state cannot change drastically in a week. Do not take into consideration the categories for which you do not have any information and do not invent something for them. The new state must be the realistic and probable one, detailed and precise but as concise as possible. Everything must be written in the first person at the present time. You must output a json object with the key "actions", mapping each category to its action, and the key "next_state", containing the new state as a string. """
+        delta = f"""Here is their state that describes their health state and habits at the beginning of the week : { state }"""
+        return prefix, delta
+
+    def build_actions_prompt(self, state: str, program: str) -> str:
+        return "".join(self.actions_prompt_parts(state, program))
+
+    def build_next_state_prompt(self, state: str, actions: dict) -> str:
+        return "".join(self.next_state_prompt_parts(state, actions))
+
+    def build_fused_prompt(self, state: str, program: str) -> str:
+        return "".join(self.fused_prompt_parts(state, program))
+
+    def parse_fused_output(self, output: str) -> tuple:
+        return validate_fused_step(parse_json_object(output), self.categories_actions)
+
+    def parse_actions(self, output: str) -> dict:
+        return format_actions_output(output, self.categories_actions)
+
+    def repair_prompt_parts(self, state: str, program: str) -> tuple:
+        prefix, delta = self.actions_prompt_parts(state, program)
+        return prefix, delta + f""" Answer only with a json object whose keys are exactly { json.dumps(self.categories_actions) } and whose values are the actions as strings."""
+
+    def repair_actions(self, state: str, program: str) -> dict:
+        """Re-issue only the actions step with a schema-constrained prompt after an unparsable answer."""
+        prefix, delta = self.repair_prompt_parts(state, program)
+        return self.parse_actions(
+            self.generate_content(delta, self.repair_generation_config, prefix, stage="repair")
+        )
+
+    async def repair_actions_async(self, state: str, program: str, semaphore=None, discrete=False) -> dict:
+        prefix, delta = self.repair_prompt_parts(state, program)
+        generation_config = self.discrete_repair_generation_config if discrete else self.repair_generation_config
+        return self.parse_actions(
+            await self.generate_content_async(delta, semaphore, generation_config, prefix, stage="repair")
+        )
+
+    def choose_actions(self, state: str, program: str) -> dict:
+        """Validated actions dict for the week, repairing only this step if the answer is unusable."""
+        try:
+            return self.parse_actions(self.get_actions_from_program_and_state(state, program))
+        except OutputParsingError:
+            self.router.record_failure("actions")
+            return self.repair_actions(state, program)
+
+    async def choose_actions_async(
+        self, state: str, program: str, semaphore=None, config_overrides=None, discrete=False
+    ) -> dict:
+        try:
+            return self.parse_actions(
+                await self.get_actions_from_program_and_state_async(
+                    state, program, semaphore, config_overrides, discrete
+                )
+            )
+        except OutputParsingError:
+            self.router.record_failure("actions")
+            return await self.repair_actions_async(state, program, semaphore, discrete)
+
+    def step(self, state: str, program: str) -> tuple:
+        """
+        Simulate one week.
+
+        Args:
+            state (str): State at the beginning of the week.
+            program (str): Program recommended by the first LLM.
+
+        Returns:
+            tuple: The actions dict taken during the week and the state at the end of it.
+        """
+        if self.step_mode == "fused":
+            prefix, delta = self.fused_prompt_parts(state, program)
+            output = self.generate_content(delta, self.fused_generation_config, prefix, stage="step")
+            try:
+                return self.parse_fused_output(output)
+            except OutputParsingError:
+                # Redo this week only, with the two-call steps below
+                self.router.record_failure("step")
+        actions = self.choose_actions(state, program)
+        return actions, self.determine_next_state(state, actions)
+
+    async def step_async(
+        self, state: str, program: str, semaphore=None, config_overrides=None, discrete=False
+    ) -> tuple:
+        # The fused schema has free-text actions, discrete steps always take two calls
+        if self.step_mode == "fused" and not discrete:
+            prefix, delta = self.fused_prompt_parts(state, program)
+            output = await self.generate_content_async(
+                delta,
+                semaphore,
+                dict(self.fused_generation_config, **(config_overrides or {})),
+                prefix,
+                stage="step",
+            )
+            try:
+                return self.parse_fused_output(output)
+            except OutputParsingError:
+                # Redo this week only, with the two-call steps below
+                self.router.record_failure("step")
+        actions = await self.choose_actions_async(state, program, semaphore, config_overrides, discrete)
+        return actions, await self.determine_next_state_async(
+            state, actions, semaphore, config_overrides
         )
-        return response.candidates[0].content.parts[0].text
 
     def get_actions_from_program_and_state(self, state: str, program: str) -> dict:
         """
@@ -76,9 +332,9 @@ class LifeSimulator:
         Returns:
             dict: Result with the chosen actions.
         """
-        prompt = f"""I present you someone's state that describes their health state and habits : { state }. They received those recommendations from their personal coach: { json.dumps(program) }. This is an ideal program, which means that they might not be able to respect each step of the program (it depends on their motivation, their objectives, etc… and all information that you can find in their state. Your goal is to find the realistic actions that they are going to do during the next week, based on their current state and the program they are given. Your goal is not to take the optimal actions but the most realistic ones based on their characteristics. The actions are split into different categories : { self.categories_actions }. For each category, you must choose 1 and only 1 action to take, the one that is the most probable according to you. If you do not have any information on a given category, return 'I do not have any information on that category' and do not invent anything. You may decide not to do anything : if so, you must specify it by returning 'none' for the concerned category. When returning the actions, you must use the first person at the present time. for You must then output your actions as a string with the following json format (without forgetting the brackets) : "category_1" : 'action_1', "category_2": 'action_2', etc…"""
+        prefix, delta = self.actions_prompt_parts(state, program)
 
-        actions = self.generate_content(prompt)
+        actions = self.generate_content(delta, self.actions_generation_config, prefix, stage="actions")
         return actions
 
     def determine_next_state(self, state: str, actions: dict) -> str:
@@ -92,8 +348,8 @@ class LifeSimulator:
         Returns:
             str: Next state at time t+1.
         """
-        prompt = f"""I present you someone's state that describes the health state and habits that they had at the beginning of the week : { state }. During this week, they took many actions regarding different categories : { actions }. These actions are all they did during this week. You must not assume that they did something else during this week. Your goal is to determine their state at the end of the week. This new state must take into account their characteristics and the actions that they have taken during the week. Be careful and take into consideration that turning an action into a habit takes times, so their state cannot change drastically in a week. If a category contains 'I do not have any information on that category', do not take it into consideration. You must not invent something for those categories, so do not write something if you do not have any information on it. Your result must then be the realistic and probable one. You should then output the new state as a string. The format must be detailed and precise but as concise as possible. And finally, you must use the first person at the present time."""
-        next_state = self.generate_content(prompt)
+        prefix, delta = self.next_state_prompt_parts(state, actions)
+        next_state = self.generate_content(delta, prefix=prefix)
         return next_state
 
     def get_evolution_given_program(
@@ -113,38 +369,132 @@ class LifeSimulator:
         all_actions = []
         all_states = []
         for t in range(time_horizon):
-            actions = self.get_actions_from_program_and_state(program, initial_state)
-            formatted_actions = format_actions_output(actions)
-            next_state = self.determine_next_state(initial_state, formatted_actions)
+            formatted_actions, next_state = self.step(initial_state, program)
             all_actions.append(formatted_actions)
             all_states.append(next_state)
             initial_state = next_state
         return {"actions": all_actions, "states": all_states}
 
-    def simulation_pipeline(
-        self, initial_state: str, program: str, time_horizon: int
-    ) -> tuple:
+    async def get_actions_from_program_and_state_async(
+        self, state: str, program: str, semaphore=None, config_overrides=None, discrete=False
+    ) -> str:
+        prefix, delta = self.actions_prompt_parts(state, program)
+        generation_config = self.discrete_actions_generation_config if discrete else self.actions_generation_config
+        return await self.generate_content_async(
+            delta, semaphore, dict(generation_config, **(config_overrides or {})), prefix, stage="actions"
+        )
+
+    async def determine_next_state_async(
+        self, state: str, actions: dict, semaphore=None, config_overrides=None
+    ) -> str:
+        prefix, delta = self.next_state_prompt_parts(state, actions)
+        return await self.generate_content_async(
+            delta, semaphore, dict(GENERATION_CONFIG, **(config_overrides or {})), prefix
+        )
+
+    async def iter_evolution_given_program_async(
+        self,
+        initial_state: str,
+        program: str,
+        time_horizon: int,
+        semaphore=None,
+        start_week: int = 0,
+        config_overrides: dict = None,
+        discrete: bool = False,
+    ):
         """
-        Whole pipeline for the simulation model.
+        Yield each simulated week as soon as its next state is known.
+
+        Args:
+            initial_state (str): State at t=start_week.
+            program (str): Program recommended by the first LLM.
+            time_horizon (int): Number of time steps to consider.
+            semaphore (asyncio.Semaphore): Optional cap on concurrent Gemini calls.
+            start_week (int): Number of weeks already simulated, used to resume a run.
+            config_overrides (dict): Generation config entries to override, e.g. temperature and seed.
+            discrete (bool): Choose each category's action among its ACTION_LABELS instead of free text.
+
+        Yields:
+            dict: {"week": week number starting at 1, "actions": dict, "state": str}.
+        """
+        for t in range(start_week, time_horizon):
+            formatted_actions, next_state = await self.step_async(
+                initial_state, program, semaphore, config_overrides, discrete
+            )
+            yield {"week": t + 1, "actions": formatted_actions, "state": next_state}
+            initial_state = next_state
+
+    async def get_evolution_given_program_async(
+        self, initial_state: str, program: str, time_horizon: int, semaphore=None
+    ) -> dict:
+        """
+        Async version of get_evolution_given_program.
+
+        Args:
+            initial_state (str): Initial state at t=0.
+            program (str): Program recommended by the first LLM.
+            time_horizon (int): Number of time steps to consider.
+            semaphore (asyncio.Semaphore): Optional cap on concurrent Gemini calls.
+
+        Returns:
+            dict: Dictionary containing the list of actions and the list of states.
+        """
+        all_actions = []
+        all_states = []
+        async for week in self.iter_evolution_given_program_async(
+            initial_state, program, time_horizon, semaphore
+        ):
+            all_actions.append(week["actions"])
+            all_states.append(week["state"])
+        return {"actions": all_actions, "states": all_states}
+
+    async def simulation_pipeline_async(
+        self,
+        initial_state: str,
+        program: str,
+        time_horizon: int,
+        max_concurrency: int = None,
+    ) -> dict:
+        """
+        Run the habits and program trajectories concurrently.
 
         Args:
             initial_state (str): Initial state at t=0.
             program (str): Program recommended by the first LLM.
-            current_habits (str): Current habits of the agent.
             time_horizon (int): Number of time steps to consider.
+            max_concurrency (int): Cap on concurrent Gemini calls, defaults to self.max_concurrency.
 
         Returns:
             dict: Dictionary containing the evolution of the habits and the program.
         """
-        return {
-            "habits": self.get_evolution_given_program(
-                initial_state, self.prompt_no_program, time_horizon
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+        habits, program_evolution = await asyncio.gather(
+            self.get_evolution_given_program_async(
+                initial_state, self.prompt_no_program, time_horizon, semaphore
             ),
-            "program": self.get_evolution_given_program(
-                initial_state, program, time_horizon
+            self.get_evolution_given_program_async(
+                initial_state, program, time_horizon, semaphore
             ),
-        }
+        )
+        return {"habits": habits, "program": program_evolution}
+
+    def simulation_pipeline(
+        self, initial_state: str, program: str, time_horizon: int
+    ) -> dict:
+        """
+        Whole pipeline for the simulation model.
+
+        Args:
+            initial_state (str): Initial state at t=0.
+            program (str): Program recommended by the first LLM.
+            time_horizon (int): Number of time steps to consider.
 
+        Returns:
+            dict: Dictionary containing the evolution of the habits and the program.
+        """
+        return asyncio.run(
+            self.simulation_pipeline_async(initial_state, program, time_horizon)
+        )
 
 if __name__ == "__main__":
     simulator = LifeSimulator()
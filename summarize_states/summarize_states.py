@@ -1,39 +1,199 @@
+import asyncio
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import vertexai
-from vertexai.preview.generative_models import GenerativeModel
 from dotenv import load_dotenv
 import os
 
+from llm.metrics import record_usage, span
+from llm.resilience import ResilientCaller
+from llm.routing import ModelRouter
 from summarize_states.explo.input_example import EXAMPLE_STATES_2, EXAMPLE_ACTIONS_2
 
+MODEL_NAME = "gemini-1.5-pro-002"
+SYSTEM_INSTRUCTION = "You are a helpful assistant that can answer questions and help with tasks."
+GENERATION_CONFIG = {
+    "max_output_tokens": 512,
+    "temperature": 0.3,
+    "top_p": 0.95,
+}
+TONES = {
+    "program": "The summary should have a motivational tone, because they feel proud of what they accomplished and the progress they made.",
+    "habits": "The summary should have a deceptive tone, because they did not make any progress and feel sad about it.",
+}
+
+
+class RunningSummary:
+    """
+    Summary of a trajectory kept up to date as each week arrives.
+
+    Every update sends only the previous summary and the new week, so the cost per
+    week does not grow with the horizon and the final summary is available as soon
+    as the last week has been folded in.
+    """
+
+    def __init__(self, summarizer, tone: str):
+        self.summarizer = summarizer
+        self.tone = tone
+        self.summary = ""
+        self.weeks = 0
+        self.lock = asyncio.Lock()
+
+    def update(self, actions: dict, state: str) -> str:
+        self.weeks += 1
+        prompt = self.summarizer.build_update_prompt(
+            self.summary, self.weeks, actions, state, self.tone
+        )
+        self.summary = self.summarizer.generate_content(prompt)
+        return self.summary
+
+    async def update_async(self, actions: dict, state: str, semaphore=None) -> str:
+        # The lock is FIFO, so updates scheduled as concurrent tasks are applied in week order.
+        async with self.lock:
+            self.weeks += 1
+            prompt = self.summarizer.build_update_prompt(
+                self.summary, self.weeks, actions, state, self.tone
+            )
+            self.summary = await self.summarizer.generate_content_async(prompt, semaphore)
+            return self.summary
+
 
 class StateSummarizer:
-    def __init__(self, env_file="conf.env"):
+    def __init__(
+        self,
+        env_file="conf.env",
+        cache=None,
+        max_weeks_per_prompt=20,
+        resilience=None,
+        router=None,
+        map_workers=4,
+        reduce_fan_in=8,
+    ):
         load_dotenv(env_file)
         PROJECT_ID = os.getenv("PROJECT_ID")
         REGION = os.getenv("LOCATION")
         vertexai.init(project=PROJECT_ID, location=REGION)
-        self.model = GenerativeModel(
-            "gemini-1.5-pro-002",
-            system_instruction="You are a helpful assistant that can answer questions and help with tasks.",
-        )
+        # Optional llm.cache.ResponseCache shared with the other generators.
+        self.cache = cache
+        # Optional llm.resilience.ResilientCaller shared with the other Gemini clients.
+        self.resilience = resilience or ResilientCaller()
+        # Optional llm.routing.ModelRouter choosing the model of the "summary" stage.
+        self.router = router or ModelRouter()
+        # Above this many weeks, summaries are built with map-reduce over chunks of weeks.
+        self.max_weeks_per_prompt = max_weeks_per_prompt
+        # Shared by every request, so long horizons cannot multiply the concurrent chunk calls
+        self.pool = ThreadPoolExecutor(max_workers=map_workers, thread_name_prefix="summary-map")
+        # Largest number of summaries reduced by a single prompt
+        self.reduce_fan_in = reduce_fan_in
 
     def generate_content(self, text):
-        response = self.model.generate_content(
-            [text],
-            generation_config={
-                "max_output_tokens": 512,
-                "temperature": 0.3,
-                "top_p": 0.95,
-            },
+        model_name = self.router.model_name("summary")
+
+        def generate():
+            with span("generate.summary") as timing:
+                response = self.resilience.call(
+                    self.router.model(model_name, SYSTEM_INSTRUCTION).generate_content,
+                    [text],
+                    generation_config=GENERATION_CONFIG,
+                    stage="summary",
+                )
+            self.router.record("summary", model_name, timing.seconds)
+            record_usage(model_name, "summary", response)
+            return response.candidates[0].content.parts[0].text
+
+        if self.cache is None:
+            return generate()
+        key = self.cache.make_key(model_name, SYSTEM_INSTRUCTION, text, GENERATION_CONFIG)
+        return self.cache.get_or_compute(key, generate)
+
+    async def generate_content_async(self, text, semaphore=None):
+        model_name = self.router.model_name("summary")
+
+        async def generate():
+            async with semaphore or contextlib.nullcontext():
+                with span("generate.summary") as timing:
+                    response = await self.resilience.call_async(
+                        self.router.model(model_name, SYSTEM_INSTRUCTION).generate_content_async,
+                        [text],
+                        generation_config=GENERATION_CONFIG,
+                        stage="summary",
+                    )
+            self.router.record("summary", model_name, timing.seconds)
+            record_usage(model_name, "summary", response)
+            return response.candidates[0].content.parts[0].text
+
+        if self.cache is None:
+            return await generate()
+        key = self.cache.make_key(model_name, SYSTEM_INSTRUCTION, text, GENERATION_CONFIG)
+        return await self.cache.get_or_compute_async(key, generate)
+
+    def running_summary(self, tone: str) -> RunningSummary:
+        return RunningSummary(self, tone)
+
+    def build_update_prompt(self, summary: str, week: int, actions: dict, state: str, tone: str) -> str:
+        previous = (
+            f"Here is the summary of what they did and what they have been through during the first { week - 1 } weeks : { summary }."
+            if summary
+            else "This is the first week."
         )
-        return response.candidates[0].content.parts[0].text
+        return f"""{ previous } During week { week }, they did these actions : { actions }, and at the end of this week, their state is the following : { state }. Your goal is to make an updated summary of what they did and what they have been through since the first week, including this week. This summary must not exceed 3 sentences. { TONES[tone] } You must use the first person. You must output a string containing only the summary as a result."""
+
+    def build_chunk_prompt(self, first_week: int, actions: list, states: list) -> str:
+        return f"""I present you a series of actions that a person did during weeks { first_week } to { first_week + len(actions) - 1 } : { actions }. The first actions correspond to the ones they made during week { first_week }, and the last ones correspond to the actions they made during week { first_week + len(actions) - 1 }. I also present you a series of states that they went through during those weeks : { states }. Your goal is to make a factual summary of what they did and how their state evolved during those weeks. This summary must not exceed 3 sentences. You must use the first person. You must output a string containing only the summary as a result."""
+
+    def build_reduce_prompt(self, chunk_summaries: list, tone: str = None) -> str:
+        """Final reduce with the tone, or an intermediate, factual one when tone is None."""
+        kind, tone = ("single", TONES[tone]) if tone is not None else ("single factual", "")
+        return f"""I present you a series of summaries of what a person did and what they have been through, each covering a few consecutive weeks, in chronological order : { chunk_summaries }. Your goal is to make a { kind } summary of what they did and what they have been through during all those weeks. This summary must not exceed 3 sentences. { tone } You must use the first person. You must output a string containing only the summary as a result."""
+
+    def generate_all(self, prompts: list) -> list:
+        """Answers of the prompts in order, generated in parallel on the shared pool."""
+        # Each call runs in a copy of the caller's context, so it keeps the request's latency budget and timings
+        futures = [
+            self.pool.submit(contextvars.copy_context().run, self.generate_content, prompt)
+            for prompt in prompts
+        ]
+        return [future.result() for future in futures]
+
+    def summarize_map_reduce(self, actions: list, states: list, tone: str) -> str:
+        """
+        Summarize a long trajectory by summarizing chunks of weeks in parallel, then the chunk summaries.
+
+        Summaries are reduced by groups of reduce_fan_in until one prompt can hold
+        them all, so no prompt grows with the horizon.
+
+        Args:
+            actions (list): Actions of each week.
+            states (list): States at the end of each week.
+            tone (str): "program" or "habits".
+
+        Returns:
+            str: Summary of at most 3 sentences.
+        """
+        size = self.max_weeks_per_prompt
+        prompts = [
+            self.build_chunk_prompt(start + 1, actions[start : start + size], states[start : start + size])
+            for start in range(0, len(actions), size)
+        ]
+        summaries = self.generate_all(prompts)
+        fan_in = self.reduce_fan_in
+        while len(summaries) > fan_in:
+            summaries = self.generate_all(
+                [self.build_reduce_prompt(summaries[i : i + fan_in]) for i in range(0, len(summaries), fan_in)]
+            )
+        return self.generate_content(self.build_reduce_prompt(summaries, tone))
 
     def summarize_program_states(self, actions: list[str], states: list[str]) -> dict:
+        if len(states) > self.max_weeks_per_prompt:
+            return self.summarize_map_reduce(actions, states, "program")
         prompt = f"""I present you a series of actions that a person did during the past few weeks : { actions }. The first actions correspond to the ones they made during the first week, and the last ones correspond to the actions they made during the past week. I also present you a series of states that they went through during those weeks : { states }. Your goal is to make a summary of what they did and what they have been through during those weeks. This summary must not exceed 3 sentences. The summary should have a motivational tone, because they feel proud of what they accomplished and the progress they made. You must use the first person. You must output a string containing only the summary as a result."""
         summary = self.generate_content(prompt)
         return summary
 
     def summarize_habits_states(self, actions: list[str], states: list[str]) -> dict:
+        if len(states) > self.max_weeks_per_prompt:
+            return self.summarize_map_reduce(actions, states, "habits")
         prompt = f"""I present you a series of actions that a person did during the past few weeks : { actions }. The first actions correspond to the ones they made during the first week, and the last ones correspond to the actions they made during the past week. I also present you a series of states that they went through during those weeks : { states }. Your goal is to make a summary of what they did and what they have been through during those weeks. This summary must not exceed 3 sentences. The summary should have a deceptive tone, because they did not make any progress and feel sad about it. You must use the first person. You must output a string containing only the summary as a result."""
         summary = self.generate_content(prompt)
         return summary
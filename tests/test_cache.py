@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from llm.cache import ResponseCache
+
+
+def test_waiters_recompute_when_the_leader_is_cancelled():
+    async def scenario():
+        cache = ResponseCache()
+        calls = []
+        started = asyncio.Event()
+
+        async def stuck():
+            calls.append("leader")
+            started.set()
+            await asyncio.Event().wait()
+
+        async def compute():
+            calls.append("waiter")
+            return "value"
+
+        leader = asyncio.create_task(cache.get_or_compute_async("key", stuck))
+        await started.wait()
+        waiter = asyncio.create_task(cache.get_or_compute_async("key", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await waiter == "value"
+        assert calls == ["leader", "waiter"]
+        assert cache.get("key") == "value"
+        assert cache.in_flight_async == {}
+
+    asyncio.run(scenario())
+
+
+def test_leader_errors_reach_the_waiters():
+    async def scenario():
+        cache = ResponseCache()
+        release = asyncio.Event()
+
+        async def failing():
+            await release.wait()
+            raise ValueError("boom")
+
+        tasks = [asyncio.create_task(cache.get_or_compute_async("key", failing)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert [type(result) for result in results] == [ValueError, ValueError]
+        assert cache.get_stats()["misses"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_purge_drops_expired_and_oldest_rows(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.sqlite3"), max_disk_entries=2, ttl_seconds=60)
+    now = time.time()
+    cache.set_disk("expired", "x", now - 120)
+    for i in range(3):
+        cache.set_disk(f"key{i}", "x", now + i)
+    cache.purge()
+    keys = [row[0] for row in cache.db.execute("SELECT key FROM responses ORDER BY key")]
+    assert keys == ["key1", "key2"]
+    assert cache.get_stats()["purged"] == 2
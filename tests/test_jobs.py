@@ -0,0 +1,73 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from server.executors import ExecutorSaturatedError
+from server.jobs import JobManager, JobStore
+
+
+class FakeSimulator:
+    def __init__(self):
+        self.start_weeks = []
+
+    async def iter_evolution_given_program_async(self, state, program, time_horizon, start_week=0):
+        self.start_weeks.append(start_week)
+        for week in range(start_week + 1, time_horizon + 1):
+            yield {"week": week, "actions": {"Sport": f"week {week}"}, "state": f"{state}+{week}"}
+
+
+async def finished(manager, job_id):
+    task = manager.tasks.get(job_id)
+    if task is not None:
+        await task
+    return await manager.get(job_id)
+
+
+def make_manager(tmp_path, **kwargs):
+    return JobManager(FakeSimulator(), JobStore(str(tmp_path / "jobs.sqlite3")), **kwargs)
+
+
+REQUEST = {"initial_state": "s", "program": "p", "time_horizon": 2}
+
+
+def test_extend_only_computes_the_new_weeks(tmp_path):
+    async def scenario():
+        manager = make_manager(tmp_path)
+        job_id = await manager.submit(REQUEST)
+        await finished(manager, job_id)
+        await manager.extend(job_id, 4)
+        job = await finished(manager, job_id)
+        assert job["status"] == "succeeded"
+        assert len(job["life_simulation"]["states"]) == 4
+        assert manager.life_simulator.start_weeks == [0, 2]
+
+    asyncio.run(scenario())
+
+
+def test_extend_rolls_the_horizon_back_when_the_job_cannot_resume(tmp_path):
+    async def scenario():
+        manager = make_manager(tmp_path)
+        job_id = await manager.submit(REQUEST)
+        await finished(manager, job_id)
+
+        def locked(*args):
+            raise sqlite3.OperationalError("database is locked")
+
+        manager.store.claim = locked
+        with pytest.raises(sqlite3.OperationalError):
+            await manager.extend(job_id, 4)
+        assert (await manager.get(job_id))["request"]["time_horizon"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_extend_is_refused_before_the_horizon_changes_when_saturated(tmp_path):
+    async def scenario():
+        manager = make_manager(tmp_path, max_pending=0)
+        job_id = await asyncio.to_thread(manager.store.create, REQUEST)
+        with pytest.raises(ExecutorSaturatedError):
+            await manager.extend(job_id, 4)
+        assert (await manager.get(job_id))["request"]["time_horizon"] == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import pytest
+
+from llm.parsing import (
+    NO_INFORMATION,
+    IncrementalObjectParser,
+    OutputParsingError,
+    parse_json_object,
+    validate_actions,
+)
+
+CATEGORIES = ["Sport", "Diet", "Sleep"]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '{"Sport": "run"}',
+        'Here are the actions: {"Sport": "run"} Hope it helps.',
+        '```json\n{"Sport": "run"}\n```',
+        '{"Sport": "run",}',
+        "{'Sport': 'run'}",
+        '{\\"Sport\\": \\"run\\"}',
+        '{"Sport": "run"',
+        '"Sport": "run"',
+    ],
+)
+def test_parse_json_object_repairs(text):
+    assert parse_json_object(text) == {"Sport": "run"}
+
+
+def test_parse_json_object_rejects_non_objects():
+    with pytest.raises(OutputParsingError):
+        parse_json_object("I cannot answer that.")
+    with pytest.raises(OutputParsingError):
+        parse_json_object("[1, 2]")
+
+
+def test_incremental_parser_returns_members_as_they_complete():
+    parser = IncrementalObjectParser()
+    assert parser.feed('```json\n{"Sport": {"run": "tw') == []
+    assert parser.feed('ice a week"}, "Di') == [("Sport", {"run": "twice a week"})]
+    assert parser.feed('et": {"fruit": "a, b}"}, "count": 3') == [("Diet", {"fruit": "a, b}"})]
+    assert parser.feed("}\n```") == [("count", 3)]
+    assert parser.feed(', "after": 1}') == []
+
+
+def test_incremental_parser_skips_invalid_members():
+    parser = IncrementalObjectParser()
+    assert parser.feed('{"a": nope, "b": [1, 2]}') == [("b", [1, 2])]
+
+
+def test_validate_actions_matches_categories():
+    actions = validate_actions({" sport ": "run", "diet": {"meal": "salad"}, "Unknown": "x"}, CATEGORIES)
+    assert actions == {"Sport": "run", "Diet": '{"meal": "salad"}', "Sleep": NO_INFORMATION}
+
+
+def test_validate_actions_rejects_unrelated_objects():
+    with pytest.raises(OutputParsingError):
+        validate_actions({"Unknown": "x"}, CATEGORIES)
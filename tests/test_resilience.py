@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("google.api_core")
+
+from llm.resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+
+
+def open_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.on_failure()
+    return breaker
+
+
+def test_half_open_lets_a_single_trial_through():
+    breaker = open_breaker()
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.on_failure()
+    assert breaker.before_call() is True
+    breaker.on_success()
+    assert breaker.state == "closed"
+
+
+def test_cancelled_trial_releases_the_breaker():
+    async def scenario():
+        breaker = open_breaker()
+        caller = ResilientCaller("test", breaker=breaker, hedge_percentile=None)
+        started = asyncio.Event()
+
+        async def stuck():
+            started.set()
+            await asyncio.Event().wait()
+
+        trial = asyncio.create_task(caller.call_async(stuck))
+        await started.wait()
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        # Neither a success nor a failure: the next call is the trial
+        assert breaker.before_call() is True
+
+    asyncio.run(scenario())
+
+
+def test_failed_trial_reopens_the_breaker():
+    async def scenario():
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+        breaker.on_failure()
+        breaker.opened_at -= 60
+        caller = ResilientCaller("test", breaker=breaker, hedge_percentile=None, max_attempts=1)
+
+        async def failing():
+            raise ConnectionError("reset by peer")
+
+        with pytest.raises(ConnectionError):
+            await caller.call_async(failing)
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+    asyncio.run(scenario())
@@ -1,35 +1,175 @@
 #%%
 from google.cloud import texttospeech
 import io
-import random
 import base64
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from llm.metrics import span
+
+# Compressed encodings first, LINEAR16 is kept for callers that need raw PCM
+AUDIO_ENCODINGS = {
+    "ogg_opus": (texttospeech.AudioEncoding.OGG_OPUS, "audio/ogg"),
+    "mp3": (texttospeech.AudioEncoding.MP3, "audio/mpeg"),
+    "linear16": (texttospeech.AudioEncoding.LINEAR16, "audio/wav"),
+}
+# Sentences are grouped up to this many characters per request, well under the 5000 bytes limit
+MAX_CHUNK_CHARS = 400
+
+
+def split_sentences(text, max_chars=MAX_CHUNK_CHARS):
+    """Split text into chunks of whole sentences, so the first one can be played while the rest render."""
+    sentences = [s for s in re.split(r"(?<=[.!?…])\s+", text.strip()) if s]
+    chunks = []
+    for sentence in sentences:
+        if chunks and len(chunks[-1]) + 1 + len(sentence) <= max_chars:
+            chunks[-1] += " " + sentence
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+class AudioCache:
+    """In-memory LRU of synthesized audio, bounded by the total size of the clips."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text, voice_name, audio_encoding, speaking_rate) -> str:
+        payload = "\x00".join([text, voice_name, audio_encoding, str(speaking_rate)])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            audio = self.entries.get(key)
+            if audio is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return audio
+
+    def set(self, key, audio: bytes):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = audio
+            self.size += len(audio)
+            while self.size > self.max_bytes and self.entries:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
 
 class TextToSpeech:
-    def __init__(self):
+    def __init__(self, audio_encoding="ogg_opus", cache=None, max_workers=4, media_store=None):
+        if audio_encoding not in AUDIO_ENCODINGS:
+            raise ValueError(f"audio_encoding must be one of {list(AUDIO_ENCODINGS)}, got {audio_encoding!r}")
         self.client = texttospeech.TextToSpeechClient()
-        self.audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.LINEAR16,
-            speaking_rate=1
-        )
+        self.audio_encoding = audio_encoding
+        self.speaking_rate = 1
         self.voices = [
             "en-GB-Journey-D",
             "en-GB-News-K",
             "en-GB-Wavenet-A",
             "en-GB-Wavenet-F"
         ]
+        # Optional AudioCache, the same text with the same voice and config is synthesized once
+        self.cache = cache
+        # Chunks of one text are synthesized in parallel, in this pool
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-chunk")
+        # Optional MediaStore, speech_media writes the audio there instead of returning it
+        self.media_store = media_store
+
+    def voice_for(self, user_id=None) -> str:
+        """Always the same voice for the same user, so that their audio can be cached."""
+        if user_id is None:
+            return self.voices[0]
+        digest = hashlib.sha256(str(user_id).encode("utf-8")).digest()
+        return self.voices[int.from_bytes(digest[:4], "big") % len(self.voices)]
+
+    def media_type(self, audio_encoding=None) -> str:
+        return AUDIO_ENCODINGS[audio_encoding or self.audio_encoding][1]
+
+    def chunks(self, text, audio_encoding=None) -> list:
+        # Only MP3 frames can be concatenated: every LINEAR16 clip has its own WAV header,
+        # and concatenated Ogg files are a chained stream most players stop after the first link of
+        if (audio_encoding or self.audio_encoding) != "mp3":
+            return [text]
+        return split_sentences(text)
+
+    def synthesize(self, text, voice_name, audio_encoding=None) -> bytes:
+        """Audio bytes for one chunk of text."""
+        audio_encoding = audio_encoding or self.audio_encoding
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(text, voice_name, audio_encoding, self.speaking_rate)
+            audio = self.cache.get(key)
+            if audio is not None:
+                return audio
 
-    def text_to_speech(self, text):
-        voice_name = random.choice(self.voices)
         input_text = texttospeech.SynthesisInput(text=text)
         voice = texttospeech.VoiceSelectionParams(
             language_code="en-GB",
             name=voice_name,
         )
-        response = self.client.synthesize_speech(
-            request={"input": input_text, "voice": voice, "audio_config": self.audio_config}
+        audio_config = texttospeech.AudioConfig(
+            audio_encoding=AUDIO_ENCODINGS[audio_encoding][0],
+            speaking_rate=self.speaking_rate
         )
+        with span("tts.synthesize"):
+            response = self.client.synthesize_speech(
+                request={"input": input_text, "voice": voice, "audio_config": audio_config}
+            )
+
+        audio = io.BytesIO(response.audio_content).read()
+        if self.cache is not None:
+            self.cache.set(key, audio)
+        return audio
 
-        audio_bytes = io.BytesIO(response.audio_content).read()
+    def iter_speech(self, text, user_id=None, audio_encoding=None):
+        """
+        Yield the audio of text chunk by chunk, in order.
+
+        Every chunk is submitted at once, so the first one is yielded as soon as it
+        is ready while the others are still rendering. Only MP3 is split into
+        several chunks, which can be concatenated as they come.
+        """
+        voice_name = self.voice_for(user_id)
+        futures = [
+            self.executor.submit(self.synthesize, chunk, voice_name, audio_encoding)
+            for chunk in self.chunks(text, audio_encoding)
+        ]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            # The caller's executor slot covers this call, it must not end while chunks still render
+            wait(futures)
+
+    def text_to_speech(self, text, user_id=None, audio_encoding=None):
+        audio_bytes = b"".join(self.iter_speech(text, user_id, audio_encoding))
         return base64.b64encode(audio_bytes).decode('utf-8')
 
+    def speech_media(self, text, user_id=None, audio_encoding=None) -> dict:
+        """Write the audio to the media store as its chunks come, and return its reference."""
+        if self.media_store is None:
+            raise RuntimeError("speech_media needs a media_store")
+        return self.media_store.put_stream(
+            self.iter_speech(text, user_id, audio_encoding), self.media_type(audio_encoding)
+        )
+
 # %%